@@ -18,6 +18,8 @@ AUTH_USER_MODEL = "users.User"
 
 AUTH_API_LOGIN_URL = os.environ.get('AUTH_LOGIN_URL')
 
+ETL_NOTIFY_CHANNEL = os.environ.get('ETL_NOTIFY_CHANNEL', 'etl_changes')
+
 AUTHENTICATION_BACKENDS = [
     'users.auth.AuthBackend',
 ]
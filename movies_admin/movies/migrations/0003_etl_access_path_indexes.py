@@ -0,0 +1,44 @@
+from django.db import migrations, models
+
+# (модель, имя индекса, таблица, колонки). Те же индексы создаёт schema_design/movies_database.ddl.
+INDEXES = (
+    ('filmwork', 'film_work_modified_idx', 'film_work', ('modified', 'id')),
+    ('genre', 'genre_modified_idx', 'genre', ('modified', 'id')),
+    ('person', 'person_modified_idx', 'person', ('modified', 'id')),
+    ('personfilmwork', 'person_film_work_person_idx', 'person_film_work', ('person_id', 'film_work_id')),
+    ('genrefilmwork', 'genre_film_work_genre_idx', 'genre_film_work', ('genre_id', 'film_work_id')),
+)
+
+MODEL_FIELDS = {'person_id': 'person', 'genre_id': 'genre', 'film_work_id': 'film_work'}
+
+
+def add_index_concurrently(model_name: str, name: str, table: str, columns: tuple):
+    """
+    Создаёт индекс без блокировки записи в таблицу. IF NOT EXISTS нужен для баз, созданных из DDL,
+    где индекс уже есть.
+    """
+    return migrations.SeparateDatabaseAndState(
+        database_operations=[
+            migrations.RunSQL(
+                sql=f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON content.{table} ({", ".join(columns)});',
+                reverse_sql=f'DROP INDEX CONCURRENTLY IF EXISTS content.{name};',
+            ),
+        ],
+        state_operations=[
+            migrations.AddIndex(
+                model_name=model_name,
+                index=models.Index(fields=[MODEL_FIELDS.get(column, column) for column in columns], name=name),
+            ),
+        ],
+    )
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY нельзя выполнить внутри транзакции.
+    atomic = False
+
+    dependencies = [
+        ('movies', '0002_rename_genres_filmwork_filmwork_genres_and_more'),
+    ]
+
+    operations = [add_index_concurrently(*index) for index in INDEXES]
@@ -27,6 +27,9 @@ class Genre(UUIDMixin, TimeStampedMixin):
         db_table = "content\".\"genre"
         verbose_name = _('Genre')
         verbose_name_plural = _('Genres')
+        indexes = [
+            models.Index(fields=['modified', 'id'], name='genre_modified_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -39,6 +42,9 @@ class Person(UUIDMixin, TimeStampedMixin):
         db_table = "content\".\"person"
         verbose_name = _('Person')
         verbose_name_plural = _('Persons')
+        indexes = [
+            models.Index(fields=['modified', 'id'], name='person_modified_idx'),
+        ]
 
     def __str__(self):
         return self.full_name
@@ -69,6 +75,9 @@ class Filmwork(UUIDMixin, TimeStampedMixin):
         db_table = "content\".\"film_work"
         verbose_name = _('Filmwork')
         verbose_name_plural = _('Filmworks')
+        indexes = [
+            models.Index(fields=['modified', 'id'], name='film_work_modified_idx'),
+        ]
 
     def __str__(self):
         return self.title
@@ -83,6 +92,7 @@ class GenreFilmwork(UUIDMixin):
         db_table = "content\".\"genre_film_work"
         indexes = [
             models.Index(fields=['film_work', 'genre'], name='film_work_genre_idx'),
+            models.Index(fields=['genre', 'film_work'], name='genre_film_work_genre_idx'),
         ]
         constraints = [
             models.UniqueConstraint(fields=['film_work', 'genre'], name='unique_film_work_genre')
@@ -108,6 +118,7 @@ class PersonFilmwork(UUIDMixin):
         db_table = "content\".\"person_film_work"
         indexes = [
             models.Index(fields=['film_work', 'person'], name='film_work_person_idx'),
+            models.Index(fields=['person', 'film_work'], name='person_film_work_person_idx'),
         ]
         constraints = [
             models.UniqueConstraint(fields=['film_work', 'person'], name='unique_film_work_person')
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Genre, Filmwork, Person, GenreFilmwork, PersonFilmwork
+
+
+@receiver(post_save, sender=Filmwork)
+@receiver(post_save, sender=Genre)
+@receiver(post_save, sender=Person)
+@receiver(post_save, sender=GenreFilmwork)
+@receiver(post_save, sender=PersonFilmwork)
+@receiver(post_delete, sender=Filmwork)
+@receiver(post_delete, sender=Genre)
+@receiver(post_delete, sender=Person)
+@receiver(post_delete, sender=GenreFilmwork)
+@receiver(post_delete, sender=PersonFilmwork)
+def notify_etl(sender, **kwargs):
+    # NOTIFY доставляется только после коммита, а одинаковые уведомления одной транзакции схлопываются.
+    table_name = sender._meta.db_table.split('"."')[-1]
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, %s);', [settings.ETL_NOTIFY_CHANNEL, table_name])
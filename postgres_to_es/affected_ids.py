@@ -0,0 +1,88 @@
+import os
+import sqlite3
+import tempfile
+import uuid
+from typing import Iterable, Iterator, List, Optional
+
+
+class AffectedIds:
+    """
+    Множество идентификаторов документов, затронутых изменениями за цикл.
+
+    Идентификаторы хранятся в памяти как 16-байтовые строки. Когда их становится больше max_in_memory, множество
+    переносится во временную базу SQLite в каталоге spill_dir и дальше пополняется там. Пачки выдаются в порядке
+    возрастания идентификаторов, поэтому загрузку можно продолжить после последнего загруженного идентификатора.
+    """
+
+    def __init__(self, max_in_memory: int, spill_dir: Optional[str] = None):
+        self.max_in_memory = max_in_memory
+        self.spill_dir = spill_dir
+        self._ids = set()
+        self._conn = None
+        self._db_path = None
+        self._spilled = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self) -> int:
+        if self._conn is not None:
+            return self._spilled
+        return len(self._ids)
+
+    def add(self, ids: Iterable[uuid.UUID]) -> None:
+        keys = (item_id.bytes for item_id in ids)
+        if self._conn is not None:
+            self._insert(keys)
+            return
+        self._ids.update(keys)
+        if len(self._ids) > self.max_in_memory:
+            self._spill()
+
+    def _spill(self) -> None:
+        fd, self._db_path = tempfile.mkstemp(prefix='affected-ids-', suffix='.db', dir=self.spill_dir)
+        os.close(fd)
+        self._conn = sqlite3.connect(self._db_path)
+        # Файл временный и после падения не нужен, журнал и fsync только замедляют вставку.
+        self._conn.execute('PRAGMA journal_mode=OFF;')
+        self._conn.execute('PRAGMA synchronous=OFF;')
+        self._conn.execute('CREATE TABLE affected_id (id BLOB PRIMARY KEY) WITHOUT ROWID;')
+        self._insert(self._ids)
+        self._ids = set()
+
+    def _insert(self, keys: Iterable[bytes]) -> None:
+        with self._conn:
+            cursor = self._conn.executemany(
+                'INSERT OR IGNORE INTO affected_id (id) VALUES (?);',
+                ((key,) for key in keys)
+            )
+            self._spilled += cursor.rowcount
+
+    def batches(self, size: int, after: Optional[uuid.UUID] = None) -> Iterator[List[uuid.UUID]]:
+        """Выдаёт идентификаторы больше after пачками по size в порядке возрастания."""
+        after_key = after.bytes if after is not None else b''
+        if self._conn is None:
+            keys = sorted(key for key in self._ids if key > after_key)
+            for start in range(0, len(keys), size):
+                yield [uuid.UUID(bytes=key) for key in keys[start:start + size]]
+            return
+
+        while True:
+            rows = self._conn.execute(
+                'SELECT id FROM affected_id WHERE id > ? ORDER BY id LIMIT ?;',
+                (after_key, size)
+            ).fetchall()
+            if not rows:
+                return
+            yield [uuid.UUID(bytes=row[0]) for row in rows]
+            after_key = rows[-1][0]
+
+    def close(self) -> None:
+        self._ids = set()
+        if self._conn is not None:
+            self._conn.close()
+            os.remove(self._db_path)
+            self._conn = None
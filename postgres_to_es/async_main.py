@@ -0,0 +1,286 @@
+import asyncio
+import os
+import random
+from datetime import datetime
+from typing import AsyncIterator, Type
+
+from dotenv import load_dotenv
+from pydantic import BaseModel
+
+from settings import postgres_settings, elasticsearch_settings, etl_settings
+
+import psycopg
+from psycopg import AsyncConnection, sql
+from psycopg.conninfo import make_conninfo
+from elasticsearch import (
+    AsyncElasticsearch, ConnectionError as EsConnectionError, ConnectionTimeout as EsConnectionTimeout)
+from elasticsearch.helpers import BulkIndexError, async_bulk
+from psycopg.errors import (
+    ConnectionTimeout as PsConnectionTimeout, ConnectionFailure as PsConnectionFailure,
+    OperationalError as PsOperationalError)
+from psycopg.rows import dict_row
+
+from affected_ids import AffectedIds
+from loader import RETRYABLE_STATUSES
+from logger import logger
+from metrics import BACKOFF_SLEEP_SECONDS
+from queries import CHANGED_ITEMS_SQL, RELATED_ITEMS_SQL, fill_empty_lists
+from registry import INDEXES, IndexSpec
+from serialization import DocumentSerializer
+from state.checkpoints import MIN_UUID
+from state.models import State
+from state.storages import get_storage
+
+from decorators import async_backoff
+
+load_dotenv(dotenv_path='.env')
+
+serializer = DocumentSerializer(
+    logger=logger,
+    mode=etl_settings.serialization,
+    validation_sample_rate=1 if etl_settings.debug else etl_settings.validation_sample_rate
+)
+
+
+async def extract_changed_items(
+        conn: AsyncConnection,
+        table_name: str,
+        last_updated: datetime,
+        end_updated: datetime
+) -> AsyncIterator[list]:
+    logger.info(f'Fetching {table_name} changed after %s', last_updated)
+
+    sql_request = CHANGED_ITEMS_SQL.format(table_name=table_name, shard_filter='TRUE')
+    last_seen = (last_updated, MIN_UUID)
+    async with conn.cursor() as cur:
+        while True:
+            await cur.execute(sql_request, (*last_seen, end_updated, etl_settings.batch_size,))
+            items_data = await cur.fetchall()
+            if not items_data:
+                break
+            yield [item['id'] for item in items_data]
+            last_item = items_data[-1]
+            last_seen = (last_item['modified'], last_item['id'])
+
+
+async def extract_related_items(
+        conn: AsyncConnection,
+        item_ids: list,
+        primary_table: str,
+        join_table: str,
+        join_column: str,
+        filter_column: str
+) -> list:
+    sql_request = RELATED_ITEMS_SQL.format(
+        primary_table=primary_table,
+        join_table=join_table,
+        join_column=join_column,
+        filter_column=filter_column,
+        shard_filter='TRUE'
+    )
+    async with conn.cursor() as cur:
+        await cur.execute(sql_request, (item_ids,))
+        return [item['id'] for item in await cur.fetchall()]
+
+
+async def get_changed_ids(
+        conn: AsyncConnection,
+        index: IndexSpec,
+        last_updated: datetime,
+        end_updated: datetime
+) -> AsyncIterator[list]:
+    """Собирает идентификаторы документов, затронутых всеми источниками, и выдаёт их плотными пачками."""
+    with AffectedIds(
+            max_in_memory=etl_settings.dedup_max_in_memory,
+            spill_dir=etl_settings.dedup_spill_dir
+    ) as affected_ids:
+        for source in index.sources:
+            async for changed_ids in extract_changed_items(conn, source.table, last_updated, end_updated):
+                if source.join_path is not None:
+                    changed_ids = await extract_related_items(
+                        conn,
+                        changed_ids,
+                        index.root_table,
+                        source.join_path.join_table,
+                        source.join_path.join_column,
+                        source.join_path.filter_column
+                    )
+                affected_ids.add(changed_ids)
+        for item_ids in affected_ids.batches(size=etl_settings.transform_batch_size):
+            yield item_ids
+
+
+async def transform_data(conn: AsyncConnection, index: IndexSpec, item_ids: list) -> list:
+    async with conn.cursor() as cur:
+        if serializer.mode == 'raw':
+            await cur.execute(index.document_sql, (item_ids,))
+            return await cur.fetchall()
+        await cur.execute(index.details_sql, (item_ids,))
+        return list(fill_empty_lists(await cur.fetchall(), index.list_fields))
+
+
+@async_backoff(exceptions=(EsConnectionError, EsConnectionTimeout,), reraise=True)
+async def load_to_es(
+        data: list,
+        index: str,
+        es_client: AsyncElasticsearch,
+        model: Type[BaseModel],
+        start_sleep_time: float = 0.1,
+        factor: float = 2,
+        border_sleep_time: float = 10
+):
+    """
+    Загружает документы пачки и, как BulkLoader, повторяет только документы с временными ошибками (429, 5xx шлюза).
+
+    Если Elasticsearch отклонил документы по другой причине (например, не подходят под маппинг), поднимается
+    BulkIndexError: цикл не должен сдвигать last_update мимо незагруженных документов.
+    """
+    bulk_request = [
+        {
+            "_index": index,
+            "_id": item['id'],
+            "_source": source
+        } for item in data if (source := serializer.serialize(item, model)) is not None
+    ]
+    indexed, sleep_time = 0, start_sleep_time
+    while True:
+        success, errors = await async_bulk(es_client, bulk_request, raise_on_error=False, raise_on_exception=False)
+        indexed += success
+        failed_ids, rejected = set(), []
+        for error in errors:
+            result = next(iter(error.values()))
+            if result.get('status') in RETRYABLE_STATUSES:
+                failed_ids.add(str(result['_id']))
+            else:
+                rejected.append(error)
+        if rejected:
+            raise BulkIndexError(f'{len(rejected)} document(s) rejected by index {index}', rejected)
+        if not failed_ids:
+            break
+        bulk_request = [action for action in bulk_request if str(action['_id']) in failed_ids]
+        sleep_time = min((sleep_time * (1 + random.uniform(-0.5, 0.5))) * factor, border_sleep_time)
+        logger.warning(f'{len(failed_ids)} documents failed in index {index}. Retry in {sleep_time}s.')
+        BACKOFF_SLEEP_SECONDS.labels(function='bulk_load').inc(sleep_time)
+        await asyncio.sleep(sleep_time)
+    logger.info(f'Bulk indexing completed, {indexed} documents indexed.')
+
+
+async def load_batch(
+        data: list,
+        index: str,
+        es_client: AsyncElasticsearch,
+        model: Type[BaseModel],
+        bulk_slots: asyncio.Semaphore
+):
+    try:
+        await load_to_es(data=data, index=index, es_client=es_client, model=model)
+    finally:
+        bulk_slots.release()
+
+
+async def update_index(
+        dsn: str,
+        es_client: AsyncElasticsearch,
+        index: str,
+        bulk_slots: asyncio.Semaphore,
+        last_updated: datetime,
+        end_updated: datetime
+) -> int:
+    """
+    Обновляет один индекс, не дожидаясь завершения отправленных bulk-запросов.
+
+    Пока Elasticsearch индексирует предыдущие пачки, из PostgreSQL читается и трансформируется следующая.
+    Число одновременно выполняющихся bulk-запросов всех индексов ограничено семафором bulk_slots. Если загрузка
+    хотя бы одной пачки не удалась, ошибка пробрасывается после завершения остальных, и last_update не сдвигается.
+    """
+    spec = INDEXES[index]
+    processed = 0
+    # Завершённые задачи не удаляются из списка, иначе их ошибки были бы потеряны.
+    tasks = []
+    async with await AsyncConnection.connect(dsn, row_factory=dict_row, autocommit=True) as conn:
+        async for changed_ids in get_changed_ids(conn, spec, last_updated, end_updated):
+            formatted_items = await transform_data(conn, spec, changed_ids)
+            await bulk_slots.acquire()
+            tasks.append(asyncio.create_task(load_batch(formatted_items, index, es_client, spec.model, bulk_slots)))
+            processed += len(changed_ids)
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return processed
+
+
+async def listen_for_changes(dsn: str, changed: asyncio.Event):
+    async with await AsyncConnection.connect(dsn, autocommit=True) as conn:
+        await conn.execute(sql.SQL('LISTEN {};').format(sql.Identifier(etl_settings.notify_channel)))
+        async for _ in conn.notifies():
+            changed.set()
+
+
+async def update_from_modified(dsn: str, es_client: AsyncElasticsearch, state: State, bulk_slots: asyncio.Semaphore):
+    last_update_row = state.get_state('last_update') or datetime.min.strftime('%d-%m-%y %H:%M:%S')
+    last_update = datetime.strptime(last_update_row, '%d-%m-%y %H:%M:%S')
+    start_update_datetime = datetime.now()
+
+    processed = await asyncio.gather(*(
+        update_index(
+            dsn=dsn,
+            es_client=es_client,
+            index=index,
+            bulk_slots=bulk_slots,
+            last_updated=last_update,
+            end_updated=start_update_datetime
+        ) for index in INDEXES
+    ))
+
+    state.set_state('last_update', start_update_datetime.strftime('%d-%m-%y %H:%M:%S'))
+    return sum(processed)
+
+
+@async_backoff(exceptions=(PsConnectionFailure, PsConnectionTimeout, PsOperationalError,))
+async def main():
+    es_client = AsyncElasticsearch(hosts=elasticsearch_settings.hosts)
+    bulk_slots = asyncio.Semaphore(etl_settings.async_max_in_flight_bulks)
+
+    dsn = make_conninfo(**postgres_settings.dict())
+    os.makedirs(etl_settings.state_dir, exist_ok=True)
+    # Состояние пишется раз за цикл, поэтому хранилищу postgres хватает синхронного соединения.
+    state_conn = psycopg.connect(dsn, autocommit=True) if etl_settings.state_storage == 'postgres' else None
+    state = State(get_storage(name='storage', directory=etl_settings.state_dir, conn=state_conn))
+    changed = asyncio.Event()
+    listener = asyncio.create_task(listen_for_changes(dsn, changed))
+
+    try:
+        poll_interval = etl_settings.poll_interval_min
+        while True:
+            changed.clear()
+            try:
+                processed = await update_from_modified(
+                    dsn=dsn, es_client=es_client, state=state, bulk_slots=bulk_slots
+                )
+            except BulkIndexError as e:
+                # Окно цикла будет обработано заново в следующем цикле.
+                logger.error(f'Cycle failed, last_update is kept: {str(e)}. Errors: {e.errors[:10]}')
+                processed = 0
+
+            if processed:
+                poll_interval = etl_settings.poll_interval_min
+            else:
+                poll_interval = min(poll_interval * 2, etl_settings.poll_interval_max)
+            if listener.done():
+                # Пробрасываем ошибку соединения LISTEN, чтобы backoff переподключился.
+                listener.result()
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=poll_interval)
+                await asyncio.sleep(etl_settings.notify_debounce)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        listener.cancel()
+        await es_client.close()
+        if state_conn is not None:
+            state_conn.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,207 @@
+"""
+Замеряет время запросов ETL и админки на сгенерированных данных без индексов горячих путей и с ними.
+
+В отдельной базе --dbname (по умолчанию movies_benchmark) создаётся схема из schema_design/movies_database.ddl
+без индексов, которые в этом файле создаются CONCURRENTLY, и генерируются --films фильмов (по умолчанию 1 000 000)
+с персонами, жанрами и связями. Каждый запрос выполняется --repeat раз, печатается медиана времени. Затем индексы
+создаются CONCURRENTLY из того же файла, и замеры повторяются. В конце база удаляется, если не указан --keep.
+
+Запуск: python benchmark_indexes.py [--films 1000000] [--cast 8] [--genres 30] [--repeat 5] [--ddl FILE] [--keep]
+"""
+import argparse
+import hashlib
+import os
+import statistics
+import uuid
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+
+import psycopg
+from psycopg import sql
+from psycopg.conninfo import make_conninfo
+
+from queries import (
+    CHANGED_ITEMS_SQL, RELATED_ITEMS_SQL, FILMWORKS_DETAILS_SQL, GENRES_DETAILS_SQL, PERSONS_DETAILS_SQL)
+from settings import postgres_settings, etl_settings
+from state.checkpoints import MIN_UUID
+
+DEFAULT_DDL = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'schema_design', 'movies_database.ddl')
+
+# Идентификаторы вычисляются из номера записи, чтобы связи можно было генерировать без соединений таблиц.
+GENERATE_SQL = (
+    '''
+    INSERT INTO content.genre (id, name, created, modified)
+    SELECT md5('genre' || n)::uuid, 'Genre ' || n, now(), now() - random() * interval '365 days'
+    FROM generate_series(1, %(genres)s) AS n;
+    ''',
+    '''
+    INSERT INTO content.person (id, full_name, created, modified)
+    SELECT md5('person' || n)::uuid, 'Person ' || n, now(), now() - random() * interval '365 days'
+    FROM generate_series(1, %(persons)s) AS n;
+    ''',
+    '''
+    INSERT INTO content.film_work (id, title, creation_date, rating, type, created, modified)
+    SELECT
+        md5('film' || n)::uuid, 'Film ' || n, date '1950-01-01' + (random() * 25000)::int, round(random() * 100) / 10,
+        'movie', now(), now() - random() * interval '365 days'
+    FROM generate_series(1, %(films)s) AS n;
+    ''',
+    '''
+    INSERT INTO content.genre_film_work (id, genre_id, film_work_id, created)
+    SELECT gen_random_uuid(), md5('genre' || ((n * 7 + k) %% %(genres)s + 1))::uuid, md5('film' || n)::uuid, now()
+    FROM generate_series(1, %(films)s) AS n, generate_series(0, %(genres_per_film)s - 1) AS k;
+    ''',
+    '''
+    INSERT INTO content.person_film_work (id, person_id, film_work_id, role, created)
+    SELECT
+        gen_random_uuid(), md5('person' || (1 + floor(random() * %(persons)s))::int)::uuid, md5('film' || n)::uuid,
+        (ARRAY['actor', 'director', 'writer'])[1 + floor(random() * 3)::int], now()
+    FROM generate_series(1, %(films)s) AS n, generate_series(1, %(cast)s) AS k
+    ON CONFLICT DO NOTHING;
+    ''',
+)
+
+API_FILM_SQL = '''
+    SELECT
+        fw.id, fw.title, fw.description, fw.creation_date, fw.rating, fw.type,
+        ARRAY_AGG(DISTINCT g.name) AS genres,
+        ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'actor') AS actors
+    FROM content.film_work fw
+    LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+    LEFT JOIN content.genre g ON g.id = gfw.genre_id
+    LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+    LEFT JOIN content.person p ON p.id = pfw.person_id
+    WHERE fw.id = %s
+    GROUP BY fw.id;
+'''
+
+
+def record_id(kind: str, number: int) -> uuid.UUID:
+    return uuid.UUID(hashlib.md5(f'{kind}{number}'.encode()).hexdigest())
+
+
+def split_ddl(path: str) -> tuple:
+    """Делит DDL на обычные операторы и операторы CREATE INDEX CONCURRENTLY."""
+    with open(path) as ddl_file:
+        statements = [statement.strip() for statement in ddl_file.read().split(';') if statement.strip()]
+    concurrent = [statement for statement in statements if 'CONCURRENTLY' in statement]
+    return [statement for statement in statements if statement not in concurrent], concurrent
+
+
+def make_queries(films: int, persons: int, genres: int, batch: int) -> list:
+    now = datetime.now(timezone.utc)
+    since = now - timedelta(days=1)
+    film_ids = [record_id('film', number) for number in range(1, films + 1, max(films // batch, 1))][:batch]
+    person_ids = [record_id('person', number) for number in range(1, persons + 1, max(persons // batch, 1))][:batch]
+    queries = [
+        (
+            f'etl: changed {table_name} page',
+            CHANGED_ITEMS_SQL.format(table_name=table_name, shard_filter='TRUE'),
+            (since, MIN_UUID, now, batch)
+        ) for table_name in ('film_work', 'person', 'genre')
+    ]
+    queries += [
+        (
+            'etl: films of changed persons',
+            RELATED_ITEMS_SQL.format(
+                primary_table='film_work', join_table='person_film_work', join_column='film_work_id',
+                filter_column='person_id', shard_filter='TRUE'
+            ),
+            (person_ids,)
+        ),
+        (
+            'etl: persons of changed films',
+            RELATED_ITEMS_SQL.format(
+                primary_table='person', join_table='person_film_work', join_column='person_id',
+                filter_column='film_work_id', shard_filter='TRUE'
+            ),
+            (film_ids,)
+        ),
+        (
+            'etl: genres of changed films',
+            RELATED_ITEMS_SQL.format(
+                primary_table='genre', join_table='genre_film_work', join_column='genre_id',
+                filter_column='film_work_id', shard_filter='TRUE'
+            ),
+            (film_ids,)
+        ),
+        ('etl: transform films', FILMWORKS_DETAILS_SQL, (film_ids,)),
+        ('etl: transform persons', PERSONS_DETAILS_SQL, (person_ids,)),
+        ('etl: transform one genre', GENRES_DETAILS_SQL, ([record_id('genre', genres)],)),
+        (
+            'admin: films modified last 7 days',
+            'SELECT count(*) FROM content.film_work WHERE modified >= %s;',
+            (now - timedelta(days=7),)
+        ),
+        ('api: film detail', API_FILM_SQL, (film_ids[0],)),
+    ]
+    return queries
+
+
+def measure(conn: psycopg.Connection, query: str, params: tuple, repeat: int) -> float:
+    conn.execute(query, params).fetchall()
+    timings = []
+    for _ in range(repeat):
+        started = perf_counter()
+        conn.execute(query, params).fetchall()
+        timings.append((perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--films', type=int, default=1_000_000)
+    parser.add_argument('--persons', type=int, help='default: films / 2')
+    parser.add_argument('--genres', type=int, default=30)
+    parser.add_argument('--genres-per-film', type=int, default=2)
+    parser.add_argument('--cast', type=int, default=8, help='person links per film')
+    parser.add_argument('--batch', type=int, default=etl_settings.batch_size, help='ids per ETL query')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--dbname', default='movies_benchmark')
+    parser.add_argument('--ddl', default=DEFAULT_DDL)
+    parser.add_argument('--keep', action='store_true', help='keep the benchmark database')
+    args = parser.parse_args()
+    persons = args.persons or max(args.films // 2, 1)
+    plain_ddl, index_ddl = split_ddl(args.ddl)
+
+    admin_dsn = make_conninfo(**postgres_settings.dict())
+    with psycopg.connect(admin_dsn, autocommit=True) as admin_conn:
+        admin_conn.execute(sql.SQL('DROP DATABASE IF EXISTS {};').format(sql.Identifier(args.dbname)))
+        admin_conn.execute(sql.SQL('CREATE DATABASE {};').format(sql.Identifier(args.dbname)))
+
+    try:
+        with psycopg.connect(make_conninfo(admin_dsn, dbname=args.dbname), autocommit=True) as conn:
+            for statement in plain_ddl:
+                conn.execute(statement)
+            started = perf_counter()
+            params = {
+                'films': args.films, 'persons': persons, 'genres': args.genres,
+                'genres_per_film': min(args.genres_per_film, args.genres), 'cast': args.cast,
+            }
+            for statement in GENERATE_SQL:
+                conn.execute(statement, params)
+            conn.execute('VACUUM ANALYZE;')
+            print(f'Generated {args.films} films, {persons} persons, {args.genres} genres '
+                  f'in {perf_counter() - started:.0f} s')
+
+            queries = make_queries(films=args.films, persons=persons, genres=args.genres, batch=args.batch)
+            without_indexes = [measure(conn, query, params, args.repeat) for _, query, params in queries]
+
+            started = perf_counter()
+            for statement in index_ddl:
+                conn.execute(statement)
+            conn.execute('ANALYZE;')
+            print(f'Created {len(index_ddl)} indexes concurrently in {perf_counter() - started:.0f} s')
+            with_indexes = [measure(conn, query, params, args.repeat) for _, query, params in queries]
+
+        print(f'{"query":<36} {"without, ms":>12} {"with, ms":>10} {"speedup":>8}')
+        for (name, _, _), before, after in zip(queries, without_indexes, with_indexes):
+            print(f'{name:<36} {before:>12.1f} {after:>10.1f} {before / max(after, 0.001):>7.1f}x')
+    finally:
+        if not args.keep:
+            with psycopg.connect(admin_dsn, autocommit=True) as admin_conn:
+                admin_conn.execute(sql.SQL('DROP DATABASE IF EXISTS {};').format(sql.Identifier(args.dbname)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Сравнивает скорость сериализации документов (docs/sec) в режимах ETL_SERIALIZATION.
+
+Строки генерируются в том же виде, что возвращают SQL трансформации. Для режима raw тела документов собираются
+заранее, потому что в работе их строит PostgreSQL. Поэтому raw измеряет только передачу готовой строки получателю
+(sink only) и не сравним с остальными режимами напрямую: сборка JSON запросом document_sql здесь не учитывается,
+её стоимость видна по времени стадии transform в метрике etl_stage_seconds.
+
+Запуск: python benchmark_serialization.py [--docs 20000] [--sample-rate 0.01]
+"""
+import argparse
+import logging
+import random
+import uuid
+from datetime import date
+from time import perf_counter
+
+import orjson
+
+from serialization import DocumentSerializer, SERIALIZATION_MODES
+from state.models import Movie, Genre, Person
+
+logger = logging.getLogger('benchmark')
+
+
+def make_movie() -> dict:
+    persons = {
+        role: [{'id': str(uuid.uuid4()), 'name': f'Person {random.randint(0, 10 ** 6)}'} for _ in range(count)]
+        for role, count in (('directors', 2), ('actors', 30), ('writers', 4))
+    }
+    return {
+        'id': uuid.uuid4(),
+        'title': 'Star Wars: Episode IV - A New Hope',
+        'description': 'The Imperial Forces, under orders from cruel Darth Vader, hold Princess Leia hostage.',
+        'imdb_rating': 8.6,
+        'genres': [{'id': str(uuid.uuid4()), 'name': name} for name in ('Action', 'Adventure', 'Fantasy')],
+        **persons,
+        **{f'{role}_names': [person['name'] for person in persons[role]] for role in persons},
+        'creation_date': date(1977, 5, 25),
+    }
+
+
+def make_genre() -> dict:
+    return {
+        'id': uuid.uuid4(),
+        'name': 'Sci-Fi',
+        'description': 'Science fiction',
+        'films': [{'id': str(uuid.uuid4()), 'title': f'Film {i}'} for i in range(200)],
+    }
+
+
+def make_person() -> dict:
+    return {
+        'id': uuid.uuid4(),
+        'name': 'Mark Hamill',
+        'films': [
+            {'id': str(uuid.uuid4()), 'roles': ['actor', 'writer'], 'imdb_rating': 7.5} for _ in range(40)
+        ],
+    }
+
+
+def benchmark(serializer: DocumentSerializer, rows: list, model) -> float:
+    started = perf_counter()
+    for row in rows:
+        serializer.serialize(row, model)
+    return len(rows) / (perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--docs', type=int, default=20000)
+    parser.add_argument('--sample-rate', type=float, default=0.01)
+    args = parser.parse_args()
+
+    print(f'{"model":<8} {"mode":<16} {"docs/sec":>12} {"speedup":>8}')
+    for model, make_row in ((Movie, make_movie), (Genre, make_genre), (Person, make_person)):
+        rows = [make_row() for _ in range(args.docs)]
+        raw_rows = [{'id': row['id'], 'source': orjson.dumps(row).decode()} for row in rows]
+
+        baseline = None
+        for mode in SERIALIZATION_MODES:
+            serializer = DocumentSerializer(logger=logger, mode=mode, validation_sample_rate=args.sample_rate)
+            docs_per_sec = benchmark(serializer, raw_rows if mode == 'raw' else rows, model)
+            baseline = baseline or docs_per_sec
+            label = f'{mode} (sink only)' if mode == 'raw' else mode
+            print(f'{model.__name__:<8} {label:<16} {docs_per_sec:>12.0f} {docs_per_sec / baseline:>7.1f}x')
+    print('raw (sink only): JSON is built by PostgreSQL (document_sql), which is not timed here')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from logging import Logger
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import psycopg
+
+from lanes import LATENCY_LANE, THROUGHPUT_LANE, Lane
+from state.checkpoints import Checkpoints
+from state.models import State
+
+STATE_DATETIME_FORMAT = '%d-%m-%y %H:%M:%S'
+# Больше срезов не создаётся, даже если отставание больше threshold * MAX_SLICES строк: срезы становятся крупнее.
+MAX_SLICES = 64
+# Граница среза хранится в last_update с точностью до секунды, поэтому срезы короче не делятся.
+MIN_SLICE = timedelta(seconds=2)
+
+ESTIMATE_SQL = 'EXPLAIN (FORMAT JSON) SELECT 1 FROM content.{table_name} WHERE modified >= %s AND modified < %s;'
+
+Window = Tuple[datetime, datetime]
+
+
+def format_state_datetime(value: datetime) -> str:
+    return value.strftime(STATE_DATETIME_FORMAT)
+
+
+def parse_state_datetime(value: str) -> datetime:
+    return datetime.strptime(value, STATE_DATETIME_FORMAT)
+
+
+class CatchUpScheduler:
+    """
+    Обрабатывает большое отставание ETL параллельными срезами окна [last_update, now).
+
+    Отставание оценивается планировщиком PostgreSQL (EXPLAIN) как число строк таблиц-источников, изменившихся
+    в окне. Оценка запрашивается, только если last_update старше min_lag секунд: в обычной работе каждый цикл
+    сдвигает last_update, и в простое PostgreSQL не получает лишних запросов. Пока оценка не больше threshold,
+    цикл идёт обычным порядком. Иначе окно делится пополам, пока оценка
+    среза больше slice_rows, соседние мелкие срезы склеиваются, и срезы обрабатываются workers потоками.
+
+    У каждого среза своё состояние - last_update и контрольные точки, как у обычного цикла, - поэтому срезы
+    фиксируют прогресс независимо. План (границы срезов) хранится в основном состоянии, и после падения
+    обработка продолжается с тех же срезов. Когда обработаны все срезы, last_update основного состояния
+    сдвигается на конец плана, и следующий цикл снова оценивает отставание.
+
+    Срезы - очередь THROUGHPUT_LANE с крупными пачками. Изменения после конца плана (свежие правки в админке)
+    тем временем каждые poll_interval секунд обрабатываются отдельным потоком в очереди LATENCY_LANE мелкими
+    пачками со своим состоянием, и пока она занята, срезы ждут перед следующей пачкой. Поэтому правка попадает
+    в индекс через секунды, а не после всего догона.
+    """
+
+    PLAN_KEY = 'catch_up'
+
+    def __init__(
+        self,
+        tables: Iterable[str],
+        logger: Logger,
+        threshold: int = 100_000,
+        slice_rows: int = 50_000,
+        workers: int = 4,
+        poll_interval: float = 1.0,
+        min_lag: float = 300.0
+    ):
+        self.tables = sorted(set(tables))
+        self.threshold = threshold
+        self.slice_rows = slice_rows
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.min_lag = min_lag
+        self._logger = logger
+
+    def estimate(self, conn: psycopg.Connection, start: datetime, end: datetime) -> int:
+        """Оценка числа строк таблиц-источников с modified в окне [start, end). Соединение с dict_row."""
+        rows = 0
+        for table_name in self.tables:
+            plan = conn.execute(ESTIMATE_SQL.format(table_name=table_name), (start, end)).fetchone()['QUERY PLAN']
+            rows += plan[0]['Plan']['Plan Rows']
+        return rows
+
+    def _split(self, conn: psycopg.Connection, start: datetime, end: datetime, rows: int, slice_rows: int) -> list:
+        if rows <= slice_rows or end - start < MIN_SLICE:
+            return [(start, end, rows)]
+        middle = (start + (end - start) / 2).replace(microsecond=0)
+        return (
+            self._split(conn, start, middle, self.estimate(conn, start, middle), slice_rows)
+            + self._split(conn, middle, end, self.estimate(conn, middle, end), slice_rows)
+        )
+
+    def plan(self, conn: psycopg.Connection, start: datetime, end: datetime) -> Optional[List[Window]]:
+        """Возвращает срезы окна [start, end) или None, если отставание не больше threshold."""
+        rows = self.estimate(conn, start, end)
+        if rows <= self.threshold:
+            return None
+        slice_rows = max(self.slice_rows, rows // MAX_SLICES + 1)
+
+        windows, window_rows = [], 0
+        for slice_start, slice_end, rows_in_slice in self._split(conn, start, end, rows, slice_rows):
+            if windows and window_rows + rows_in_slice <= slice_rows:
+                windows[-1] = (windows[-1][0], slice_end)
+                window_rows += rows_in_slice
+            else:
+                windows.append((slice_start, slice_end))
+                window_rows = rows_in_slice
+        self._logger.info(
+            f'Backlog of about {rows} changed rows since {start} exceeds {self.threshold}, '
+            f'catching up in {len(windows)} slices with {self.workers} workers'
+        )
+        return windows
+
+    def run(
+        self,
+        conn: psycopg.Connection,
+        state: State,
+        latency_state: State,
+        slice_state: Callable[[int], State],
+        update_slice: Callable[[State, datetime, Lane], int]
+    ) -> Optional[int]:
+        """
+        Обрабатывает срезы сохранённого плана или нового плана, если отставание велико.
+
+        slice_state возвращает состояние среза по номеру, update_slice обрабатывает изменения от last_update
+        переданного состояния до переданного конца окна в очереди lane (так же, как обычный цикл). Очередь
+        передаётся именованным аргументом lane, остальные параметры update_slice можно связать через partial. Возвращает
+        число обработанных изменений или None, если догонять нечего и нужен обычный цикл.
+        """
+        windows = [
+            (parse_state_datetime(slice_start), parse_state_datetime(slice_end))
+            for slice_start, slice_end in state.get_state(self.PLAN_KEY) or []
+        ]
+        if not windows:
+            last_update_row = state.get_state('last_update') or format_state_datetime(datetime.min)
+            start = parse_state_datetime(last_update_row)
+            end = datetime.now().replace(microsecond=0)
+            if (end - start).total_seconds() < self.min_lag:
+                return None
+            windows = self.plan(conn, start, end)
+            if windows is None:
+                return None
+            # Состояния готовятся до сохранения плана: если упасть раньше, план просто построится заново.
+            for number, (slice_start, _) in enumerate(windows):
+                current = slice_state(number)
+                current.set_state(Checkpoints.STATE_KEY, {})
+                current.set_state('last_update', format_state_datetime(slice_start))
+            latency_state.set_state(Checkpoints.STATE_KEY, {})
+            latency_state.set_state('last_update', format_state_datetime(windows[-1][1]))
+            state.set_state(self.PLAN_KEY, [
+                (format_state_datetime(slice_start), format_state_datetime(slice_end))
+                for slice_start, slice_end in windows
+            ])
+        if latency_state.get_state('last_update') is None:
+            latency_state.set_state('last_update', format_state_datetime(windows[-1][1]))
+
+        processed = 0
+        lock = threading.Lock()
+        stop = threading.Event()
+        unfinished = {
+            number: slice_start
+            for number, (slice_start, slice_end) in enumerate(windows)
+            if slice_state(number).get_state('last_update') != format_state_datetime(slice_end)
+        }
+        THROUGHPUT_LANE.mark_behind(min(unfinished.values(), default=None))
+
+        def process(number: int, slice_end: datetime) -> None:
+            nonlocal processed
+            slice_processed = update_slice(slice_state(number), slice_end, lane=THROUGHPUT_LANE)
+            with lock:
+                processed += slice_processed
+                del unfinished[number]
+                THROUGHPUT_LANE.mark_behind(min(unfinished.values(), default=None))
+            self._logger.info(
+                f'Catch-up slice {number + 1}/{len(windows)} up to {slice_end} done, {slice_processed} changes, '
+                f'throughput lane lag {THROUGHPUT_LANE.lag():.0f}s'
+            )
+
+        def drain_latency() -> None:
+            nonlocal processed
+            while not stop.is_set():
+                started = datetime.now().replace(microsecond=0)
+                LATENCY_LANE.mark_behind(parse_state_datetime(latency_state.get_state('last_update')))
+                LATENCY_LANE.start()
+                try:
+                    lane_processed = update_slice(latency_state, started, lane=LATENCY_LANE)
+                finally:
+                    LATENCY_LANE.finish()
+                LATENCY_LANE.mark_behind(started)
+                if lane_processed:
+                    with lock:
+                        processed += lane_processed
+                    self._logger.info(
+                        f'Latency lane: {lane_processed} fresh changes up to {started} processed ahead of catch-up'
+                    )
+                stop.wait(self.poll_interval)
+
+        with ThreadPoolExecutor(max_workers=self.workers + 1, thread_name_prefix='catch-up') as executor:
+            latency = executor.submit(drain_latency)
+            pending = {latency} | {
+                executor.submit(process, number, windows[number][1])
+                for number in sorted(unfinished)
+            }
+            try:
+                while pending != {latency}:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+            finally:
+                stop.set()
+            latency.result()
+        THROUGHPUT_LANE.mark_behind(None)
+        LATENCY_LANE.mark_behind(None)
+
+        # Основное состояние сдвигается одной записью на каждый ключ: при падении между ними план пройдётся
+        # ещё раз, но все его срезы уже отмечены как обработанные. Изменения после конца плана уже обработаны
+        # очередью LATENCY_LANE, поэтому обычный цикл продолжит с её last_update.
+        state.set_state(Checkpoints.STATE_KEY, {})
+        state.set_state('last_update', latency_state.get_state('last_update'))
+        state.set_state(self.PLAN_KEY, None)
+        self._logger.info(f'Catch-up completed up to {windows[-1][1]}, {processed} changes processed')
+        return processed
@@ -0,0 +1,57 @@
+from collections import defaultdict
+from typing import Dict, List, Set, Tuple
+
+from psycopg import Connection, ServerCursor
+
+ChangedIds = Dict[str, Set]
+
+
+def read_changes(cursor: ServerCursor, limit: int) -> list:
+    cursor.execute(
+        '''
+        SELECT id, entity, entity_id, op
+        FROM content.change_log
+        ORDER BY id
+        LIMIT %s;
+        ''',
+        (limit,)
+    )
+    return cursor.fetchall()
+
+
+def acknowledge_changes(conn: Connection, changes: list) -> None:
+    """
+    Удаляет обработанные записи из content.change_log.
+
+    Удаляются ровно прочитанные идентификаторы, а не всё до максимального id: записи транзакций, которые
+    зафиксировались позже с меньшим id, останутся в журнале и попадут в следующую пачку.
+    """
+    conn.execute(
+        'DELETE FROM content.change_log WHERE id = ANY(%s);',
+        ([change['id'] for change in changes],)
+    )
+    conn.commit()
+
+
+def split_changes(changes: list) -> Tuple[ChangedIds, ChangedIds]:
+    """
+    Раскладывает пачку изменений на обновлённые и удалённые идентификаторы по сущностям.
+
+    Для каждой пары (entity, entity_id) учитывается только последняя операция в пачке.
+    """
+    last_ops = {}
+    for change in changes:
+        last_ops[(change['entity'], change['entity_id'])] = change['op']
+
+    upserted: ChangedIds = defaultdict(set)
+    deleted: ChangedIds = defaultdict(set)
+    for (entity, entity_id), op in last_ops.items():
+        if op == 'D':
+            deleted[entity].add(entity_id)
+        else:
+            upserted[entity].add(entity_id)
+    return upserted, deleted
+
+
+def chunked(items: list, size: int) -> List[list]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
@@ -0,0 +1,297 @@
+"""
+Сверяет документы, которые строят SQL трансформации, с прежними запросами и сравнивает их планы.
+
+В транзакции, которая в конце откатывается, в схему content добавляется фикстура: фильмы с большим составом
+и несколькими жанрами, а также крайние случаи - фильм без жанров и персон, жанр без фильмов, персона без фильмов,
+персона с несколькими ролями в одном фильме, однофамильцы в одном фильме. Для фикстуры (и, при --sample, для
+случайных существующих записей) документы прежних и текущих запросов сравниваются без учёта порядка элементов
+списков. Прежние запросы отдавали [{"id": null, ...}] для фильма без жанров и NULL вместо списка фильмов персоны,
+а жанры без фильмов теряли вовсе, такие расхождения ошибкой не считаются. Затем для обоих вариантов выполняется
+EXPLAIN (ANALYZE, BUFFERS) на пачке из --batch идентификаторов, как в работе ETL: печатаются стоимость плана, время
+выполнения, число прочитанных буферов и наибольшее число строк в узле плана.
+
+Запуск: python check_transform_queries.py [--films 2000] [--cast 50] [--genres 5] [--sample 0] [--batch 100]
+[--output FILE]
+"""
+import argparse
+import json
+import random
+import sys
+import uuid
+from datetime import datetime, timezone
+
+import psycopg
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row
+
+from queries import (
+    FILMWORKS_DETAILS_SQL, GENRES_DETAILS_SQL, PERSONS_DETAILS_SQL,
+    FILMWORKS_LIST_FIELDS, GENRES_LIST_FIELDS, PERSONS_LIST_FIELDS)
+from settings import postgres_settings, etl_settings
+
+LEGACY_FILMWORKS_DETAILS_SQL = '''
+    SELECT
+        fw.id,
+        fw.title,
+        fw.description,
+        fw.rating AS imdb_rating,
+        JSON_AGG(DISTINCT jsonb_build_object('id', g.id, 'name', g.name)) AS genres,
+        JSON_AGG(DISTINCT jsonb_build_object('id', p.id, 'name', p.full_name))
+            FILTER (WHERE pfw.role = 'director') AS directors,
+        JSON_AGG(DISTINCT jsonb_build_object('id', p.id, 'name', p.full_name))
+            FILTER (WHERE pfw.role = 'actor') AS actors,
+        JSON_AGG(DISTINCT jsonb_build_object('id', p.id, 'name', p.full_name))
+            FILTER (WHERE pfw.role = 'writer') AS writers,
+        ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'director') AS directors_names,
+        ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'actor') AS actors_names,
+        ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'writer') AS writers_names,
+        fw.creation_date
+    FROM content.film_work fw
+    LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+    LEFT JOIN content.person p ON p.id = pfw.person_id
+    LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+    LEFT JOIN content.genre g ON g.id = gfw.genre_id
+    WHERE fw.id = ANY(%s)
+    GROUP BY fw.id;
+'''
+
+LEGACY_GENRES_DETAILS_SQL = '''
+    SELECT
+        g.id,
+        g.name,
+        g.description,
+        JSON_AGG(DISTINCT jsonb_build_object('id', fw.id, 'title', fw.title)) AS films
+    FROM content.film_work fw
+    LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+    LEFT JOIN content.genre g ON g.id = gfw.genre_id
+    WHERE g.id = ANY(%s)
+    GROUP BY g.id;
+'''
+
+LEGACY_PERSONS_DETAILS_SQL = '''
+    WITH Roles AS (
+        SELECT
+            pfw.person_id,
+            fw.id AS film_id,
+            fw.rating as imdb_rating,
+            array_agg(pfw.role) AS roles
+        FROM
+            content.person_film_work AS pfw
+        JOIN
+            content.film_work AS fw ON pfw.film_work_id = fw.id
+        GROUP BY
+            pfw.person_id, fw.id
+    )
+    SELECT
+        p.id,
+        p.full_name AS name,
+        JSON_AGG(
+            JSON_BUILD_OBJECT(
+                'id', r.film_id,
+                'roles', r.roles,
+                'imdb_rating', r.imdb_rating
+            )
+        ) FILTER (WHERE r.film_id IS NOT NULL) AS films
+    FROM
+        content.person AS p
+    LEFT JOIN Roles r ON r.person_id = p.id
+    WHERE
+        p.id = ANY(%s)
+    GROUP BY
+        p.id;
+'''
+
+QUERIES = (
+    ('movies', 'film_work', LEGACY_FILMWORKS_DETAILS_SQL, FILMWORKS_DETAILS_SQL, FILMWORKS_LIST_FIELDS),
+    ('genres', 'genre', LEGACY_GENRES_DETAILS_SQL, GENRES_DETAILS_SQL, GENRES_LIST_FIELDS),
+    ('persons', 'person', LEGACY_PERSONS_DETAILS_SQL, PERSONS_DETAILS_SQL, PERSONS_LIST_FIELDS),
+)
+
+ROLES = ('director', 'actor', 'writer')
+
+
+def create_fixture(conn: psycopg.Connection, films: int, cast: int, genres: int) -> dict:
+    """Добавляет фикстуру в текущую транзакцию и возвращает идентификаторы её записей по таблицам."""
+    now = datetime.now(timezone.utc)
+    random.seed(0)
+    genre_ids = [uuid.uuid4() for _ in range(max(genres * 4, 1))]
+    person_ids = [uuid.uuid4() for _ in range(max(cast * 10, 2))]
+    film_ids = [uuid.uuid4() for _ in range(films)]
+    empty_film_id, empty_genre_id, empty_person_id = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+
+    genre_links, person_links = [], []
+    for film_id in film_ids:
+        for genre_id in random.sample(genre_ids, min(genres, len(genre_ids))):
+            genre_links.append((uuid.uuid4(), genre_id, film_id, now))
+        for person_id in random.sample(person_ids, min(cast, len(person_ids))):
+            person_links.append((uuid.uuid4(), person_id, film_id, random.choice(ROLES), now))
+    if film_ids:
+        # Персона с несколькими ролями в одном фильме и однофамильцы в одном фильме.
+        person_links.append((uuid.uuid4(), person_ids[0], film_ids[0], 'director', now))
+        person_links.append((uuid.uuid4(), person_ids[0], film_ids[0], 'writer', now))
+        person_links.append((uuid.uuid4(), person_ids[1], film_ids[0], 'actor', now))
+        person_links = list({(link[1], link[2], link[3]): link for link in person_links}.values())
+
+    with conn.cursor() as cur:
+        cur.executemany(
+            'INSERT INTO content.genre (id, name, description, created, modified) VALUES (%s, %s, %s, %s, %s);',
+            [
+                (genre_id, f'Fixture genre {i}', None, now, now)
+                for i, genre_id in enumerate([*genre_ids, empty_genre_id])
+            ]
+        )
+        cur.executemany(
+            'INSERT INTO content.person (id, full_name, created, modified) VALUES (%s, %s, %s, %s);',
+            [
+                (person_id, 'Fixture namesake' if i < 2 else f'Fixture person {i}', now, now)
+                for i, person_id in enumerate([*person_ids, empty_person_id])
+            ]
+        )
+        cur.executemany(
+            '''
+            INSERT INTO content.film_work (id, title, description, creation_date, rating, type, created, modified)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
+            ''',
+            [
+                (film_id, f'Fixture film {i}', None, now.date(), round(random.uniform(1, 10), 1), 'movie', now, now)
+                for i, film_id in enumerate([*film_ids, empty_film_id])
+            ]
+        )
+        cur.executemany(
+            'INSERT INTO content.genre_film_work (id, genre_id, film_work_id, created) VALUES (%s, %s, %s, %s);',
+            genre_links
+        )
+        cur.executemany(
+            '''
+            INSERT INTO content.person_film_work (id, person_id, film_work_id, role, created)
+            VALUES (%s, %s, %s, %s, %s);
+            ''',
+            person_links
+        )
+        cur.execute('ANALYZE content.film_work, content.genre, content.person, content.genre_film_work, '
+                    'content.person_film_work;')
+
+    return {
+        'film_work': [*film_ids, empty_film_id],
+        'genre': [*genre_ids, empty_genre_id],
+        'person': [*person_ids, empty_person_id],
+    }
+
+
+def sample_ids(conn: psycopg.Connection, table_name: str, exclude: list, size: int) -> list:
+    rows = conn.execute(
+        f'SELECT id FROM content.{table_name} WHERE NOT id = ANY(%s) ORDER BY random() LIMIT %s;',
+        (exclude, size)
+    ).fetchall()
+    return [row['id'] for row in rows]
+
+
+def sort_lists(value):
+    if isinstance(value, dict):
+        return {key: sort_lists(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return sorted((sort_lists(item) for item in value), key=lambda item: json.dumps(item, sort_keys=True))
+    return value
+
+
+def normalize(row: dict, list_fields: tuple) -> dict:
+    document = dict(row)
+    for field in list_fields:
+        # Прежние запросы отдавали NULL вместо пустого списка и [{"id": null, ...}] для пустых связей.
+        document[field] = [
+            item for item in document.get(field) or []
+            if not (isinstance(item, dict) and all(value is None for value in item.values()))
+        ]
+    return sort_lists(document)
+
+
+def compare(legacy_rows: list, rows: list, list_fields: tuple) -> list:
+    legacy = {row['id']: normalize(row, list_fields) for row in legacy_rows}
+    current = {row['id']: normalize(row, list_fields) for row in rows}
+    problems = []
+    for item_id, document in current.items():
+        if item_id not in legacy:
+            # Прежний запрос жанров терял жанры без фильмов.
+            if any(document[field] for field in list_fields):
+                problems.append(f'{item_id}: missing in legacy output')
+        elif legacy[item_id] != document:
+            problems.append(f'{item_id}: {legacy[item_id]} != {document}')
+    for item_id in legacy.keys() - current.keys():
+        problems.append(f'{item_id}: missing in current output')
+    return problems
+
+
+def walk_plan(plan: dict):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from walk_plan(child)
+
+
+def explain(conn: psycopg.Connection, sql: str, ids: list, repeat: int) -> dict:
+    """Возвращает показатели лучшего по времени из repeat прогонов EXPLAIN (ANALYZE, BUFFERS)."""
+    best = None
+    for _ in range(repeat):
+        result = conn.execute(f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql.strip()}', (ids,)).fetchone()
+        explained = result['QUERY PLAN'][0]
+        plan = explained['Plan']
+        stats = {
+            'total_cost': plan['Total Cost'],
+            'execution_ms': explained['Execution Time'],
+            'planning_ms': explained['Planning Time'],
+            'shared_blocks': plan.get('Shared Hit Blocks', 0) + plan.get('Shared Read Blocks', 0),
+            'peak_rows': max(node['Actual Rows'] * node['Actual Loops'] for node in walk_plan(plan)),
+        }
+        if best is None or stats['execution_ms'] < best['execution_ms']:
+            best = stats
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--films', type=int, default=2000, help='fixture films')
+    parser.add_argument('--cast', type=int, default=50, help='persons per fixture film')
+    parser.add_argument('--genres', type=int, default=5, help='genres per fixture film')
+    parser.add_argument('--sample', type=int, default=0, help='existing records per index to compare as well')
+    parser.add_argument('--batch', type=int, default=etl_settings.transform_batch_size, help='ids per EXPLAIN run')
+    parser.add_argument('--repeat', type=int, default=3, help='EXPLAIN ANALYZE runs per query, the best one is kept')
+    parser.add_argument('--output', help='write the report to this JSON file')
+    args = parser.parse_args()
+
+    report, failed = {}, False
+    with psycopg.connect(make_conninfo(**postgres_settings.dict()), row_factory=dict_row) as conn:
+        try:
+            fixture = create_fixture(conn, films=args.films, cast=args.cast, genres=args.genres)
+            print(f'{"index":<8} {"query":<8} {"cost":>10} {"exec ms":>9} {"buffers":>8} {"peak rows":>10}')
+            for index, table_name, legacy_sql, sql, list_fields in QUERIES:
+                ids = fixture[table_name]
+                if args.sample:
+                    ids = ids + sample_ids(conn, table_name, exclude=ids, size=args.sample)
+
+                legacy_rows = conn.execute(legacy_sql, (ids,)).fetchall()
+                rows = conn.execute(sql, (ids,)).fetchall()
+                problems = compare(legacy_rows, rows, list_fields)
+                report[index] = {'documents': len(rows), 'mismatches': problems}
+
+                for name, query in (('legacy', legacy_sql), ('current', sql)):
+                    stats = explain(conn, query, ids[:args.batch], args.repeat)
+                    report[index][name] = stats
+                    print(
+                        f'{index:<8} {name:<8} {stats["total_cost"]:>10.0f} '
+                        f'{stats["execution_ms"]:>9.1f} {stats["shared_blocks"]:>8} {stats["peak_rows"]:>10}'
+                    )
+                print(f'  {index}: {len(rows)} documents compared, {len(problems)} mismatches')
+                for problem in problems:
+                    print(f'  {index} mismatch: {problem}')
+                failed = failed or bool(problems)
+        finally:
+            conn.rollback()
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    print('Documents differ' if failed else 'Documents match')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional, Union
+
+import psycopg
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
+
+from logger import logger
+from settings import postgres_settings, etl_settings
+
+# Обрыв соединения, таймаут соединения или пула: PoolTimeout и ошибки класса 08 - подклассы OperationalError.
+RECONNECT_EXCEPTIONS = (psycopg.OperationalError,)
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def required_pool_size() -> int:
+    """
+    Наибольшее число соединений, которые ETL одновременно берёт из пула.
+
+    Цикл держит соединение серверного курсора, в режиме догона ещё по одному держат каждый поток срезов и очередь
+    LATENCY_LANE. С ETL_PIPELINE каждый из них добавляет по соединению на поток трансформации. Ещё одно
+    соединение нужно для коротких записей состояния и хэшей.
+    """
+    fetchers = 1
+    if etl_settings.catch_up_threshold and etl_settings.change_source != 'change_log' and etl_settings.shard_count <= 1:
+        fetchers += etl_settings.catch_up_workers + 1
+    per_fetcher = 1 + (etl_settings.transform_workers if etl_settings.pipeline_enabled else 0)
+    return fetchers * per_fetcher + 1
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Общий пул соединений с PostgreSQL, открывается при первом обращении.
+
+    Перед выдачей соединение проверяется запросом, поэтому оборванное за время простоя соединение заменяется
+    новым, а не ломает следующую пачку. Соединения выдаются с dict_row, транзакция фиксируется при возврате.
+    Пул не меньше required_pool_size, иначе потоки догона и конвейера ждали бы друг друга до PoolTimeout.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            max_size = max(etl_settings.pool_max_size, required_pool_size())
+            if max_size > etl_settings.pool_max_size:
+                logger.warning(
+                    f'ETL_POOL_MAX_SIZE={etl_settings.pool_max_size} is below the {max_size} connections '
+                    f'the configured workers hold at once, using {max_size}'
+                )
+            _pool = ConnectionPool(
+                conninfo=make_conninfo(**postgres_settings.dict()),
+                kwargs={'row_factory': dict_row},
+                min_size=min(etl_settings.pool_min_size, max_size),
+                max_size=max_size,
+                max_idle=etl_settings.pool_max_idle,
+                timeout=etl_settings.pool_timeout,
+                check=ConnectionPool.check_connection,
+                name='etl',
+                open=True
+            )
+        return _pool
+
+
+def close_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+@contextmanager
+def connection(source: Union[psycopg.Connection, ConnectionPool]) -> Iterator[psycopg.Connection]:
+    """Соединение source как есть или соединение из пула source на время блока (с фиксацией в конце)."""
+    if isinstance(source, ConnectionPool):
+        with source.connection() as conn:
+            yield conn
+    else:
+        yield source
@@ -1,26 +1,68 @@
+import asyncio
 import time
 from functools import wraps
 import random
 from logger import logger
+from metrics import BACKOFF_SLEEP_SECONDS
 
 
-def backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10, exceptions=(Exception,)):
+def backoff(
+        start_sleep_time=0.1, factor=2, border_sleep_time=10, exceptions=(Exception,), reraise=False, max_retries=None
+):
+    # С reraise=True остальные ошибки пробрасываются вызывающему, а не пишутся в лог с возвратом None.
+    # С max_retries ошибка из exceptions после стольких повторов подряд тоже пробрасывается вызывающему.
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
             sleep_time = start_sleep_time
+            retries = 0
 
             while True:
                 try:
                     return func(*args, **kwargs)
                 except exceptions as e:
+                    if max_retries is not None and retries >= max_retries:
+                        raise
+                    retries += 1
                     sleep_time = min(
                         (sleep_time * (1 + random.uniform(-0.5, 0.5))) * factor,
                         border_sleep_time
                     )
                     logger.warning(f"Failed to execute function [{func}]. Sleep {sleep_time}s. Error: {str(e)}")
+                    BACKOFF_SLEEP_SECONDS.labels(function=func.__name__).inc(sleep_time)
                     time.sleep(sleep_time)
                 except Exception as e:
+                    if reraise:
+                        raise
+                    logger.error(f'Failed to execute function [{func}]. Error: {str(e)}')
+                    break
+
+        return wrapper
+
+    return decorator
+
+
+def async_backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10, exceptions=(Exception,), reraise=False):
+    # reraise - как у backoff: остальные ошибки пробрасываются вызывающему.
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            sleep_time = start_sleep_time
+
+            while True:
+                try:
+                    return await func(*args, **kwargs)
+                except exceptions as e:
+                    sleep_time = min(
+                        (sleep_time * (1 + random.uniform(-0.5, 0.5))) * factor,
+                        border_sleep_time
+                    )
+                    logger.warning(f"Failed to execute function [{func}]. Sleep {sleep_time}s. Error: {str(e)}")
+                    BACKOFF_SLEEP_SECONDS.labels(function=func.__name__).inc(sleep_time)
+                    await asyncio.sleep(sleep_time)
+                except Exception as e:
+                    if reraise:
+                        raise
                     logger.error(f'Failed to execute function [{func}]. Error: {str(e)}')
                     break
 
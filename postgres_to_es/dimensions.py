@@ -0,0 +1,136 @@
+import threading
+import uuid
+from collections import OrderedDict
+from itertools import islice
+from time import monotonic
+from typing import Dict, Iterable, Iterator, Tuple
+
+from psycopg import Cursor
+
+from settings import etl_settings
+
+ROLES = ('director', 'actor', 'writer')
+
+
+class DimensionCache:
+    """
+    Кэш id -> значение колонки небольшой редко меняющейся таблицы (названия жанров, имена персон).
+
+    Хранит не больше max_size записей, вытесняя давно не использованные, и не дольше ttl секунд. Промахи
+    загружаются одним запросом. Изменившиеся строки сбрасываются через invalidate из того же потока изменений,
+    по которому обновляются индексы, а ttl ограничивает устаревание, если изменение прошло мимо ETL.
+    """
+
+    def __init__(self, table: str, column: str, max_size: int, ttl: float):
+        self.table = table
+        self.column = column
+        self.max_size = max_size
+        self.ttl = ttl
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get_many(self, cursor: Cursor, ids: Iterable[uuid.UUID]) -> Dict[uuid.UUID, str]:
+        found, missing = {}, []
+        now = monotonic()
+        with self._lock:
+            for item_id in set(ids):
+                cached = self._values.get(item_id)
+                if cached is not None and cached[1] > now:
+                    self._values.move_to_end(item_id)
+                    found[item_id] = cached[0]
+                else:
+                    missing.append(item_id)
+            self._hits += len(found)
+            self._misses += len(missing)
+
+        if missing:
+            cursor.execute(
+                f'SELECT id, {self.column} AS value FROM content.{self.table} WHERE id = ANY(%s);',
+                (missing,)
+            )
+            loaded = {row['id']: row['value'] for row in cursor.fetchall()}
+            found.update(loaded)
+            expires = monotonic() + self.ttl
+            with self._lock:
+                for item_id, value in loaded.items():
+                    self._values[item_id] = (value, expires)
+                    self._values.move_to_end(item_id)
+                while len(self._values) > self.max_size:
+                    self._values.popitem(last=False)
+        return found
+
+    def invalidate(self, ids: Iterable[uuid.UUID]) -> None:
+        with self._lock:
+            for item_id in ids:
+                self._values.pop(item_id, None)
+
+    def take_stats(self) -> Tuple[int, int]:
+        with self._lock:
+            stats = self._hits, self._misses
+            self._hits = self._misses = 0
+        return stats
+
+
+# Ключ - таблица, изменения которой сбрасывают записи кэша.
+DIMENSIONS: Dict[str, DimensionCache] = {
+    'genre': DimensionCache(
+        table='genre',
+        column='name',
+        max_size=etl_settings.dimension_cache_size,
+        ttl=etl_settings.dimension_cache_ttl
+    ),
+    'person': DimensionCache(
+        table='person',
+        column='full_name',
+        max_size=etl_settings.dimension_cache_size,
+        ttl=etl_settings.dimension_cache_ttl
+    ),
+}
+
+
+def invalidate_dimensions(table_name: str, ids: Iterable[uuid.UUID]) -> None:
+    cache = DIMENSIONS.get(table_name)
+    if cache is not None:
+        cache.invalidate(ids)
+
+
+def fill_movie_names(cursor: Cursor, rows: Iterable[dict]) -> Iterator[dict]:
+    """
+    Собирает документы фильмов из строк FILMWORKS_LINKS_SQL, подставляя названия жанров и имена персон из кэша.
+
+    Строки читаются группами по etl_settings.cursor_itersize, промахи кэша загружаются через cursor одним
+    запросом на группу. Документы совпадают с результатом FILMWORKS_DETAILS_SQL: элементы списков упорядочены
+    по id, списки имён без повторов и отсортированы по кодовым точкам, как с COLLATE "C" в SQL. Связи с записями,
+    которых уже нет в таблице, пропускаются.
+    """
+    rows = iter(rows)
+    while group := list(islice(rows, etl_settings.cursor_itersize)):
+        genre_names = DIMENSIONS['genre'].get_many(
+            cursor, (item_id for row in group for item_id in row['genre_ids'] or ())
+        )
+        person_names = DIMENSIONS['person'].get_many(
+            cursor, (item_id for row in group for item_id in row['person_ids'] or ())
+        )
+
+        for row in group:
+            genres = [
+                {'id': str(genre_id), 'name': genre_names[genre_id]}
+                for genre_id in row['genre_ids'] or () if genre_id in genre_names
+            ]
+            persons = {role: [] for role in ROLES}
+            for person_id, role in zip(row['person_ids'] or (), row['roles'] or ()):
+                if person_id in person_names and role in persons:
+                    persons[role].append({'id': str(person_id), 'name': person_names[person_id]})
+
+            yield {
+                'id': row['id'],
+                'title': row['title'],
+                'description': row['description'],
+                'imdb_rating': row['imdb_rating'],
+                'genres': sorted(genres, key=lambda genre: genre['id']),
+                **{f'{role}s': sorted(persons[role], key=lambda person: person['id']) for role in ROLES},
+                **{f'{role}s_names': sorted({person['name'] for person in persons[role]}) for role in ROLES},
+                'creation_date': row['creation_date'],
+            }
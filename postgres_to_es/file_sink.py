@@ -0,0 +1,159 @@
+import fcntl
+import gzip
+import os
+import socket
+import threading
+from datetime import datetime
+from logging import Logger
+from typing import Dict, Iterable
+
+import orjson
+import zstandard
+from elasticsearch.helpers import expand_action
+
+from loader import BulkReport, Sink
+from metrics import record_report
+
+COMPRESSIONS = {'zstd': '.ndjson.zst', 'gzip': '.ndjson.gz', 'none': '.ndjson'}
+# Файл, в который ещё пишут. Писатель держит на нём flock, поэтому брошенный файл можно отличить от открытого.
+PART_SUFFIX = '.part'
+
+
+def bulk_lines(action: dict) -> bytes:
+    """Строки _bulk для действия: служебная строка и, кроме удаления, тело."""
+    header, body = expand_action(action)
+    lines = orjson.dumps(header) + b'\n'
+    if body is not None:
+        if isinstance(body, str):
+            body = body.encode()
+        elif not isinstance(body, bytes):
+            body = orjson.dumps(body)
+        lines += body + b'\n'
+    return lines
+
+
+def finalize_abandoned(directory: str, logger: Logger) -> None:
+    """Переименовывает незавершённые файлы упавших писателей, чтобы они попали в воспроизведение."""
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if not name.endswith(PART_SUFFIX):
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as part:
+                try:
+                    fcntl.flock(part.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                os.rename(path, path[:-len(PART_SUFFIX)])
+            logger.warning(f'Finalized abandoned file {path}, its last actions may be truncated')
+
+
+class _OpenFile:
+    def __init__(self, path: str, compression: str):
+        self.path = path
+        self.actions = 0
+        self.raw = open(path, 'xb')
+        fcntl.flock(self.raw.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if compression == 'zstd':
+            self.stream = zstandard.ZstdCompressor().stream_writer(self.raw, closefd=False)
+        elif compression == 'gzip':
+            self.stream = gzip.GzipFile(fileobj=self.raw, mode='wb', compresslevel=6)
+        else:
+            self.stream = self.raw
+
+    def write(self, data: bytes) -> None:
+        self.stream.write(data)
+
+    def flush(self) -> int:
+        """Сбрасывает сжатый блок в файл, чтобы записанное можно было прочитать после падения процесса."""
+        if isinstance(self.stream, zstandard.ZstdCompressionWriter):
+            self.stream.flush(zstandard.FLUSH_BLOCK)
+        else:
+            self.stream.flush()
+        self.raw.flush()
+        return self.raw.tell()
+
+    def finish(self) -> str:
+        if self.stream is not self.raw:
+            self.stream.close()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.raw.close()
+        path = self.path[:-len(PART_SUFFIX)]
+        os.rename(self.path, path)
+        return path
+
+
+class NdjsonFileSink(Sink):
+    """
+    Записывает bulk-действия в файлы NDJSON в формате запроса _bulk, сжатые zstd или gzip.
+
+    Действия каждого индекса пишутся в каталог directory/<индекс>. Пока файл открыт, у него суффикс .part;
+    когда размер на диске превышает max_file_bytes или получатель закрывается, поток сжатия завершается, и файл
+    переименовывается. После каждого load сжатый блок сбрасывается в файл, поэтому при падении процесса
+    теряется только незавершённая запись. Такие файлы остаются с суффиксом .part и переименовываются при
+    следующем запуске (finalize_abandoned). Загрузить файлы в Elasticsearch можно скриптом replay.py.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        logger: Logger,
+        compression: str = 'zstd',
+        max_file_bytes: int = 256 * 1024 * 1024
+    ):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f'Unknown compression {compression}, expected one of {tuple(COMPRESSIONS)}')
+        self.directory = directory
+        self.compression = compression
+        self.max_file_bytes = max_file_bytes
+        self._logger = logger
+        self._files: Dict[str, _OpenFile] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        finalize_abandoned(directory, logger)
+
+    def _index_lock(self, index: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(index, threading.Lock())
+
+    def _open(self, index: str) -> _OpenFile:
+        index_dir = os.path.join(self.directory, index)
+        os.makedirs(index_dir, exist_ok=True)
+        # Имена файлов одного писателя упорядочены по времени, порядок воспроизведения берётся из них.
+        name = (
+            f'{index}-{datetime.now():%Y%m%dT%H%M%S%f}-{socket.gethostname()}-{os.getpid()}'
+            f'{COMPRESSIONS[self.compression]}{PART_SUFFIX}'
+        )
+        return _OpenFile(os.path.join(index_dir, name), self.compression)
+
+    def _finish(self, index: str) -> None:
+        current = self._files.pop(index, None)
+        if current is not None:
+            path = current.finish()
+            self._logger.info(f'File {path} completed with {current.actions} actions')
+
+    def load(self, actions: Iterable[dict], index: str) -> BulkReport:
+        written = 0
+        with self._index_lock(index):
+            current = self._files.get(index)
+            for action in actions:
+                if current is None:
+                    current = self._files[index] = self._open(index)
+                current.write(bulk_lines(action))
+                written += 1
+            if current is not None:
+                current.actions += written
+                if current.flush() >= self.max_file_bytes:
+                    self._finish(index)
+        if written:
+            self._logger.info(f'Written {written} actions for index {index} to files')
+        report = BulkReport(success=written)
+        record_report(index, report)
+        return report
+
+    def close(self) -> None:
+        for index in list(self._files):
+            with self._index_lock(index):
+                self._finish(index)
@@ -0,0 +1,74 @@
+from logging import Logger
+from time import monotonic
+from typing import Iterator, Tuple
+
+import psycopg
+
+from loader import Sink
+from queries import full_scan_sql
+from registry import IndexSpec
+from serialization import DocumentSerializer
+
+COPY_SQL = 'COPY ({query}) TO STDOUT'
+
+
+class CopyStats:
+    def __init__(self):
+        self.documents = 0
+        self.bytes = 0
+        self.started = monotonic()
+
+    def __str__(self):
+        seconds = max(monotonic() - self.started, 1e-9)
+        megabytes = self.bytes / 2 ** 20
+        return (
+            f'{self.documents} documents, {megabytes:.1f} MiB in {seconds:.1f}s, '
+            f'{megabytes / seconds:.1f} MiB/s, {self.documents / seconds:.0f} docs/s'
+        )
+
+
+def copy_documents(conn: psycopg.Connection, index: IndexSpec, stats: CopyStats) -> Iterator[Tuple[str, bytes]]:
+    """
+    Выдаёт пары (id, тело документа) всех документов индекса из одного COPY ... TO STDOUT.
+
+    Тело документа собирает PostgreSQL (index.document_sql по всей корневой таблице), вывод COPY читается
+    блоками и режется на строки без разбора по колонкам. В текстовом формате COPY экранирует обратную косую черту
+    и управляющие символы, но в тексте jsonb управляющих символов нет, поэтому достаточно убрать удвоение
+    обратной косой черты.
+    """
+    query = full_scan_sql(index.document_sql, index.root_table)
+    with conn.cursor() as cursor, cursor.copy(COPY_SQL.format(query=query)) as copy:
+        tail = b''
+        for block in copy:
+            stats.bytes += len(block)
+            lines = (tail + bytes(block)).split(b'\n')
+            tail = lines.pop()
+            for line in lines:
+                document_id, source = line.split(b'\t', 1)
+                stats.documents += 1
+                yield document_id.decode(), source.replace(b'\\\\', b'\\')
+
+
+def copy_load(
+        conn: psycopg.Connection,
+        loader: Sink,
+        index: IndexSpec,
+        target: str,
+        logger: Logger,
+        validation_sample_rate: float = 0.01
+) -> int:
+    """Загружает все документы индекса в target потоком из COPY, пишет в лог скорость в МиБ/с и документах/с."""
+    # Тела документов уже собраны PostgreSQL, как в режиме raw: моделью проверяется только выборка.
+    serializer = DocumentSerializer(logger=logger, mode='raw', validation_sample_rate=validation_sample_rate)
+    stats = CopyStats()
+    actions = (
+        {
+            '_index': target,
+            '_id': document_id,
+            '_source': source
+        } for document_id, source in copy_documents(conn, index, stats)
+        if serializer.serialize({'id': document_id, 'source': source}, index.model) is not None
+    )
+    loader.load(actions, index=target)
+    logger.info(f'Copied {index.name} into {target}: {stats}')
+    return stats.documents
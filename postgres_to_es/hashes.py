@@ -0,0 +1,164 @@
+import abc
+import hashlib
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Tuple, Union
+
+import psycopg
+from psycopg.rows import tuple_row
+from psycopg_pool import ConnectionPool
+
+from connections import connection
+
+DIGEST_SIZE = 16
+
+
+class HashStore:
+    """Хэши последних загруженных _source по паре (индекс, id документа)."""
+
+    @abc.abstractmethod
+    def get(self, index: str, ids: List[str]) -> Dict[str, bytes]:
+        ...
+
+    @abc.abstractmethod
+    def put(self, index: str, hashes: Dict[str, bytes]) -> None:
+        ...
+
+    @abc.abstractmethod
+    def delete(self, index: str, ids: List[str]) -> None:
+        ...
+
+
+class SqliteHashStore(HashStore):
+    def __init__(self, db_path: str = 'hashes.db'):
+        self.db_path = db_path
+        # Хэши пишут потоки загрузки конвейера, доступ сериализуется блокировкой.
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL;')
+            self._conn.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS document_hash (
+                    index_name TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    hash BLOB NOT NULL,
+                    PRIMARY KEY (index_name, id)
+                ) WITHOUT ROWID;
+                '''
+            )
+
+    def get(self, index: str, ids: List[str]) -> Dict[str, bytes]:
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT id, hash FROM document_hash WHERE index_name = ? AND id IN ({", ".join("?" * len(ids))});',
+                (index, *ids)
+            ).fetchall()
+        return dict(rows)
+
+    def put(self, index: str, hashes: Dict[str, bytes]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO document_hash (index_name, id, hash) VALUES (?, ?, ?);',
+                [(index, item_id, digest) for item_id, digest in hashes.items()]
+            )
+
+    def delete(self, index: str, ids: List[str]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'DELETE FROM document_hash WHERE index_name = ? AND id = ?;',
+                [(index, item_id) for item_id in ids]
+            )
+
+
+class PostgresHashStore(HashStore):
+    """
+    Хэши в таблице content.etl_document_hash.
+
+    conn - соединение в режиме autocommit или пул, из которого каждая операция берёт своё соединение.
+    """
+
+    def __init__(self, conn: Union[psycopg.Connection, ConnectionPool]):
+        self.conn = conn
+        with connection(self.conn) as conn:
+            conn.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS content.etl_document_hash (
+                    index_name TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    hash bytea NOT NULL,
+                    PRIMARY KEY (index_name, id)
+                );
+                '''
+            )
+
+    def get(self, index: str, ids: List[str]) -> Dict[str, bytes]:
+        with connection(self.conn) as conn, conn.cursor(row_factory=tuple_row) as cur:
+            cur.execute(
+                'SELECT id, hash FROM content.etl_document_hash WHERE index_name = %s AND id = ANY(%s);',
+                (index, ids)
+            )
+            return dict(cur.fetchall())
+
+    def put(self, index: str, hashes: Dict[str, bytes]) -> None:
+        with connection(self.conn) as conn:
+            conn.execute(
+                '''
+                INSERT INTO content.etl_document_hash (index_name, id, hash)
+                SELECT %s, id, hash FROM unnest(%s::text[], %s::bytea[]) AS h(id, hash)
+                ON CONFLICT (index_name, id) DO UPDATE SET hash = EXCLUDED.hash;
+                ''',
+                (index, list(hashes), list(hashes.values()))
+            )
+
+    def delete(self, index: str, ids: List[str]) -> None:
+        with connection(self.conn) as conn:
+            conn.execute(
+                'DELETE FROM content.etl_document_hash WHERE index_name = %s AND id = ANY(%s);',
+                (index, ids)
+            )
+
+
+class DocumentHashes:
+    """
+    Отсеивает документы, _source которых не изменился с последней загрузки.
+
+    Для каждого загруженного документа хранится 16-байтовый хэш blake2b его _source. Документ с тем же хэшем
+    не отправляется в Elasticsearch, число таких документов копится до вызова take_suppressed.
+    """
+
+    def __init__(self, store: HashStore):
+        self.store = store
+        self._suppressed = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(source) -> bytes:
+        if isinstance(source, str):
+            source = source.encode()
+        return hashlib.blake2b(source, digest_size=DIGEST_SIZE).digest()
+
+    def filter_unchanged(self, index: str, actions: List[dict]) -> Tuple[List[dict], Dict[str, bytes]]:
+        """Возвращает изменившиеся действия индексации и хэши, которые нужно запомнить после их загрузки."""
+        hashes = {str(action['_id']): self.digest(action['_source']) for action in actions}
+        if not hashes:
+            return actions, hashes
+        known = self.store.get(index, list(hashes))
+        changed = [action for action in actions if known.get(str(action['_id'])) != hashes[str(action['_id'])]]
+        with self._lock:
+            self._suppressed += len(actions) - len(changed)
+        return changed, {str(action['_id']): hashes[str(action['_id'])] for action in changed}
+
+    def remember(self, index: str, hashes: Dict[str, bytes]) -> None:
+        if hashes:
+            self.store.put(index, hashes)
+
+    def forget(self, index: str, ids: Iterable) -> None:
+        ids = [str(item_id) for item_id in ids]
+        if ids:
+            self.store.delete(index, ids)
+
+    def take_suppressed(self) -> int:
+        with self._lock:
+            suppressed, self._suppressed = self._suppressed, 0
+        return suppressed
@@ -0,0 +1,64 @@
+import threading
+from datetime import datetime
+from typing import Iterable, Iterator, Optional
+
+from settings import etl_settings
+
+
+class Lane:
+    """
+    Очередь работы ETL со своими размерами пачек и своим отставанием.
+
+    Пачки очереди, которая уступает другой (yields_to), выдаются только когда та свободна: пока более
+    приоритетная очередь обрабатывает изменения, остальные ждут перед следующей пачкой.
+    """
+
+    def __init__(self, name: str, batch_size: int, transform_batch_size: int, yields_to: Optional['Lane'] = None):
+        self.name = name
+        self.batch_size = batch_size
+        self.transform_batch_size = transform_batch_size
+        self.yields_to = yields_to
+        self._idle = threading.Event()
+        self._idle.set()
+        self._behind = None
+        self._lock = threading.Lock()
+
+    def paced(self, batches: Iterable) -> Iterator:
+        for batch in batches:
+            if self.yields_to is not None:
+                self.yields_to.wait_idle()
+            yield batch
+
+    def wait_idle(self) -> None:
+        self._idle.wait()
+
+    def start(self) -> None:
+        self._idle.clear()
+
+    def finish(self) -> None:
+        self._idle.set()
+
+    def mark_behind(self, oldest_change: Optional[datetime]) -> None:
+        """Запоминает начало самого старого необработанного окна очереди, None - очередь догнала источник."""
+        with self._lock:
+            self._behind = oldest_change
+
+    def lag(self) -> float:
+        """Отставание очереди в секундах: сколько прошло с начала самого старого необработанного окна."""
+        with self._lock:
+            behind = self._behind
+        return max((datetime.now() - behind).total_seconds(), 0.0) if behind is not None else 0.0
+
+
+LATENCY_LANE = Lane(
+    name='latency',
+    batch_size=etl_settings.latency_batch_size,
+    transform_batch_size=etl_settings.latency_batch_size
+)
+THROUGHPUT_LANE = Lane(
+    name='throughput',
+    batch_size=etl_settings.batch_size,
+    transform_batch_size=etl_settings.transform_batch_size,
+    yields_to=LATENCY_LANE
+)
+LANES = (LATENCY_LANE, THROUGHPUT_LANE)
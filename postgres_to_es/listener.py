@@ -0,0 +1,80 @@
+import select
+from logging import Logger
+from time import monotonic
+from typing import Optional
+
+import psycopg
+from psycopg import Notify, sql
+
+
+class ChangeListener:
+    """
+    Ожидает уведомлений PostgreSQL (LISTEN) о сохранении моделей в админке.
+
+    Уведомления, пришедшие подряд с паузой меньше debounce, схлопываются в одно пробуждение, но ожидание
+    не растягивается дольше max_debounce, чтобы поток правок не откладывал индексацию бесконечно.
+
+    При обрыве соединения LISTEN ожидание сразу возвращает True (уведомления за это время потеряны), а следующее
+    ожидание подключается заново.
+    """
+
+    def __init__(
+        self,
+        dsn: str,
+        channel: str,
+        logger: Logger,
+        debounce: float = 0.2,
+        max_debounce: float = 1.0
+    ):
+        self.dsn = dsn
+        self.channel = channel
+        self.debounce = debounce
+        self.max_debounce = max_debounce
+        self._logger = logger
+        self._conn: Optional[psycopg.Connection] = None
+        self._notified = False
+
+    def __enter__(self):
+        self._connect()
+        return self
+
+    def _connect(self) -> None:
+        self._conn = psycopg.connect(self.dsn, autocommit=True)
+        self._conn.add_notify_handler(self._on_notify)
+        self._conn.execute(sql.SQL('LISTEN {};').format(sql.Identifier(self.channel)))
+        self._logger.info(f'Listening for changes on channel {self.channel}')
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._conn.close()
+
+    def _on_notify(self, notify: Notify) -> None:
+        self._notified = True
+
+    def _poll(self, timeout: float) -> bool:
+        readable, _, _ = select.select([self._conn], [], [], max(timeout, 0))
+        if readable:
+            # Любой запрос заставляет psycopg дочитать сокет и вызвать обработчик уведомлений.
+            self._conn.execute('SELECT 1;')
+        return self._notified
+
+    def wait(self, timeout: float) -> bool:
+        try:
+            return self._wait(timeout)
+        except psycopg.OperationalError as e:
+            self._logger.warning(f'LISTEN connection lost, reconnecting on next wait. Error: {str(e)}')
+            self._conn.close()
+            return True
+
+    def _wait(self, timeout: float) -> bool:
+        if self._conn.closed:
+            self._connect()
+        self._notified = False
+        if not self._poll(timeout):
+            return False
+
+        deadline = monotonic() + self.max_debounce
+        while monotonic() < deadline:
+            self._notified = False
+            if not self._poll(min(self.debounce, deadline - monotonic())):
+                break
+        return True
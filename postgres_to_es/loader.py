@@ -0,0 +1,214 @@
+import abc
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from logging import Logger
+from time import monotonic
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from elasticsearch import Elasticsearch, ConnectionError as EsConnectionError, ConnectionTimeout as EsConnectionTimeout
+from elasticsearch.helpers import streaming_bulk
+
+from hashes import DocumentHashes
+from metrics import BACKOFF_SLEEP_SECONDS, BULK_SECONDS, BULK_THROTTLED, record_report
+
+RETRYABLE_STATUSES = {429, 502, 503, 504}
+# Примерный размер служебной строки действия в формате _bulk.
+ACTION_OVERHEAD_BYTES = 100
+
+
+@dataclass
+class BulkReport:
+    success: int = 0
+    retried: int = 0
+    rejected: int = 0
+    suppressed: int = 0
+    rejected_ids: List = field(default_factory=list)
+
+
+class Sink(abc.ABC):
+    """
+    Получатель bulk-действий ETL.
+
+    Действия передаются в формате elasticsearch.helpers.bulk: метаданные с префиксом _ и тело документа
+    в _source. Получатель должен сохранить действия до возврата из load, после этого фиксируется контрольная точка.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @abc.abstractmethod
+    def load(self, actions: Iterable[dict], index: str) -> BulkReport:
+        ...
+
+    def close(self) -> None:
+        pass
+
+
+class BulkLoader(Sink):
+    """
+    Отправляет bulk-запросы в Elasticsearch и повторяет только неудавшиеся документы.
+
+    Документы с временными ошибками (429, 5xx шлюза, обрыв соединения или таймаут) отправляются повторно
+    с экспоненциальной паузой со случайным разбросом, пока не будут приняты. Документы, отклонённые по
+    другим причинам (например, не подходят под маппинг), не повторяются и попадают в лог с текстом ошибки.
+
+    Размер пачки в байтах подстраивается под кластер: уменьшается вдвое при перегрузке или задержке больше
+    target_latency и растёт в полтора раза, пока ответы приходят быстрее половины target_latency.
+
+    Если передан hashes, документы с неизменившимся _source не отправляются, а хэши принятых запоминаются.
+    """
+
+    def __init__(
+        self,
+        es_client: Elasticsearch,
+        logger: Logger,
+        min_chunk_bytes: int = 256 * 1024,
+        max_chunk_bytes: int = 10 * 1024 * 1024,
+        target_latency: float = 1.0,
+        start_sleep_time: float = 0.1,
+        factor: float = 2,
+        border_sleep_time: float = 10,
+        hashes: Optional[DocumentHashes] = None
+    ):
+        self.es_client = es_client
+        self.min_chunk_bytes = min_chunk_bytes
+        self.max_chunk_bytes = max_chunk_bytes
+        self.chunk_bytes = min(min_chunk_bytes * 4, max_chunk_bytes)
+        self.target_latency = target_latency
+        self.start_sleep_time = start_sleep_time
+        self.factor = factor
+        self.border_sleep_time = border_sleep_time
+        self.hashes = hashes
+        self._logger = logger
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _action_size(action: dict) -> int:
+        source = action.get('_source')
+        return ACTION_OVERHEAD_BYTES + (len(source) if isinstance(source, (str, bytes)) else 0)
+
+    def _chunks(self, actions: Iterable[dict]) -> Iterator[List[dict]]:
+        chunk, chunk_size = [], 0
+        for action in actions:
+            action_size = self._action_size(action)
+            if chunk and chunk_size + action_size > self.chunk_bytes:
+                yield chunk
+                chunk, chunk_size = [], 0
+            chunk.append(action)
+            chunk_size += action_size
+        if chunk:
+            yield chunk
+
+    def _adapt(self, latency: float, throttled: bool) -> None:
+        with self._lock:
+            if throttled or latency > self.target_latency:
+                self.chunk_bytes = max(self.min_chunk_bytes, self.chunk_bytes // 2)
+            elif latency < self.target_latency / 2:
+                self.chunk_bytes = min(self.max_chunk_bytes, int(self.chunk_bytes * 1.5))
+
+    def _send(self, chunk: List[dict]) -> Tuple[int, List[dict], List[Tuple[dict, dict]], bool]:
+        try:
+            results = list(streaming_bulk(
+                self.es_client,
+                chunk,
+                chunk_size=len(chunk),
+                max_chunk_bytes=self.max_chunk_bytes * 2,
+                raise_on_error=False,
+                raise_on_exception=False
+            ))
+        except (EsConnectionError, EsConnectionTimeout) as e:
+            self._logger.warning(f'Bulk request of {len(chunk)} documents failed: {str(e)}')
+            return 0, chunk, [], True
+
+        succeeded, failed, rejected, throttled = 0, [], [], False
+        # streaming_bulk возвращает результаты в порядке действий в пачке.
+        for action, (ok, result) in zip(chunk, results):
+            status = next(iter(result.values())).get('status')
+            if ok or (action.get('_op_type') == 'delete' and status == 404):
+                succeeded += 1
+            elif status in RETRYABLE_STATUSES:
+                failed.append(action)
+                throttled = throttled or status == 429
+            else:
+                rejected.append((action, result))
+        return succeeded, failed, rejected, throttled
+
+    def _filter_unchanged(
+        self,
+        chunk: List[dict],
+        index: str,
+        report: BulkReport
+    ) -> Tuple[List[dict], Dict[str, bytes]]:
+        indexed = [action for action in chunk if action.get('_op_type', 'index') == 'index']
+        changed, hashes = self.hashes.filter_unchanged(index, indexed)
+        report.suppressed += len(indexed) - len(changed)
+        return changed + [action for action in chunk if action.get('_op_type', 'index') != 'index'], hashes
+
+    def _send_chunks(self, actions: Iterable[dict], index: str, report: BulkReport) -> List[dict]:
+        """Отправляет actions пачками по мере поступления и возвращает действия с временными ошибками."""
+        failed = []
+        for chunk in self._chunks(actions):
+            hashes = {}
+            if self.hashes is not None:
+                chunk, hashes = self._filter_unchanged(chunk, index, report)
+                if not chunk:
+                    continue
+            started = monotonic()
+            succeeded, chunk_failed, rejected, throttled = self._send(chunk)
+            latency = monotonic() - started
+            self._adapt(latency, throttled)
+            BULK_SECONDS.labels(index=index).observe(latency)
+            if throttled:
+                BULK_THROTTLED.labels(index=index).inc()
+
+            report.success += succeeded
+            report.rejected += len(rejected)
+            for action, result in rejected:
+                self._logger.error(f'Document {action["_id"]} rejected by index {index}: {result}')
+                report.rejected_ids.append(action['_id'])
+            failed.extend(chunk_failed)
+
+            if self.hashes is not None:
+                # Хэши документов, которые будут отправлены повторно, запоминаются после их успешной загрузки.
+                unconfirmed = {str(action['_id']) for action in chunk_failed}
+                unconfirmed.update(str(action['_id']) for action, _ in rejected)
+                self.hashes.remember(index, {
+                    item_id: digest for item_id, digest in hashes.items() if item_id not in unconfirmed
+                })
+                # После удаления или частичного обновления хэш полного документа больше не соответствует индексу.
+                self.hashes.forget(index, [
+                    action['_id'] for action in chunk if action.get('_op_type') in ('delete', 'update')
+                ])
+        return failed
+
+    def load(self, actions: Iterable[dict], index: str) -> BulkReport:
+        """
+        Загружает действия, читая actions по мере отправки пачек, поэтому в памяти держится только текущая пачка
+        и документы, ждущие повтора. Хэши документов запоминаются после того, как Elasticsearch их принял.
+        """
+        report = BulkReport()
+        failed = self._send_chunks(actions, index, report)
+        sleep_time = self.start_sleep_time
+        while failed:
+            report.retried += len(failed)
+            sleep_time = min(
+                (sleep_time * (1 + random.uniform(-0.5, 0.5))) * self.factor,
+                self.border_sleep_time
+            )
+            self._logger.warning(f'{len(failed)} documents failed in index {index}. Retry in {sleep_time}s.')
+            BACKOFF_SLEEP_SECONDS.labels(function='bulk_load').inc(sleep_time)
+            time.sleep(sleep_time)
+            failed = self._send_chunks(failed, index, report)
+
+        self._logger.info(
+            f'Bulk completed for index {index}: {report.success} succeeded, {report.retried} retried, '
+            f'{report.rejected} rejected, {report.suppressed} unchanged skipped. '
+            f'Chunk size is {self.chunk_bytes} bytes.'
+        )
+        record_report(index, report)
+        return report
@@ -1,67 +1,105 @@
+import json
+import os
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
-from time import sleep
-from typing import List, Union, Type
+from functools import partial
+from time import monotonic
+from typing import Callable, Iterable, Iterator, List, Optional, Union, Type
 
 from dotenv import load_dotenv
 from pydantic import BaseModel
 
-from settings import postgres_settings, elasticsearch_settings
+from settings import postgres_settings, elasticsearch_settings, etl_settings
 
 import psycopg
 from psycopg.conninfo import make_conninfo
-from elasticsearch import Elasticsearch, ConnectionError as EsConnectionError, ConnectionTimeout as EsConnectionTimeout
-from elasticsearch.helpers import bulk
+from elasticsearch import Elasticsearch
 from psycopg import ServerCursor
 from psycopg.errors import (
     ConnectionTimeout as PsConnectionTimeout, ConnectionFailure as PsConnectionFailure,
     OperationalError as PsOperationalError)
-from psycopg.rows import dict_row
-
+from psycopg_pool import ConnectionPool
+
+from affected_ids import AffectedIds
+from catch_up import CatchUpScheduler
+from connections import RECONNECT_EXCEPTIONS, close_pool, get_pool
+from change_log import read_changes, acknowledge_changes, split_changes, chunked
+from dimensions import DIMENSIONS, invalidate_dimensions
+from hashes import DocumentHashes, SqliteHashStore, PostgresHashStore
+from lanes import Lane, THROUGHPUT_LANE
+from listener import ChangeListener
+from file_sink import NdjsonFileSink
+from loader import BulkLoader, BulkReport, Sink
 from logger import logger
-from state.json_file_storage import JsonFileStorage
-from state.models import State, Movie, Genre, Person
+from memory import peak_rss, reset_peak_rss
+from metrics import (
+    CHANGES, CYCLE_SECONDS, STAGE_SECONDS, StageTimer, start_metrics_server, timed, timed_batches, unwatch_states,
+    watch_state)
+from partial_updates import PartialUpdater
+from pipeline import Pipeline
+from queries import CHANGED_ITEMS_SQL, RELATED_ITEMS_SQL, fill_empty_lists
+from registry import INDEXES, IndexSpec
+from serialization import DocumentSerializer
+from sharding import ShardCoordinator
+from state.checkpoints import Checkpoints, Position, MIN_UUID
+from state.models import State
+from state.storages import get_storage
 
 from decorators import backoff
 
 load_dotenv(dotenv_path='.env')
 
+serializer = DocumentSerializer(
+    logger=logger,
+    mode=etl_settings.serialization,
+    validation_sample_rate=1 if etl_settings.debug else etl_settings.validation_sample_rate
+)
+
 
 def execute_batch(
         cursor: ServerCursor,
         sql: str,
         limit: int,
-        last_updated: datetime,
+        start_after: Position,
         end_updated: datetime
 ):
-    offset = 0
+    """
+    Постранично выбирает идентификаторы по курсору (modified, id).
+
+    Вместо LIMIT/OFFSET запоминается последняя прочитанная пара (modified, id), и следующая страница начинается
+    строго после неё. Поэтому каждая страница читается по индексу без пересканирования предыдущих, а строки с
+    одинаковым modified не теряются и не дублируются на границе страниц. Вместе с пачкой возвращается её
+    последняя пара - позиция для контрольной точки.
+    """
+    last_seen = start_after
     while True:
-        cursor.execute(sql, (last_updated, end_updated, limit, offset,))
+        cursor.execute(sql, (*last_seen, end_updated, limit,))
         items_data = cursor.fetchall()
-        items_ids = [item['id'] for item in items_data]
-        if not items_ids:
+        if not items_data:
             break
-        yield items_ids
-        offset += limit
+        last_item = items_data[-1]
+        last_seen = (last_item['modified'], last_item['id'])
+        yield [item['id'] for item in items_data], last_seen
 
 
 def extract_changed_items(
         cursor: ServerCursor,
         table_name: str,
-        last_updated: datetime,
-        end_updated: datetime
+        start_after: Position,
+        end_updated: datetime,
+        batch_size: Optional[int] = None,
+        shard_filter: str = 'TRUE'
 ):
-    logger.info(f'Fetching {table_name} changed after %s', last_updated)
+    logger.info(f'Fetching {table_name} changed after %s', start_after)
 
-    sql_request = f'''
-        SELECT id, modified
-        FROM content.{table_name}
-        WHERE modified > %s AND modified < %s
-        ORDER BY modified
-        LIMIT %s OFFSET %s;
-    '''
+    sql_request = CHANGED_ITEMS_SQL.format(table_name=table_name, shard_filter=shard_filter)
 
-    for items_batch_ids in execute_batch(cursor, sql_request, 100, last_updated, end_updated):
-        yield items_batch_ids
+    for items_batch in execute_batch(
+            cursor, sql_request, batch_size or etl_settings.batch_size, start_after, end_updated
+    ):
+        yield items_batch
 
 
 def extract_related_items(
@@ -70,16 +108,16 @@ def extract_related_items(
         primary_table: str,
         join_table: str,
         join_column: str,
-        filter_column: str
-
+        filter_column: str,
+        shard_filter: str = 'TRUE'
 ):
     """
     Извлекает идентификаторы элементов из основной таблицы, которые связаны с элементами во вторичной таблице.
 
     Данная функция выполняет SQL-запрос, который соединяет две таблицы: основную и связанную, используя указанный
     столбец для соединения. Фильтрация происходит по столбцу в связанной таблице, включая только те элементы,
-    идентификаторы которых перечислены в item_ids. Результатом функции является список уникальных идентификаторов из
-    основной таблицы, которые соответствуют условиям фильтрации.
+    идентификаторы которых перечислены в item_ids. Идентификаторы из основной таблицы, которые соответствуют
+    условиям фильтрации, выдаются по мере чтения курсора, по cursor.itersize строк.
 
     Параметры:\n
     cursor (ServerCursor): Курсор базы данных для выполнения запросов.\n
@@ -88,313 +126,566 @@ def extract_related_items(
     join_table (str): Название связанной таблицы, которая будет присоединена к основной.\n
     join_column (str): Название столбца в связанной таблице, который используется для соединения с основной таблицей.\n
     filter_column (str): Название столбца в связанной таблице, который используется для фильтрации элементов.\n
+    shard_filter (str): SQL-условие на mt.id, по умолчанию TRUE - без шардирования.\n
 
     Возвращает:
-    List[str]: Список идентификаторов элементов из основной таблицы, соответствующих условиям фильтрации.
+    Iterator[UUID]: Идентификаторы элементов из основной таблицы, соответствующих условиям фильтрации.
     """
-    formatted_items_ids = ', '.join(['%s'] * len(item_ids))
-    sql_request = f'''
-        SELECT mt.id, mt.modified
-        FROM content.{primary_table} mt
-        LEFT JOIN content.{join_table} rt ON rt.{join_column} = mt.id
-        WHERE rt.{filter_column} IN ({formatted_items_ids})
-        ORDER BY mt.modified;
-    '''
-    cursor.execute(sql_request, item_ids)
-    items = cursor.fetchall()
-    filtered_item_ids = [item['id'] for item in items]
-    return filtered_item_ids
-
-
-def get_changed_filmworks(
-        cursor: ServerCursor,
-        last_updated: datetime,
-        end_updated: datetime
-):
-    changed_persons = extract_changed_items(
-        cursor=cursor,
-        table_name='person',
-        last_updated=last_updated,
-        end_updated=end_updated
+    sql_request = RELATED_ITEMS_SQL.format(
+        primary_table=primary_table,
+        join_table=join_table,
+        join_column=join_column,
+        filter_column=filter_column,
+        shard_filter=shard_filter
     )
-    for changed_persons_ids in changed_persons:
-        changed_filmworks_ids = extract_related_items(
-            cursor=cursor,
-            item_ids=changed_persons_ids,
-            primary_table='film_work',
-            join_table='person_film_work',
-            join_column='film_work_id',
-            filter_column='person_id'
-        )
-        yield changed_filmworks_ids
+    cursor.execute(sql_request, (item_ids,))
+    return (item['id'] for item in cursor)
 
-    changed_genres = extract_changed_items(
-        cursor=cursor,
-        table_name='genre',
-        last_updated=last_updated,
-        end_updated=end_updated
-    )
-    for changed_genres_ids in changed_genres:
-        changed_filmworks_ids = extract_related_items(
-            cursor=cursor,
-            item_ids=changed_genres_ids,
-            primary_table='film_work',
-            join_table='genre_film_work',
-            join_column='film_work_id',
-            filter_column='genre_id'
-        )
-        yield changed_filmworks_ids
 
-    changed_filmworks = extract_changed_items(
-        cursor=cursor,
-        table_name='film_work',
-        last_updated=last_updated,
-        end_updated=end_updated
-    )
-    for changed_filmworks_ids in changed_filmworks:
-        yield changed_filmworks_ids
+def get_related_ids(
+        cursor: ServerCursor,
+        item_ids: set,
+        primary_table: str,
+        join_table: str,
+        join_column: str,
+        filter_column: str
+) -> set:
+    related_ids = set()
+    for item_ids_batch in chunked(list(item_ids), etl_settings.batch_size):
+        related_ids.update(extract_related_items(
+            cursor=cursor,
+            item_ids=item_ids_batch,
+            primary_table=primary_table,
+            join_table=join_table,
+            join_column=join_column,
+            filter_column=filter_column
+        ))
+    return related_ids
 
 
-def get_changed_genres(
+def get_changed_ids(
         cursor: ServerCursor,
-        last_updated: datetime,
-        end_updated: datetime
+        index: IndexSpec,
+        checkpoints: Checkpoints,
+        end_updated: datetime,
+        partial_updater: Optional[PartialUpdater] = None,
+        loaded_through: Optional[uuid.UUID] = None,
+        lane: Lane = THROUGHPUT_LANE,
+        shard_filter: Optional[Callable[[str], str]] = None
 ):
-    changed_genres = extract_changed_items(
-        cursor=cursor,
-        table_name='genre',
-        last_updated=last_updated,
-        end_updated=end_updated
-    )
-    for changed_genres_ids in changed_genres:
-        yield changed_genres_ids
-
-    changed_filmworks = extract_changed_items(
-        cursor=cursor,
-        table_name='film_work',
-        last_updated=last_updated,
-        end_updated=end_updated
-    )
-    for changed_filmworks_ids in changed_filmworks:
-        changed_genres_ids = extract_related_items(
-            cursor=cursor,
-            item_ids=changed_filmworks_ids,
-            primary_table='genre',
-            join_table='genre_film_work',
-            join_column='genre_id',
-            filter_column='film_work_id'
-        )
-        yield changed_genres_ids
+    """
+    Выдаёт пачки идентификаторов документов индекса, затронутых изменениями всех его источников за окно.
+
+    Сначала изменившиеся записи всех источников переводятся в идентификаторы документов по путям связей и
+    собираются в одно множество, поэтому каждый документ трансформируется и загружается за цикл один раз. Затем
+    множество выдаётся плотными пачками по lane.transform_batch_size, начиная после loaded_through.
+    После каждой пачки фиксируется последний загруженный идентификатор, после последней - позиции источников.
+
+    shard_filter строит SQL-условие шардов воркера по столбцу идентификатора документа: изменения корневой
+    таблицы и связанные документы отбираются по нему в PostgreSQL. Изменения остальных таблиц читаются целиком -
+    запись жанра или персоны может затрагивать документы любого шарда.
+    """
+    positions, snapshot_commits = {}, []
+    with AffectedIds(
+            max_in_memory=etl_settings.dedup_max_in_memory,
+            spill_dir=etl_settings.dedup_spill_dir
+    ) as affected_ids:
+        for source in index.sources:
+            changed_items = extract_changed_items(
+                cursor=cursor,
+                table_name=source.table,
+                start_after=checkpoints.start_after(index.name, source.table),
+                end_updated=end_updated,
+                batch_size=lane.batch_size,
+                shard_filter=shard_filter('id') if shard_filter is not None and source.join_path is None else 'TRUE'
+            )
+            for changed_ids, position in changed_items:
+                positions[source.table] = position
+                invalidate_dimensions(source.table, changed_ids)
+                if partial_updater is not None and partial_updater.handles(index.name, source.table):
+                    changed_ids, commit = partial_updater.split(cursor, index.name, source.table, changed_ids, None)
+                    snapshot_commits.append(commit)
+                if source.join_path is not None:
+                    changed_ids = extract_related_items(
+                        cursor=cursor,
+                        item_ids=changed_ids,
+                        primary_table=index.root_table,
+                        join_table=source.join_path.join_table,
+                        join_column=source.join_path.join_column,
+                        filter_column=source.join_path.filter_column,
+                        shard_filter=shard_filter('mt.id') if shard_filter is not None else 'TRUE'
+                    )
+                affected_ids.add(changed_ids)
+
+        if not positions and loaded_through is None:
+            return
+        logger.info(f'Collected {len(affected_ids)} {index.name} documents affected by changes up to {end_updated}')
+        if affected_ids:
+            checkpoints.commit(
+                f'{index.name}:{Checkpoints.PENDING}',
+                (end_updated, loaded_through or MIN_UUID)
+            )
+        for item_ids in affected_ids.batches(size=lane.transform_batch_size, after=loaded_through):
+            yield item_ids, checkpoints.committer(index.name, Checkpoints.PENDING, (end_updated, item_ids[-1]))
 
+    def complete():
+        for commit in snapshot_commits:
+            commit()
+        checkpoints.complete(index.name, positions)
 
-def get_changed_persons(
+    yield [], complete
+
+
+def fetch_documents(
         cursor: ServerCursor,
-        last_updated: datetime,
-        end_updated: datetime
-):
-    changed_persons = extract_changed_items(
-        cursor=cursor,
-        table_name='person',
-        last_updated=last_updated,
-        end_updated=end_updated
-    )
-    for changed_persons_ids in changed_persons:
-        yield changed_persons_ids
-
-    changed_filmworks = extract_changed_items(
-        cursor=cursor,
-        table_name='film_work',
-        last_updated=last_updated,
-        end_updated=end_updated
+        item_ids: list,
+        details_sql: str,
+        document_sql: str,
+        list_fields: tuple
+) -> Iterator[dict]:
+    if serializer.mode == 'raw':
+        cursor.execute(document_sql, (item_ids,))
+        return iter(cursor)
+    cursor.execute(details_sql, (item_ids,))
+    return fill_empty_lists(cursor, list_fields)
+
+
+def transform_data(cursor: ServerCursor, item_ids: list, index: IndexSpec) -> Iterator[dict]:
+    """
+    Выдаёт документы пачки по мере чтения курсора.
+
+    Серверный курсор читается по cursor.itersize строк, поэтому в памяти не держится вся пачка. Курсор занят,
+    пока документы не прочитаны до конца.
+    """
+    if index.links_sql is not None and serializer.mode != 'raw' and etl_settings.dimension_cache_size > 0:
+        cursor.execute(index.links_sql, (item_ids,))
+        # Промахи кэша загружаются отдельным курсором того же соединения, не прерывая чтение строк.
+        with cursor.connection.cursor() as names_cursor:
+            yield from index.fill_names(names_cursor, cursor)
+        return
+    yield from fetch_documents(cursor, item_ids, index.details_sql, index.document_sql, index.list_fields)
+
+
+def load_to_es(data: Iterable[dict], index: str, loader: Sink, model: Type[BaseModel]) -> BulkReport:
+    bulk_request = (
+        {
+            "_index": index,
+            "_id": item['id'],
+            "_source": source
+        } for item in data if (source := serializer.serialize(item, model)) is not None
     )
-    for changed_filmworks_ids in changed_filmworks:
-        changed_persons_ids = extract_related_items(
-            cursor=cursor,
-            item_ids=changed_filmworks_ids,
-            primary_table='genre',
-            join_table='genre_film_work',
-            join_column='genre_id',
-            filter_column='film_work_id'
-        )
-        yield changed_persons_ids
-
-
-def transform_filmworks_data(cursor: ServerCursor, filmwork_ids: list):
-    details_sql = f'''
-        SELECT
-            fw.id,
-            fw.title,
-            fw.description,
-            fw.rating AS imdb_rating,
-            JSON_AGG(DISTINCT jsonb_build_object('id', g.id, 'name', g.name)) AS genres,
-            JSON_AGG(DISTINCT jsonb_build_object('id', p.id, 'name', p.full_name)) FILTER (WHERE pfw.role = 'director') AS directors,
-            JSON_AGG(DISTINCT jsonb_build_object('id', p.id, 'name', p.full_name)) FILTER (WHERE pfw.role = 'actor') AS actors,
-            JSON_AGG(DISTINCT jsonb_build_object('id', p.id, 'name', p.full_name)) FILTER (WHERE pfw.role = 'writer') AS writers,
-            ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'director') AS directors_names,
-            ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'actor') AS actors_names,
-            ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'writer') AS writers_names,
-            fw.creation_date
-        FROM content.film_work fw
-        LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
-        LEFT JOIN content.person p ON p.id = pfw.person_id
-        LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
-        LEFT JOIN content.genre g ON g.id = gfw.genre_id
-        WHERE fw.id = ANY(%s)
-        GROUP BY fw.id;
-    '''
-    cursor.execute(details_sql, (filmwork_ids,))
-    formatted_data = cursor.fetchall()
-    for row in formatted_data:
-        for key in ['directors_names', 'actors_names', 'writers_names', 'directors', 'actors', 'writers']:
-            if row[key] is None:
-                row[key] = []
-    return formatted_data
-
-
-def transform_genres_data(cursor: ServerCursor, genres_ids: list):
-    details_sql = f'''
-        SELECT
-            g.id,
-            g.name,
-            g.description,
-            JSON_AGG(DISTINCT jsonb_build_object('id', fw.id, 'title', fw.title)) AS films
-        FROM content.film_work fw
-        LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
-        LEFT JOIN content.genre g ON g.id = gfw.genre_id
-        WHERE g.id = ANY(%s)
-        GROUP BY g.id;
-    '''
-    cursor.execute(details_sql, (genres_ids,))
-    formatted_data = cursor.fetchall()
-    for row in formatted_data:
-        if row['films'] is None:
-            row['films'] = []
-    return formatted_data
-
-
-def transform_persons_data(cursor: ServerCursor, persons_ids: list):
-    details_sql = '''
-        WITH Roles AS (
-            SELECT
-                pfw.person_id,
-                fw.id AS film_id,
-                fw.rating as imdb_rating,
-                array_agg(pfw.role) AS roles
-            FROM
-                content.person_film_work AS pfw
-            JOIN
-                content.film_work AS fw ON pfw.film_work_id = fw.id
-            GROUP BY
-                pfw.person_id, fw.id
-        )
-        SELECT
-            p.id,
-            p.full_name AS name,
-            JSON_AGG(
-                JSON_BUILD_OBJECT(
-                    'id', r.film_id,
-                    'roles', r.roles,
-                    'imdb_rating', r.imdb_rating
-                )
-            ) FILTER (WHERE r.film_id IS NOT NULL) AS films
-        FROM
-            content.person AS p
-        LEFT JOIN Roles r ON r.person_id = p.id
-        WHERE 
-            p.id = ANY(%s)
-        GROUP BY
-            p.id;
-    '''
-    cursor.execute(details_sql, (persons_ids,))
-    formatted_data = cursor.fetchall()
-    return formatted_data
-
-
-@backoff(exceptions=(EsConnectionError, EsConnectionTimeout,))
-def load_to_es(data: list, index: str, es_client: Elasticsearch, model: Type[BaseModel]):
+    return loader.load(bulk_request, index=index)
 
+
+def delete_from_es(ids: list, index: str, loader: Sink) -> BulkReport:
     bulk_request = [
         {
+            "_op_type": "delete",
             "_index": index,
-            "_id": item['id'],
-            "_source": model(**dict(item)).json()
-        } for item in data
+            "_id": item_id
+        } for item_id in ids
     ]
-    responses = bulk(es_client, bulk_request)
-    logger.info(f'Bulk indexing completed, {responses[0]} documents indexed.')
+    return loader.load(bulk_request, index=index)
+
 
+@contextmanager
+def transform_cursor():
+    with get_pool().connection() as conn, conn.cursor() as cur:
+        yield cur
 
-def update_filmworks(
+
+def update_index(
         cursor: ServerCursor,
-        es_client: Elasticsearch,
-        last_updated: datetime,
-        end_updated: datetime
-):
-    changed_filmworks = get_changed_filmworks(cursor=cursor, last_updated=last_updated, end_updated=end_updated)
-    for changed_filmwork_ids in changed_filmworks:
-        formatted_filmworks = transform_filmworks_data(cursor=cursor, filmwork_ids=changed_filmwork_ids)
-        load_to_es(data=formatted_filmworks, index='movies', es_client=es_client, model=Movie)
+        loader: Sink,
+        changed_batches,
+        transform,
+        index: str,
+        model: Type[BaseModel],
+        lane: Lane = THROUGHPUT_LANE
+) -> int:
+    """
+    Извлекает, трансформирует и загружает пачки changed_batches в индекс.
+
+    Пачка - список идентификаторов и функция фиксации контрольной точки (или None). Контрольная точка
+    фиксируется только после загрузки пачки. Пачки очереди lane ждут, пока освободится более приоритетная
+    очередь. Время стадий пачки пишется в etl_stage_seconds.
+    """
+    changed_batches = lane.paced(timed_batches(changed_batches, index=index))
+
+    if etl_settings.pipeline_enabled:
+        pipeline = Pipeline(
+            transform=lambda cursor, ids: StageTimer(transform(cursor, ids), index=index, stage='transform'),
+            load=timed(partial(load_to_es, index=index, loader=loader, model=model), index=index, stage='load'),
+            cursor_factory=transform_cursor,
+            logger=logger,
+            transform_workers=etl_settings.transform_workers,
+            load_workers=etl_settings.load_workers,
+            queue_size=etl_settings.pipeline_queue_size
+        )
+        stats = pipeline.run(changed_batches, name=index)
+        return stats['extract'].items
+
+    processed = 0
+    for changed_ids, commit in changed_batches:
+        if changed_ids:
+            # Документы трансформируются по мере загрузки, поэтому из времени загрузки вычитается трансформация.
+            formatted_items = StageTimer(transform(cursor, changed_ids), index=index, stage='transform')
+            started = monotonic()
+            load_to_es(data=formatted_items, index=index, loader=loader, model=model)
+            STAGE_SECONDS.labels(index=index, stage='load').observe(monotonic() - started - formatted_items.seconds)
+            processed += len(changed_ids)
+        if commit is not None:
+            commit()
+    return processed
+
+
+def update_from_change_log(
+        conn: psycopg.Connection,
+        cursor: ServerCursor,
+        loader: Sink,
+        state: State
+) -> int:
+    processed = 0
+    while True:
+        started = datetime.now()
+        changes = read_changes(cursor=cursor, limit=etl_settings.change_log_batch_size)
+        if not changes:
+            break
+        logger.info(f'Processing {len(changes)} change log entries')
+        upserted, deleted = split_changes(changes)
+        for table_name in DIMENSIONS:
+            invalidate_dimensions(table_name, upserted[table_name] | deleted[table_name])
+
+        for index in INDEXES.values():
+            changed_ids = set(upserted[index.root_table])
+            for source in index.sources:
+                if source.join_path is not None:
+                    changed_ids |= get_related_ids(
+                        cursor=cursor,
+                        item_ids=upserted[source.table],
+                        primary_table=index.root_table,
+                        join_table=source.join_path.join_table,
+                        join_column=source.join_path.join_column,
+                        filter_column=source.join_path.filter_column
+                    )
+            removed_ids = deleted[index.root_table]
+
+            update_index(
+                cursor=cursor,
+                loader=loader,
+                changed_batches=(
+                    (ids, None) for ids in chunked(list(changed_ids - removed_ids), etl_settings.transform_batch_size)
+                ),
+                transform=partial(transform_data, index=index),
+                index=index.name,
+                model=index.model
+            )
+            if removed_ids:
+                delete_from_es(ids=list(removed_ids), index=index.name, loader=loader)
 
+        # С хранилищем postgres на этом же соединении состояние фиксируется вместе с подтверждением.
+        state.set_state('last_update', started.strftime('%d-%m-%y %H:%M:%S'))
+        acknowledge_changes(conn=conn, changes=changes)
+        processed += len(changes)
+    return processed
 
-def update_genres(
+
+def update_from_sources(
         cursor: ServerCursor,
-        es_client: Elasticsearch,
-        last_updated: datetime,
-        end_updated: datetime
-):
-    changed_genres = get_changed_genres(cursor=cursor, last_updated=last_updated, end_updated=end_updated)
-    for changed_genres_ids in changed_genres:
-        formatted_genres = transform_genres_data(cursor=cursor, genres_ids=changed_genres_ids)
-        load_to_es(data=formatted_genres, index='genres', es_client=es_client, model=Genre)
+        loader: Sink,
+        index: IndexSpec,
+        checkpoints: Checkpoints,
+        end_updated: datetime,
+        shard_filter: Optional[Callable[[str], str]] = None,
+        partial_updater: Optional[PartialUpdater] = None,
+        target_index: Optional[str] = None,
+        lane: Lane = THROUGHPUT_LANE
+) -> int:
+    windows = [(end_updated, None)]
+    pending = checkpoints.pending(index.name)
+    if pending is not None:
+        # Окно, собранное до падения, дозагружается первым, затем изменения после него обрабатываются как обычно.
+        windows.insert(0, pending)
+
+    processed = 0
+    for window_end, loaded_through in windows:
+        processed += update_index(
+            cursor=cursor,
+            loader=loader,
+            changed_batches=get_changed_ids(
+                cursor=cursor,
+                index=index,
+                checkpoints=checkpoints,
+                end_updated=window_end,
+                partial_updater=partial_updater,
+                loaded_through=loaded_through,
+                lane=lane,
+                shard_filter=shard_filter
+            ),
+            transform=partial(transform_data, index=index),
+            index=target_index or index.name,
+            model=index.model,
+            lane=lane
+        )
+    return processed
 
 
-def update_persons(
+def update_from_modified(
         cursor: ServerCursor,
-        es_client: Elasticsearch,
-        last_updated: datetime,
-        end_updated: datetime
-):
-    changed_persons = get_changed_persons(cursor=cursor, last_updated=last_updated, end_updated=end_updated)
-    for changed_persons_ids in changed_persons:
-        formatted_persons = transform_persons_data(cursor=cursor, persons_ids=changed_persons_ids)
-        load_to_es(data=formatted_persons, index='persons', es_client=es_client, model=Person)
+        loader: Sink,
+        states: List[State],
+        shard_filter: Optional[Callable[[str], str]] = None,
+        partial_updater: Optional[PartialUpdater] = None,
+        end_updated: Optional[datetime] = None,
+        lane: Lane = THROUGHPUT_LANE
+) -> int:
+    last_update_row = states[0].get_state('last_update') or datetime.min.strftime('%d-%m-%y %H:%M:%S')
+    last_update = datetime.strptime(last_update_row, '%d-%m-%y %H:%M:%S')
+    start_update_datetime = end_updated or datetime.now()
+    checkpoints = Checkpoints(states=states, last_updated=last_update)
+
+    processed = 0
+    for index in INDEXES.values():
+        processed += update_from_sources(
+            cursor=cursor,
+            loader=loader,
+            index=index,
+            checkpoints=checkpoints,
+            end_updated=start_update_datetime,
+            shard_filter=shard_filter,
+            partial_updater=partial_updater,
+            lane=lane
+        )
 
+    # Окно обработано целиком, следующий цикл начинается с last_update. Позиции сбрасываются первыми: при падении
+    # между двумя записями окно просто пройдётся заново.
+    checkpoints.reset()
+    for state in states:
+        state.set_state('last_update', start_update_datetime.strftime('%d-%m-%y %H:%M:%S'))
+    return processed
 
-@backoff(exceptions=(PsConnectionFailure, PsConnectionTimeout, PsOperationalError,))
-def main():
-    state = State(JsonFileStorage(logger=logger))
-    es_client = Elasticsearch(hosts=elasticsearch_settings.hosts)
 
-    dsn = make_conninfo(**postgres_settings.dict())
+def get_shard_state(shard: int, conn: Optional[Union[psycopg.Connection, ConnectionPool]] = None) -> State:
+    return State(get_storage(
+        name=f'storage.shard-{shard}-of-{etl_settings.shard_count}',
+        directory=etl_settings.shard_state_dir,
+        conn=conn
+    ))
 
-    with (psycopg.connect(dsn, row_factory=dict_row) as conn,
-          ServerCursor(conn, 'fetcher') as cur):
-        while True:
-            last_update_row = state.get_state('last_update') or datetime.min.strftime('%d-%m-%y %H:%M:%S')
-            last_update = datetime.strptime(last_update_row, '%d-%m-%y %H:%M:%S')
-            start_update_datetime = datetime.now()
-
-            update_filmworks(
-                cursor=cur,
-                es_client=es_client,
-                last_updated=last_update,
-                end_updated=start_update_datetime
-            )
-            update_genres(
-                cursor=cur,
-                es_client=es_client,
-                last_updated=last_update,
-                end_updated=start_update_datetime
-            )
-            update_persons(
-                cursor=cur,
-                es_client=es_client,
-                last_updated=last_update,
-                end_updated=start_update_datetime
+
+def update_shards(
+        cursor: ServerCursor,
+        loader: Sink,
+        coordinator: ShardCoordinator,
+        state_conn: Optional[Union[psycopg.Connection, ConnectionPool]] = None
+) -> int:
+    """
+    Обновляет индексы по шардам, которыми сейчас владеет воркер.
+
+    У каждого шарда свои контрольные точки. Шарды с одинаковыми контрольными точками (обычный случай, когда
+    воркер давно владеет ими) обрабатываются за один проход по изменениям.
+    """
+    shards_by_checkpoint = defaultdict(dict)
+    shards = sorted(coordinator.rebalance())
+    for shard in shards:
+        state = get_shard_state(shard, conn=state_conn)
+        checkpoint = json.dumps(
+            [state.get_state('last_update'), state.get_state(Checkpoints.STATE_KEY)],
+            sort_keys=True
+        )
+        watch_state(state, name=f'shard-{shard}')
+        shards_by_checkpoint[checkpoint][shard] = state
+    unwatch_states(keep=[f'shard-{shard}' for shard in shards])
+
+    processed = 0
+    for shard_states in shards_by_checkpoint.values():
+        processed += update_from_modified(
+            cursor=cursor,
+            loader=loader,
+            states=list(shard_states.values()),
+            shard_filter=partial(coordinator.shard_condition, shards=set(shard_states))
+        )
+    return processed
+
+
+def get_catch_up_state(key: Union[int, str], conn: Optional[Union[psycopg.Connection, ConnectionPool]] = None) -> State:
+    return State(get_storage(name=f'storage.catch-up-{key}', directory=etl_settings.state_dir, conn=conn))
+
+
+def update_catch_up_slice(state: State, end_updated: datetime, pool: ConnectionPool, loader: Sink, lane: Lane) -> int:
+    # Срезы обрабатываются параллельно, поэтому у каждого своё соединение и серверный курсор.
+    with pool.connection() as conn, ServerCursor(conn, 'catch_up') as cursor:
+        cursor.itersize = etl_settings.cursor_itersize
+        return update_from_modified(
+            cursor=cursor, loader=loader, states=[state], end_updated=end_updated, lane=lane
+        )
+
+
+def get_document_hashes(conn: Optional[ConnectionPool] = None) -> Optional[DocumentHashes]:
+    # Хэши описывают содержимое индекса Elasticsearch, файловый получатель пишет все документы.
+    if etl_settings.sink != 'elasticsearch':
+        return None
+    if etl_settings.hash_storage == 'sqlite':
+        return DocumentHashes(SqliteHashStore(db_path=os.path.join(etl_settings.state_dir, 'hashes.db')))
+    if etl_settings.hash_storage == 'postgres':
+        return DocumentHashes(PostgresHashStore(conn=conn))
+    return None
+
+
+def get_sink(hashes: Optional[DocumentHashes] = None) -> Sink:
+    if etl_settings.sink == 'file':
+        return NdjsonFileSink(
+            directory=etl_settings.sink_dir,
+            logger=logger,
+            compression=etl_settings.sink_compression,
+            max_file_bytes=etl_settings.sink_max_file_bytes
+        )
+    if etl_settings.sink != 'elasticsearch':
+        raise ValueError(f'Unknown sink {etl_settings.sink}, expected elasticsearch or file')
+    return BulkLoader(
+        es_client=Elasticsearch(hosts=elasticsearch_settings.hosts),
+        logger=logger,
+        min_chunk_bytes=etl_settings.bulk_min_chunk_bytes,
+        max_chunk_bytes=etl_settings.bulk_max_chunk_bytes,
+        target_latency=etl_settings.bulk_target_latency,
+        hashes=hashes
+    )
+
+
+@backoff(exceptions=RECONNECT_EXCEPTIONS, reraise=True, max_retries=etl_settings.cycle_retries)
+def run_cycle(
+        pool: ConnectionPool,
+        loader: Sink,
+        state: Optional[State],
+        coordinator: Optional[ShardCoordinator] = None,
+        catch_up: Optional[CatchUpScheduler] = None,
+        partial_updater: Optional[PartialUpdater] = None
+) -> int:
+    """
+    Один цикл ETL на соединении из пула.
+
+    При обрыве соединения цикл повторяется на месте на новом проверенном соединении из пула: загрузчик, клиент
+    Elasticsearch и состояние в памяти сохраняются, а контрольные точки продолжают работу с упавшей пачки.
+    После etl_settings.cycle_retries неудачных повторов ошибка уходит в main, который переподключается целиком.
+    """
+    with pool.connection() as conn, ServerCursor(conn, 'fetcher') as cur:
+        cur.itersize = etl_settings.cursor_itersize
+        if etl_settings.change_source == 'change_log':
+            if state is not None:
+                return update_from_change_log(conn=conn, cursor=cur, loader=loader, state=state)
+            # Состояние в PostgreSQL пишется в транзакции подтверждения, то есть на соединении цикла. Метрика
+            # переключается на него после записи и читает только кэш, а не соединение, возвращённое в пул.
+            state = State(get_storage(name='storage', directory=etl_settings.state_dir, conn=conn))
+            processed = update_from_change_log(conn=conn, cursor=cur, loader=loader, state=state)
+            if processed:
+                watch_state(state)
+            return processed
+        if coordinator is not None:
+            return update_shards(cursor=cur, loader=loader, coordinator=coordinator, state_conn=pool)
+        if catch_up is not None:
+            processed = catch_up.run(
+                conn=conn,
+                state=state,
+                latency_state=get_catch_up_state('latency', conn=pool),
+                slice_state=partial(get_catch_up_state, conn=pool),
+                update_slice=partial(update_catch_up_slice, pool=pool, loader=loader)
             )
+            if processed is not None:
+                return processed
+        return update_from_modified(cursor=cur, loader=loader, states=[state], partial_updater=partial_updater)
+
+
+@backoff(exceptions=(PsConnectionFailure, PsConnectionTimeout, PsOperationalError,))
+def main():
+    dsn = make_conninfo(**postgres_settings.dict())
+    listener = ChangeListener(
+        dsn=dsn,
+        channel=etl_settings.notify_channel,
+        logger=logger,
+        debounce=etl_settings.notify_debounce,
+        max_debounce=etl_settings.notify_max_debounce
+    )
 
-            state.set_state('last_update', start_update_datetime.strftime('%d-%m-%y %H:%M:%S'))
-            sleep(10)
+    sharded = etl_settings.shard_count > 1 and etl_settings.change_source != 'change_log'
+    os.makedirs(etl_settings.state_dir, exist_ok=True)
+    if sharded:
+        os.makedirs(etl_settings.shard_state_dir, exist_ok=True)
+    coordinator = ShardCoordinator(
+        dsn=dsn,
+        shard_count=etl_settings.shard_count,
+        logger=logger
+    ) if sharded else nullcontext()
+
+    # Соединения берутся из общего пула. В режиме modified контрольные точки фиксируются сразу после каждой пачки,
+    # поэтому состояние в PostgreSQL пишется через пул. В режиме change_log - в транзакции подтверждения цикла.
+    pool = get_pool()
+    if etl_settings.metrics_port:
+        start_metrics_server(etl_settings.metrics_port)
+        logger.info(f'Serving Prometheus metrics on port {etl_settings.metrics_port}')
+    try:
+        with listener, coordinator:
+            state = State(get_storage(name='storage', directory=etl_settings.state_dir, conn=pool))
+            if not sharded:
+                # Метрика читает last_update только из кэша, поэтому состояние читается заранее.
+                state.get_state('last_update')
+                watch_state(state)
+            if etl_settings.state_storage == 'postgres' and etl_settings.change_source == 'change_log':
+                state = None
+            document_hashes = get_document_hashes(conn=pool)
+            with get_sink(hashes=document_hashes) as loader:
+                partial_updater = None
+                if etl_settings.partial_updates and not sharded and isinstance(loader, BulkLoader):
+                    if document_hashes is None:
+                        logger.warning(
+                            'Partial updates need ETL_HASH_STORAGE to keep snapshots. Continue with full rebuilds'
+                        )
+                    else:
+                        partial_updater = PartialUpdater(loader=loader, logger=logger)
+                catch_up = None
+                if etl_settings.catch_up_threshold and etl_settings.change_source != 'change_log' and not sharded:
+                    catch_up = CatchUpScheduler(
+                        tables=(source.table for index in INDEXES.values() for source in index.sources),
+                        logger=logger,
+                        threshold=etl_settings.catch_up_threshold,
+                        slice_rows=etl_settings.catch_up_slice_rows,
+                        workers=etl_settings.catch_up_workers,
+                        poll_interval=etl_settings.poll_interval_min,
+                        min_lag=etl_settings.catch_up_min_lag
+                    )
+                poll_interval = etl_settings.poll_interval_min
+                while True:
+                    reset_peak_rss()
+                    started = monotonic()
+                    processed = run_cycle(
+                        pool=pool,
+                        loader=loader,
+                        state=state,
+                        coordinator=coordinator if sharded else None,
+                        catch_up=catch_up,
+                        partial_updater=partial_updater
+                    )
+                    if processed:
+                        CYCLE_SECONDS.observe(monotonic() - started)
+                        CHANGES.inc(processed)
+                    if processed and document_hashes is not None:
+                        logger.info(
+                            f'Cycle completed: {processed} changes processed, '
+                            f'{document_hashes.take_suppressed()} unchanged documents skipped'
+                        )
+                    if processed:
+                        logger.info(f'Cycle peak memory: {peak_rss() / 2 ** 20:.1f} MiB RSS')
+                        for table_name, cache in DIMENSIONS.items():
+                            hits, misses = cache.take_stats()
+                            if hits or misses:
+                                logger.info(f'Dimension cache {table_name}: {hits} hits, {misses} misses')
+
+                    if processed:
+                        poll_interval = etl_settings.poll_interval_min
+                    else:
+                        poll_interval = min(poll_interval * 2, etl_settings.poll_interval_max)
+                    listener.wait(timeout=poll_interval)
+    finally:
+        close_pool()
 
 
 if __name__ == '__main__':
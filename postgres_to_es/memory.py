@@ -0,0 +1,29 @@
+import resource
+
+CLEAR_REFS_PATH = '/proc/self/clear_refs'
+STATUS_PATH = '/proc/self/status'
+
+
+def reset_peak_rss() -> None:
+    """Сбрасывает пиковый RSS процесса, чтобы peak_rss показал пик следующего цикла. Работает только в Linux."""
+    try:
+        with open(CLEAR_REFS_PATH, 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss() -> int:
+    """
+    Пиковый RSS процесса в байтах с последнего reset_peak_rss.
+
+    Без /proc возвращается пик за всё время работы процесса (ru_maxrss).
+    """
+    try:
+        with open(STATUS_PATH) as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
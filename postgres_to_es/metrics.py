@@ -0,0 +1,159 @@
+import threading
+from datetime import datetime
+from functools import partial, wraps
+from time import monotonic
+from typing import Callable, Dict, Iterable, Iterator
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from lanes import LANES
+from state.models import State
+
+STATE_DATETIME_FORMAT = '%d-%m-%y %H:%M:%S'
+
+STAGE_SECONDS = Histogram(
+    'etl_stage_seconds',
+    'Time spent on one batch in an ETL stage',
+    ['index', 'stage'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+DOCUMENTS = Counter(
+    'etl_documents',
+    'Documents handled by the sink: indexed, retried, rejected or skipped as unchanged',
+    ['index', 'result']
+)
+BULK_SECONDS = Histogram(
+    'etl_bulk_request_seconds',
+    'Latency of bulk requests to Elasticsearch',
+    ['index'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+BULK_THROTTLED = Counter(
+    'etl_bulk_throttled',
+    'Bulk requests answered with 429 or failed with a connection error',
+    ['index']
+)
+BACKOFF_SLEEP_SECONDS = Counter(
+    'etl_backoff_sleep_seconds',
+    'Seconds slept before retrying a failed call',
+    ['function']
+)
+CYCLE_SECONDS = Histogram(
+    'etl_cycle_seconds',
+    'Duration of ETL cycles that processed changes',
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+)
+CHANGES = Counter('etl_changes', 'Changes processed by ETL cycles')
+SECONDS_BEHIND = Gauge('etl_seconds_behind', 'Seconds since last_update of the ETL state', ['state'])
+LANE_LAG_SECONDS = Gauge('etl_lane_lag_seconds', 'Age of the oldest unprocessed window of a lane', ['lane'])
+
+_server_lock = threading.Lock()
+_server_started = False
+_watched_states: Dict[str, State] = {}
+
+
+def start_metrics_server(port: int) -> None:
+    """Открывает метрики в формате Prometheus на порту port. Повторный вызов (после перезапуска main) пропускается."""
+    global _server_started
+    with _server_lock:
+        if _server_started:
+            return
+        for lane in LANES:
+            LANE_LAG_SECONDS.labels(lane=lane.name).set_function(lane.lag)
+        start_http_server(port)
+        _server_started = True
+
+
+def watch_state(state: State, name: str = 'storage') -> None:
+    """
+    Считает etl_seconds_behind по last_update состояния state при каждом чтении метрик.
+
+    last_update берётся только из кэша состояния в памяти, поэтому чтение метрик не обращается к хранилищу
+    и соединению, к которому оно привязано. Повторный вызов с тем же name переключает метрику на новое состояние.
+    """
+    with _server_lock:
+        if name not in _watched_states:
+            SECONDS_BEHIND.labels(state=name).set_function(partial(_seconds_behind, name))
+        _watched_states[name] = state
+
+
+def unwatch_states(keep: Iterable[str]) -> None:
+    """Убирает etl_seconds_behind всех состояний, кроме keep (например, шардов, которые отошли другим воркерам)."""
+    with _server_lock:
+        for name in set(_watched_states) - set(keep):
+            SECONDS_BEHIND.remove(name)
+            del _watched_states[name]
+
+
+def _seconds_behind(name: str) -> float:
+    state = _watched_states.get(name)
+    last_update = state.peek_state('last_update') if state is not None else None
+    if last_update is None:
+        return float('nan')
+    return (datetime.now() - datetime.strptime(last_update, STATE_DATETIME_FORMAT)).total_seconds()
+
+
+class StageTimer:
+    """
+    Итератор, который считает время, проведённое внутри источника iterable.
+
+    Для потоковых стадий: трансформация читается загрузкой по мере отправки, и её время отделяется от времени
+    загрузки. Когда источник исчерпан, время записывается в etl_stage_seconds.
+    """
+
+    def __init__(self, iterable: Iterable, index: str, stage: str):
+        self.seconds = 0.0
+        self._iterator = iter(iterable)
+        self._index = index
+        self._stage = stage
+
+    def __iter__(self) -> Iterator:
+        return self
+
+    def __next__(self):
+        started = monotonic()
+        try:
+            item = next(self._iterator)
+        except StopIteration:
+            self.seconds += monotonic() - started
+            STAGE_SECONDS.labels(index=self._index, stage=self._stage).observe(self.seconds)
+            raise
+        self.seconds += monotonic() - started
+        return item
+
+
+def timed_batches(batches: Iterable, index: str) -> Iterator:
+    """Выдаёт пачки batches, записывая время получения каждой в etl_stage_seconds со стадией extract."""
+    iterator = iter(batches)
+    while True:
+        started = monotonic()
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return
+        STAGE_SECONDS.labels(index=index, stage='extract').observe(monotonic() - started)
+        yield batch
+
+
+def timed(func: Callable, index: str, stage: str) -> Callable:
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        started = monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            STAGE_SECONDS.labels(index=index, stage=stage).observe(monotonic() - started)
+
+    return wrapper
+
+
+def record_report(index: str, report) -> None:
+    """Добавляет итог BulkReport загрузки в etl_documents."""
+    for result, count in (
+        ('indexed', report.success),
+        ('retried', report.retried),
+        ('rejected', report.rejected),
+        ('unchanged', report.suppressed)
+    ):
+        if count:
+            DOCUMENTS.labels(index=index, result=result).inc(count)
@@ -0,0 +1,243 @@
+import json
+from collections import defaultdict
+from dataclasses import dataclass
+from functools import partial
+from logging import Logger
+from typing import Callable, Dict, Optional, Tuple
+
+from psycopg import ServerCursor
+
+from hashes import DocumentHashes
+from loader import BulkLoader
+
+UPDATE_NESTED_SCRIPT_ID = 'etl_update_nested'
+
+# Обновляет атрибут attribute у элементов списков fields, чей id есть в params.values. Для персон фильма заново
+# собирает списки имён (*_names). Если ни один элемент не изменился, документ не переписывается.
+UPDATE_NESTED_SCRIPT = '''
+    boolean changed = false;
+    for (String field : params.fields) {
+        List items = ctx._source[field];
+        if (items == null) {
+            continue;
+        }
+        for (Map item : items) {
+            if (params.values.containsKey(item['id']) && item[params.attribute] != params.values[item['id']]) {
+                item[params.attribute] = params.values[item['id']];
+                changed = true;
+            }
+        }
+        if (params.with_names) {
+            Set names = new TreeSet();
+            for (Map item : items) {
+                names.add(item[params.attribute]);
+            }
+            ctx._source[field + '_names'] = new ArrayList(names);
+        }
+    }
+    if (!changed) {
+        ctx.op = 'noop';
+    }
+'''
+
+SOURCE_LINKS_SQL = '''
+    SELECT s.id, s.{value_column} AS value, l.{doc_column} AS doc_id, {link_role} AS role
+    FROM content.{source_table} s
+    LEFT JOIN content.{link_table} l ON l.{source_column} = s.id
+    WHERE s.id = ANY(%s)
+    ORDER BY s.id, l.{doc_column}, role;
+'''
+
+
+@dataclass(frozen=True)
+class Denormalization:
+    """Поле таблицы source_table, скопированное во вложенные списки fields документов через link_table."""
+    source_table: str
+    value_column: str
+    link_table: str
+    source_column: str
+    doc_column: str
+    fields: Tuple[str, ...]
+    attribute: str
+    with_roles: bool = False
+    with_names: bool = False
+
+    @property
+    def links_sql(self) -> str:
+        return SOURCE_LINKS_SQL.format(
+            value_column=self.value_column,
+            doc_column=self.doc_column,
+            link_role='l.role' if self.with_roles else "''",
+            source_table=self.source_table,
+            link_table=self.link_table,
+            source_column=self.source_column
+        )
+
+
+# Ключ - (индекс, таблица-источник изменений), как у контрольных точек.
+DENORMALIZATIONS: Dict[Tuple[str, str], Denormalization] = {
+    ('movies', 'person'): Denormalization(
+        source_table='person',
+        value_column='full_name',
+        link_table='person_film_work',
+        source_column='person_id',
+        doc_column='film_work_id',
+        fields=('directors', 'actors', 'writers'),
+        attribute='name',
+        with_roles=True,
+        with_names=True
+    ),
+    ('movies', 'genre'): Denormalization(
+        source_table='genre',
+        value_column='name',
+        link_table='genre_film_work',
+        source_column='genre_id',
+        doc_column='film_work_id',
+        fields=('genres',),
+        attribute='name'
+    ),
+    ('genres', 'film_work'): Denormalization(
+        source_table='film_work',
+        value_column='title',
+        link_table='genre_film_work',
+        source_column='film_work_id',
+        doc_column='genre_id',
+        fields=('films',),
+        attribute='title'
+    ),
+    ('persons', 'film_work'): Denormalization(
+        source_table='film_work',
+        value_column='rating',
+        link_table='person_film_work',
+        source_column='film_work_id',
+        doc_column='person_id',
+        fields=('films',),
+        attribute='imdb_rating',
+        with_roles=True
+    ),
+}
+
+
+class PartialUpdater:
+    """
+    Заменяет полную пересборку документов частичным обновлением, когда изменилось только скопированное поле.
+
+    Для каждой записи-источника (например, жанра для индекса movies) запоминаются хэш значения поля и хэш
+    набора связей с документами. Если связи не изменились, а значение изменилось, документам отправляются
+    bulk-действия update со скриптом, который правит только вложенные элементы этой записи. Если не изменилось
+    ничего из попадающего в документы, документы не трогаются. Записи с новыми или неизвестными связями
+    отдаются на полную пересборку, их снимки фиксируются вместе с контрольной точкой пачки.
+    """
+
+    def __init__(self, loader: BulkLoader, logger: Logger):
+        self.loader = loader
+        self.snapshots = loader.hashes.store
+        self._logger = logger
+        # Скрипт сохраняется в кластере один раз, и bulk-действия ссылаются на него по id.
+        loader.es_client.put_script(
+            id=UPDATE_NESTED_SCRIPT_ID,
+            script={'lang': 'painless', 'source': UPDATE_NESTED_SCRIPT}
+        )
+
+    @staticmethod
+    def handles(index: str, table_name: str) -> bool:
+        return (index, table_name) in DENORMALIZATIONS
+
+    @staticmethod
+    def _snapshot_keys(index: str, table_name: str) -> Tuple[str, str]:
+        return f'{index}:{table_name}:value', f'{index}:{table_name}:links'
+
+    def _remember(self, index: str, table_name: str, values: dict, links: dict) -> None:
+        value_key, links_key = self._snapshot_keys(index, table_name)
+        if values:
+            self.snapshots.put(value_key, values)
+            self.snapshots.put(links_key, links)
+
+    def split(
+            self,
+            cursor: ServerCursor,
+            index: str,
+            table_name: str,
+            source_ids: list,
+            commit: Optional[Callable[[], None]]
+    ) -> Tuple[list, Callable[[], None]]:
+        """
+        Обновляет частично всё, что можно, и возвращает идентификаторы записей-источников для полной пересборки
+        и функцию фиксации пачки, которая дополнительно запоминает их снимки.
+        """
+        denormalization = DENORMALIZATIONS[(index, table_name)]
+        cursor.execute(denormalization.links_sql, (source_ids,))
+
+        values, links, doc_ids, new_values, original_ids = {}, defaultdict(list), defaultdict(list), {}, {}
+        for row in cursor.fetchall():
+            source_id = str(row['id'])
+            original_ids[source_id] = row['id']
+            new_values[source_id] = row['value']
+            if row['doc_id'] is not None:
+                links[source_id].append(f'{row["doc_id"]}:{row["role"]}')
+                doc_ids[source_id].append(str(row['doc_id']))
+        for source_id, value in new_values.items():
+            values[source_id] = DocumentHashes.digest(json.dumps(value))
+            links[source_id] = DocumentHashes.digest('|'.join(links[source_id]))
+
+        value_key, links_key = self._snapshot_keys(index, table_name)
+        known_values = self.snapshots.get(value_key, list(values))
+        known_links = self.snapshots.get(links_key, list(values))
+
+        rebuild, updated, unchanged = [], {}, []
+        for source_id in values:
+            if known_links.get(source_id) != links[source_id]:
+                rebuild.append(source_id)
+            elif known_values.get(source_id) != values[source_id]:
+                updated[source_id] = new_values[source_id]
+            else:
+                unchanged.append(source_id)
+
+        if updated:
+            self._update_documents(index, denormalization, updated, doc_ids)
+            self._remember(
+                index, table_name,
+                {source_id: values[source_id] for source_id in updated},
+                {source_id: links[source_id] for source_id in updated}
+            )
+        self._logger.info(
+            f'Partial updates for {index} from {table_name}: {len(updated)} changed values, '
+            f'{len(unchanged)} without changes, {len(rebuild)} need full rebuild'
+        )
+
+        remember = partial(
+            self._remember, index, table_name,
+            {source_id: values[source_id] for source_id in rebuild},
+            {source_id: links[source_id] for source_id in rebuild}
+        )
+
+        def commit_with_snapshots():
+            remember()
+            if commit is not None:
+                commit()
+
+        return [original_ids[source_id] for source_id in rebuild], commit_with_snapshots
+
+    def _update_documents(self, index: str, denormalization: Denormalization, updated: dict, doc_ids: dict) -> None:
+        values_by_doc = defaultdict(dict)
+        for source_id, value in updated.items():
+            for doc_id in doc_ids[source_id]:
+                values_by_doc[doc_id][source_id] = value
+
+        actions = [
+            {
+                '_op_type': 'update',
+                '_index': index,
+                '_id': doc_id,
+                'script': {
+                    'id': UPDATE_NESTED_SCRIPT_ID,
+                    'params': {
+                        'fields': list(denormalization.fields),
+                        'attribute': denormalization.attribute,
+                        'with_names': denormalization.with_names,
+                        'values': values,
+                    },
+                },
+            } for doc_id, values in values_by_doc.items()
+        ]
+        self.loader.load(actions, index=index)
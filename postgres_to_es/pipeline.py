@@ -0,0 +1,208 @@
+import queue
+import threading
+from contextlib import AbstractContextManager
+from logging import Logger
+from time import monotonic
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+_STOP = object()
+
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.batches = 0
+        self.items = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, items: int, seconds: float) -> None:
+        with self._lock:
+            self.batches += 1
+            self.items += items
+            self.busy_seconds += seconds
+
+    def throughput(self) -> float:
+        return self.items / self.busy_seconds if self.busy_seconds else 0.0
+
+    def __str__(self):
+        return (
+            f'{self.name}: {self.batches} batches, {self.items} items, '
+            f'{self.busy_seconds:.2f}s busy, {self.throughput():.1f} items/s'
+        )
+
+
+class CommitTracker:
+    """
+    Фиксирует контрольные точки пачек строго в порядке извлечения.
+
+    Пачки загружаются несколькими потоками и завершаются в произвольном порядке. Контрольная точка пачки
+    фиксируется, только когда загружены и она, и все извлечённые до неё, поэтому после падения ни одна
+    незагруженная пачка не окажется позади сохранённой позиции.
+    """
+
+    def __init__(self):
+        self._commits: Dict[int, Optional[Callable[[], None]]] = {}
+        self._done = set()
+        self._next_seq = 0
+        self._next_commit = 0
+        self._lock = threading.Lock()
+
+    def register(self, commit: Optional[Callable[[], None]]) -> int:
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._commits[seq] = commit
+            return seq
+
+    def done(self, seq: int) -> None:
+        with self._lock:
+            self._done.add(seq)
+            while self._next_commit in self._done:
+                self._done.remove(self._next_commit)
+                commit = self._commits.pop(self._next_commit)
+                if commit is not None:
+                    commit()
+                self._next_commit += 1
+
+
+class Pipeline:
+    """
+    Выполняет извлечение, трансформацию и загрузку пачек параллельно в отдельных потоках.
+
+    Стадии связаны ограниченными очередями: если Elasticsearch не успевает индексировать, очередь на загрузку
+    заполняется и трансформация блокируется, а за ней и извлечение, поэтому в памяти держится не больше
+    queue_size пачек на стадию. Каждый поток трансформации работает со своим курсором из cursor_factory.
+    Контрольные точки пачек фиксируются после загрузки в порядке извлечения через CommitTracker.
+    """
+
+    def __init__(
+        self,
+        transform: Callable[[Any, list], Iterable[dict]],
+        load: Callable[[list], Any],
+        cursor_factory: Callable[[], AbstractContextManager],
+        logger: Logger,
+        transform_workers: int = 2,
+        load_workers: int = 2,
+        queue_size: int = 4
+    ):
+        self.transform = transform
+        self.load = load
+        self.cursor_factory = cursor_factory
+        self.transform_workers = transform_workers
+        self.load_workers = load_workers
+        self.queue_size = queue_size
+        self._logger = logger
+
+        self.stats: Dict[str, StageStats] = {}
+        self._errors: List[BaseException] = []
+        self._stop = threading.Event()
+        self._tracker = CommitTracker()
+
+    def _put(self, target: queue.Queue, item: Any) -> bool:
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source: queue.Queue) -> Any:
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return _STOP
+
+    def _fail(self, error: BaseException) -> None:
+        self._errors.append(error)
+        self._stop.set()
+
+    def _extract(self, batches: Iterable[Tuple[list, Optional[Callable[[], None]]]], output: queue.Queue) -> None:
+        stats = self.stats['extract']
+        try:
+            iterator = iter(batches)
+            while True:
+                started = monotonic()
+                batch = next(iterator, None)
+                if batch is None:
+                    break
+                ids, commit = batch
+                stats.add(len(ids), monotonic() - started)
+                seq = self._tracker.register(commit)
+                if not ids:
+                    self._tracker.done(seq)
+                    continue
+                if not self._put(output, (seq, ids)):
+                    return
+        except Exception as e:
+            self._fail(e)
+        finally:
+            for _ in range(self.transform_workers):
+                self._put(output, _STOP)
+
+    def _transform_worker(self, source: queue.Queue, output: queue.Queue) -> None:
+        stats = self.stats['transform']
+        try:
+            with self.cursor_factory() as cursor:
+                while (batch := self._get(source)) is not _STOP:
+                    seq, ids = batch
+                    started = monotonic()
+                    # Строки передаются в очередь загрузки, поэтому пачка читается целиком.
+                    rows = list(self.transform(cursor, ids))
+                    stats.add(len(rows), monotonic() - started)
+                    if not self._put(output, (seq, rows)):
+                        return
+        except Exception as e:
+            self._fail(e)
+
+    def _load_worker(self, source: queue.Queue) -> None:
+        stats = self.stats['load']
+        try:
+            while (batch := self._get(source)) is not _STOP:
+                seq, rows = batch
+                started = monotonic()
+                self.load(rows)
+                stats.add(len(rows), monotonic() - started)
+                self._tracker.done(seq)
+        except Exception as e:
+            self._fail(e)
+
+    @staticmethod
+    def _start(target: Callable, *args, count: int = 1) -> List[threading.Thread]:
+        threads = [threading.Thread(target=target, args=args, daemon=True) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def run(
+        self,
+        batches: Iterable[Tuple[list, Optional[Callable[[], None]]]],
+        name: str = 'etl'
+    ) -> Dict[str, StageStats]:
+        self.stats = {stage: StageStats(stage) for stage in ('extract', 'transform', 'load')}
+        self._errors = []
+        self._stop.clear()
+        self._tracker = CommitTracker()
+
+        ids_queue = queue.Queue(maxsize=self.queue_size)
+        rows_queue = queue.Queue(maxsize=self.queue_size)
+
+        extractors = self._start(self._extract, batches, ids_queue)
+        transformers = self._start(self._transform_worker, ids_queue, rows_queue, count=self.transform_workers)
+        loaders = self._start(self._load_worker, rows_queue, count=self.load_workers)
+
+        for thread in extractors + transformers:
+            thread.join()
+        for _ in range(self.load_workers):
+            self._put(rows_queue, _STOP)
+        for thread in loaders:
+            thread.join()
+
+        for stage_stats in self.stats.values():
+            self._logger.info(f'Pipeline [{name}] {stage_stats}')
+        if self._errors:
+            raise self._errors[0]
+        return self.stats
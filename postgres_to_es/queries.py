@@ -0,0 +1,214 @@
+from typing import Iterable, Iterator
+
+# shard_filter - условие на идентификатор документа (ShardCoordinator.shard_condition) или TRUE без шардирования.
+CHANGED_ITEMS_SQL = '''
+    SELECT id, modified
+    FROM content.{table_name}
+    WHERE (modified, id) > (%s, %s) AND modified < %s AND {shard_filter}
+    ORDER BY modified, id
+    LIMIT %s;
+'''
+
+RELATED_ITEMS_SQL = '''
+    SELECT mt.id, mt.modified
+    FROM content.{primary_table} mt
+    LEFT JOIN content.{join_table} rt ON rt.{join_column} = mt.id
+    WHERE rt.{filter_column} = ANY(%s) AND {shard_filter};
+'''
+
+# Каждая связь агрегируется отдельным подзапросом только по записям пачки, поэтому персоны и жанры фильма
+# не перемножаются. Списки упорядочены по jsonb-значению элемента, как при JSON_AGG(DISTINCT ...).
+# Имена сортируются по кодовым точкам (COLLATE "C"), как sorted() в dimensions.fill_movie_names, а не по правилам
+# сортировки базы, чтобы документы не зависели от того, каким путём они собраны.
+FILMWORKS_DETAILS_SQL = '''
+    WITH item_ids AS (
+        SELECT unnest(%s::uuid[]) AS id
+    )
+    SELECT
+        fw.id,
+        fw.title,
+        fw.description,
+        fw.rating AS imdb_rating,
+        film_genres.genres,
+        film_persons.directors,
+        film_persons.actors,
+        film_persons.writers,
+        film_persons.directors_names,
+        film_persons.actors_names,
+        film_persons.writers_names,
+        fw.creation_date
+    FROM content.film_work fw
+    LEFT JOIN (
+        SELECT film_work_id, JSON_AGG(genre ORDER BY genre) AS genres
+        FROM (
+            SELECT gfw.film_work_id, jsonb_build_object('id', g.id, 'name', g.name) AS genre
+            FROM content.genre_film_work gfw
+            JOIN content.genre g ON g.id = gfw.genre_id
+            WHERE gfw.film_work_id IN (SELECT id FROM item_ids)
+        ) AS genre_items
+        GROUP BY film_work_id
+    ) AS film_genres ON film_genres.film_work_id = fw.id
+    LEFT JOIN (
+        SELECT
+            film_work_id,
+            JSON_AGG(person ORDER BY person) FILTER (WHERE role = 'director') AS directors,
+            JSON_AGG(person ORDER BY person) FILTER (WHERE role = 'actor') AS actors,
+            JSON_AGG(person ORDER BY person) FILTER (WHERE role = 'writer') AS writers,
+            ARRAY_AGG(DISTINCT full_name COLLATE "C" ORDER BY full_name COLLATE "C")
+                FILTER (WHERE role = 'director') AS directors_names,
+            ARRAY_AGG(DISTINCT full_name COLLATE "C" ORDER BY full_name COLLATE "C")
+                FILTER (WHERE role = 'actor') AS actors_names,
+            ARRAY_AGG(DISTINCT full_name COLLATE "C" ORDER BY full_name COLLATE "C")
+                FILTER (WHERE role = 'writer') AS writers_names
+        FROM (
+            SELECT
+                pfw.film_work_id,
+                pfw.role,
+                p.full_name,
+                jsonb_build_object('id', p.id, 'name', p.full_name) AS person
+            FROM content.person_film_work pfw
+            JOIN content.person p ON p.id = pfw.person_id
+            WHERE pfw.film_work_id IN (SELECT id FROM item_ids)
+        ) AS person_items
+        GROUP BY film_work_id
+    ) AS film_persons ON film_persons.film_work_id = fw.id
+    WHERE fw.id IN (SELECT id FROM item_ids);
+'''
+
+# Только поля фильма и идентификаторы связей: названия жанров и имена персон подставляет dimensions.fill_movie_names.
+FILMWORKS_LINKS_SQL = '''
+    WITH item_ids AS (
+        SELECT unnest(%s::uuid[]) AS id
+    )
+    SELECT
+        fw.id,
+        fw.title,
+        fw.description,
+        fw.rating AS imdb_rating,
+        film_genres.genre_ids,
+        film_persons.person_ids,
+        film_persons.roles,
+        fw.creation_date
+    FROM content.film_work fw
+    LEFT JOIN (
+        SELECT film_work_id, ARRAY_AGG(genre_id) AS genre_ids
+        FROM content.genre_film_work
+        WHERE film_work_id IN (SELECT id FROM item_ids)
+        GROUP BY film_work_id
+    ) AS film_genres ON film_genres.film_work_id = fw.id
+    LEFT JOIN (
+        SELECT
+            film_work_id,
+            ARRAY_AGG(person_id ORDER BY person_id, role) AS person_ids,
+            ARRAY_AGG(role ORDER BY person_id, role) AS roles
+        FROM content.person_film_work
+        WHERE film_work_id IN (SELECT id FROM item_ids)
+        GROUP BY film_work_id
+    ) AS film_persons ON film_persons.film_work_id = fw.id
+    WHERE fw.id IN (SELECT id FROM item_ids);
+'''
+
+GENRES_DETAILS_SQL = '''
+    WITH item_ids AS (
+        SELECT unnest(%s::uuid[]) AS id
+    )
+    SELECT
+        g.id,
+        g.name,
+        g.description,
+        genre_films.films
+    FROM content.genre g
+    LEFT JOIN (
+        SELECT genre_id, JSON_AGG(film ORDER BY film) AS films
+        FROM (
+            SELECT gfw.genre_id, jsonb_build_object('id', fw.id, 'title', fw.title) AS film
+            FROM content.genre_film_work gfw
+            JOIN content.film_work fw ON fw.id = gfw.film_work_id
+            WHERE gfw.genre_id IN (SELECT id FROM item_ids)
+        ) AS film_items
+        GROUP BY genre_id
+    ) AS genre_films ON genre_films.genre_id = g.id
+    WHERE g.id IN (SELECT id FROM item_ids);
+'''
+
+PERSONS_DETAILS_SQL = '''
+    WITH item_ids AS (
+        SELECT unnest(%s::uuid[]) AS id
+    )
+    SELECT
+        p.id,
+        p.full_name AS name,
+        person_films.films
+    FROM content.person p
+    LEFT JOIN (
+        SELECT
+            film_roles.person_id,
+            JSON_AGG(
+                JSON_BUILD_OBJECT(
+                    'id', fw.id,
+                    'roles', film_roles.roles,
+                    'imdb_rating', fw.rating
+                )
+                ORDER BY fw.id
+            ) AS films
+        FROM (
+            SELECT pfw.person_id, pfw.film_work_id, ARRAY_AGG(pfw.role ORDER BY pfw.role) AS roles
+            FROM content.person_film_work pfw
+            WHERE pfw.person_id IN (SELECT id FROM item_ids)
+            GROUP BY pfw.person_id, pfw.film_work_id
+        ) AS film_roles
+        JOIN content.film_work fw ON fw.id = film_roles.film_work_id
+        GROUP BY film_roles.person_id
+    ) AS person_films ON person_films.person_id = p.id
+    WHERE p.id IN (SELECT id FROM item_ids);
+'''
+
+FILMWORKS_LIST_FIELDS = ('genres', 'directors_names', 'actors_names', 'writers_names', 'directors', 'actors', 'writers')
+GENRES_LIST_FIELDS = ('films',)
+PERSONS_LIST_FIELDS = ('films',)
+
+
+def fill_empty_lists(rows: Iterable[dict], fields: Iterable[str]) -> Iterator[dict]:
+    # JSON_AGG и ARRAY_AGG возвращают NULL, если агрегировать нечего.
+    fields = tuple(fields)
+    for row in rows:
+        for key in fields:
+            if row[key] is None:
+                row[key] = []
+        yield row
+
+
+def document_json_sql(details_sql: str, list_fields: Iterable[str]) -> str:
+    """
+    Оборачивает SQL трансформации так, чтобы PostgreSQL сам собрал тело документа в JSON (колонка source).
+
+    Пустые агрегаты заменяются на [] так же, как это делает fill_empty_lists.
+    """
+    source = 'to_jsonb(doc)'
+    if list_fields:
+        empty_lists = ', '.join(f"'{field}', COALESCE(to_jsonb(doc.{field}), '[]'::jsonb)" for field in list_fields)
+        source = f'{source} || jsonb_build_object({empty_lists})'
+    return f'''
+    SELECT doc.id, ({source})::text AS source
+    FROM ({details_sql.strip().rstrip(';')}) AS doc;
+'''
+
+
+ITEM_IDS_SQL = 'SELECT unnest(%s::uuid[]) AS id'
+
+
+def full_scan_sql(details_sql: str, root_table: str) -> str:
+    """
+    Превращает SQL трансформации пачки в запрос по всем записям root_table без параметров (например, для COPY).
+
+    Пачка задаётся CTE item_ids, поэтому достаточно заменить её на все идентификаторы таблицы: подзапросы связей
+    становятся полусоединениями со всей таблицей, и каждая таблица читается одним последовательным проходом.
+    """
+    if ITEM_IDS_SQL not in details_sql:
+        raise ValueError(f'Query has no {ITEM_IDS_SQL} batch to replace')
+    return details_sql.replace(ITEM_IDS_SQL, f'SELECT id FROM content.{root_table}').strip().rstrip(';')
+
+
+FILMWORKS_DOCUMENT_SQL = document_json_sql(FILMWORKS_DETAILS_SQL, FILMWORKS_LIST_FIELDS)
+GENRES_DOCUMENT_SQL = document_json_sql(GENRES_DETAILS_SQL, GENRES_LIST_FIELDS)
+PERSONS_DOCUMENT_SQL = document_json_sql(PERSONS_DETAILS_SQL, PERSONS_LIST_FIELDS)
@@ -0,0 +1,85 @@
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple, Type
+
+from psycopg import Cursor
+from pydantic import BaseModel
+
+from dimensions import fill_movie_names
+from queries import (
+    FILMWORKS_DETAILS_SQL, FILMWORKS_LINKS_SQL, GENRES_DETAILS_SQL, PERSONS_DETAILS_SQL,
+    FILMWORKS_DOCUMENT_SQL, GENRES_DOCUMENT_SQL, PERSONS_DOCUMENT_SQL,
+    FILMWORKS_LIST_FIELDS, GENRES_LIST_FIELDS, PERSONS_LIST_FIELDS)
+from state.models import Movie, Genre, Person
+
+
+@dataclass(frozen=True)
+class JoinPath:
+    """Связь через таблицу join_table: join_column ссылается на корневую таблицу, filter_column - на источник."""
+    join_table: str
+    join_column: str
+    filter_column: str
+
+
+@dataclass(frozen=True)
+class Source:
+    """Таблица, изменения которой затрагивают документы индекса. Без join_path это корневая таблица."""
+    table: str
+    join_path: Optional[JoinPath] = None
+
+
+@dataclass(frozen=True)
+class IndexSpec:
+    name: str
+    root_table: str
+    sources: Tuple[Source, ...]
+    details_sql: str
+    document_sql: str
+    list_fields: Tuple[str, ...]
+    model: Type[BaseModel]
+    # Запрос без соединения со справочниками и функция, которая достраивает по его строкам документы из кэша.
+    links_sql: Optional[str] = None
+    fill_names: Optional[Callable[[Cursor, Iterable[dict]], Iterator[dict]]] = None
+
+
+# Источники перечислены в порядке обработки. Контрольные точки хранятся по паре (индекс, таблица источника).
+INDEXES: Dict[str, IndexSpec] = {
+    'movies': IndexSpec(
+        name='movies',
+        root_table='film_work',
+        sources=(
+            Source('person', JoinPath('person_film_work', 'film_work_id', 'person_id')),
+            Source('genre', JoinPath('genre_film_work', 'film_work_id', 'genre_id')),
+            Source('film_work'),
+        ),
+        details_sql=FILMWORKS_DETAILS_SQL,
+        document_sql=FILMWORKS_DOCUMENT_SQL,
+        list_fields=FILMWORKS_LIST_FIELDS,
+        model=Movie,
+        links_sql=FILMWORKS_LINKS_SQL,
+        fill_names=fill_movie_names
+    ),
+    'genres': IndexSpec(
+        name='genres',
+        root_table='genre',
+        sources=(
+            Source('genre'),
+            Source('film_work', JoinPath('genre_film_work', 'genre_id', 'film_work_id')),
+        ),
+        details_sql=GENRES_DETAILS_SQL,
+        document_sql=GENRES_DOCUMENT_SQL,
+        list_fields=GENRES_LIST_FIELDS,
+        model=Genre
+    ),
+    'persons': IndexSpec(
+        name='persons',
+        root_table='person',
+        sources=(
+            Source('person'),
+            Source('film_work', JoinPath('person_film_work', 'person_id', 'film_work_id')),
+        ),
+        details_sql=PERSONS_DETAILS_SQL,
+        document_sql=PERSONS_DOCUMENT_SQL,
+        list_fields=PERSONS_LIST_FIELDS,
+        model=Person
+    ),
+}
@@ -0,0 +1,294 @@
+"""
+Полная переиндексация без простоя.
+
+Для каждого индекса создаётся новая версия (например, movies_v7) с маппингом текущего индекса или из файла
+--mapping-dir/<индекс>.json, с отключённым обновлением и без реплик. Документы загружаются в неё напрямую, затем
+восстанавливаются настройки, выполняется force merge, и алиас атомарно переключается на новую версию. Всё это время
+основной ETL продолжает писать изменения в живой индекс через алиас. Изменения, сделанные во время загрузки,
+догружаются в новую версию до и после переключения.
+
+С --output DIR Elasticsearch не используется: все документы индексов записываются файловым получателем в каталог
+DIR, откуда их потом можно загрузить в новую версию индекса скриптом replay.py.
+
+По умолчанию (--extract copy) все документы индекса читаются одним COPY ... TO STDOUT с телами, собранными
+PostgreSQL, и потоком передаются в загрузчик. С --extract batches документы строятся пачками по ETL_BATCH_SIZE
+идентификаторов, как в основном ETL.
+
+Запуск: python reindex.py [movies genres persons] [--mapping-dir DIR] [--keep-old] [--output DIR]
+[--extract copy|batches]
+"""
+import argparse
+import json
+import os
+import re
+from contextlib import nullcontext
+from datetime import datetime
+from functools import partial
+from typing import Optional
+
+import psycopg
+from elasticsearch import Elasticsearch
+from psycopg import ServerCursor
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row
+
+from file_sink import NdjsonFileSink
+from full_extract import copy_load
+from loader import BulkLoader, Sink
+from logger import logger
+from main import extract_changed_items, transform_data, update_from_sources, update_index
+from registry import INDEXES
+from settings import postgres_settings, elasticsearch_settings, etl_settings
+from state.checkpoints import Checkpoints, MIN_UUID
+from state.models import State
+from state.storages import get_storage
+
+# Настройки индекса, которые переносятся в новую версию. Остальные (uuid, creation_date и т.п.) задаёт кластер.
+COPIED_SETTINGS = ('number_of_shards', 'analysis', 'similarity', 'max_result_window')
+
+FORCE_MERGE_TIMEOUT = 3600
+
+
+def get_live_indices(es_client: Elasticsearch, alias: str) -> list:
+    """Возвращает индексы за алиасом или сам индекс, если он создан без алиаса."""
+    if es_client.indices.exists_alias(name=alias):
+        return list(es_client.indices.get_alias(name=alias))
+    if es_client.indices.exists(index=alias):
+        return [alias]
+    return []
+
+
+def next_version_name(es_client: Elasticsearch, alias: str) -> str:
+    versions = [
+        int(match.group(1))
+        for name in es_client.indices.get(index=f'{alias}_v*', expand_wildcards='all')
+        if (match := re.fullmatch(rf'{re.escape(alias)}_v(\d+)', name))
+    ]
+    return f'{alias}_v{max(versions, default=0) + 1}'
+
+
+def get_index_definition(
+        es_client: Elasticsearch,
+        alias: str,
+        live_indices: list,
+        mapping_dir: Optional[str]
+) -> dict:
+    if mapping_dir is not None:
+        with open(os.path.join(mapping_dir, f'{alias}.json')) as mapping_file:
+            definition = json.load(mapping_file)
+        settings = definition.get('settings', {})
+        return {'settings': settings.get('index', settings), 'mappings': definition['mappings']}
+
+    if not live_indices:
+        raise ValueError(f'Index {alias} does not exist, pass --mapping-dir to create it')
+    live = es_client.indices.get(index=live_indices[0])[live_indices[0]]
+    settings = live['settings']['index']
+    return {
+        'settings': {
+            **{key: settings[key] for key in COPIED_SETTINGS if key in settings},
+            'refresh_interval': settings.get('refresh_interval', '1s'),
+            'number_of_replicas': settings.get('number_of_replicas', '1'),
+        },
+        'mappings': live['mappings'],
+    }
+
+
+def load_all(
+        cursor: ServerCursor,
+        loader: Sink,
+        alias: str,
+        target: str,
+        end_updated: datetime,
+        extract: str = 'copy'
+) -> int:
+    index = INDEXES[alias]
+    if extract == 'copy':
+        return copy_load(
+            conn=cursor.connection,
+            loader=loader,
+            index=index,
+            target=target,
+            logger=logger,
+            validation_sample_rate=etl_settings.validation_sample_rate
+        )
+    changed_items = extract_changed_items(
+        cursor=cursor,
+        table_name=index.root_table,
+        start_after=(datetime.min, MIN_UUID),
+        end_updated=end_updated
+    )
+    return update_index(
+        cursor=cursor,
+        loader=loader,
+        changed_batches=((ids, None) for ids, _ in changed_items),
+        transform=partial(transform_data, index=index),
+        index=target,
+        model=index.model
+    )
+
+
+def catch_up(
+        cursor: ServerCursor,
+        loader: Sink,
+        state: State,
+        alias: str,
+        target: str,
+        since: datetime
+) -> datetime:
+    """Догружает в target документы индекса alias, изменившиеся с момента since. Возвращает конец окна."""
+    until = datetime.now()
+    checkpoints = Checkpoints(states=[state], last_updated=since)
+    processed = update_from_sources(
+        cursor=cursor,
+        loader=loader,
+        index=INDEXES[alias],
+        checkpoints=checkpoints,
+        end_updated=until,
+        target_index=target
+    )
+    checkpoints.reset()
+    logger.info(f'Caught up {processed} {alias} documents changed since {since} into {target}')
+    return until
+
+
+def swap_alias(es_client: Elasticsearch, alias: str, live_indices: list, target: str) -> None:
+    actions = [{'add': {'index': target, 'alias': alias, 'is_write_index': True}}]
+    for index in live_indices:
+        if index == alias:
+            # Индекс, созданный без алиаса, удаляется в том же атомарном действии, иначе имя алиаса занято.
+            actions.append({'remove_index': {'index': index}})
+        else:
+            actions.append({'remove': {'index': index, 'alias': alias}})
+    es_client.indices.update_aliases(actions=actions)
+    logger.info(f'Alias {alias} switched from {live_indices} to {target}')
+
+
+def reindex(
+        conn: psycopg.Connection,
+        cursor: ServerCursor,
+        es_client: Elasticsearch,
+        loader: BulkLoader,
+        state: State,
+        alias: str,
+        mapping_dir: Optional[str] = None,
+        keep_old: bool = False,
+        extract: str = 'copy'
+) -> None:
+    live_indices = get_live_indices(es_client, alias)
+    definition = get_index_definition(es_client, alias, live_indices, mapping_dir)
+    target = next_version_name(es_client, alias)
+
+    es_client.indices.create(
+        index=target,
+        settings={**definition['settings'], 'refresh_interval': '-1', 'number_of_replicas': 0},
+        mappings=definition['mappings']
+    )
+    logger.info(f'Created index {target} for {alias}')
+
+    started = datetime.now()
+    processed = load_all(
+        cursor=cursor, loader=loader, alias=alias, target=target, end_updated=started, extract=extract
+    )
+    conn.commit()
+    logger.info(f'Loaded {processed} documents into {target}')
+    since = catch_up(cursor=cursor, loader=loader, state=state, alias=alias, target=target, since=started)
+    conn.commit()
+
+    es_client.indices.put_settings(
+        index=target,
+        settings={
+            'refresh_interval': definition['settings'].get('refresh_interval', '1s'),
+            'number_of_replicas': definition['settings'].get('number_of_replicas', '1'),
+        }
+    )
+    es_client.indices.refresh(index=target)
+    es_client.options(request_timeout=FORCE_MERGE_TIMEOUT).indices.forcemerge(index=target, max_num_segments=1)
+
+    swap_alias(es_client, alias, live_indices, target)
+    # Изменения, загруженные основным ETL в старую версию между догрузкой и переключением.
+    catch_up(cursor=cursor, loader=loader, state=state, alias=alias, target=alias, since=since)
+    conn.commit()
+
+    if not keep_old:
+        old_indices = [index for index in live_indices if index != alias]
+        if old_indices:
+            es_client.indices.delete(index=old_indices)
+            logger.info(f'Deleted old indices {old_indices}')
+
+
+def export(indexes: list, directory: str, extract: str = 'copy') -> None:
+    dsn = make_conninfo(**postgres_settings.dict())
+    with (psycopg.connect(dsn, row_factory=dict_row) as conn,
+          ServerCursor(conn, 'reindex') as cur,
+          NdjsonFileSink(
+              directory=directory,
+              logger=logger,
+              compression=etl_settings.sink_compression,
+              max_file_bytes=etl_settings.sink_max_file_bytes
+          ) as sink):
+        cur.itersize = etl_settings.cursor_itersize
+        for alias in indexes:
+            processed = load_all(
+                cursor=cur, loader=sink, alias=alias, target=alias, end_updated=datetime.now(), extract=extract
+            )
+            conn.commit()
+            logger.info(f'Exported {processed} {alias} documents to {directory}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('indexes', nargs='*', choices=list(INDEXES), default=list(INDEXES))
+    parser.add_argument('--mapping-dir', help='directory with <index>.json index definitions')
+    parser.add_argument('--keep-old', action='store_true', help='keep previous index versions after the swap')
+    parser.add_argument('--output', help='write documents to NDJSON files in this directory instead of Elasticsearch')
+    parser.add_argument(
+        '--extract', choices=('copy', 'batches'), default='copy',
+        help='read all documents with one COPY per index or in batches of ids'
+    )
+    args = parser.parse_args()
+    if args.output is not None:
+        export(indexes=args.indexes, directory=args.output, extract=args.extract)
+        return
+
+    es_client = Elasticsearch(hosts=elasticsearch_settings.hosts)
+    loader = BulkLoader(
+        es_client=es_client,
+        logger=logger,
+        min_chunk_bytes=etl_settings.bulk_min_chunk_bytes,
+        max_chunk_bytes=etl_settings.bulk_max_chunk_bytes,
+        target_latency=etl_settings.bulk_target_latency
+    )
+    if args.keep_old:
+        # Индекс без алиаса занимает имя алиаса и удаляется при переключении (swap_alias), сохранить его нельзя.
+        concrete = [alias for alias in args.indexes if alias in get_live_indices(es_client, alias)]
+        if concrete:
+            parser.error(
+                f'{", ".join(concrete)} are concrete indices, not aliases, and are deleted when the alias is '
+                f'switched. Run without --keep-old or snapshot them first'
+            )
+    dsn = make_conninfo(**postgres_settings.dict())
+    os.makedirs(etl_settings.state_dir, exist_ok=True)
+
+    separate_state_conn = etl_settings.state_storage == 'postgres'
+
+    with (psycopg.connect(dsn, row_factory=dict_row) as conn,
+          psycopg.connect(dsn, autocommit=True) if separate_state_conn else nullcontext() as state_conn,
+          ServerCursor(conn, 'reindex') as cur):
+        cur.itersize = etl_settings.cursor_itersize
+        for alias in args.indexes:
+            state = State(get_storage(name=f'reindex.{alias}', directory=etl_settings.state_dir, conn=state_conn))
+            reindex(
+                conn=conn,
+                cursor=cur,
+                es_client=es_client,
+                loader=loader,
+                state=state,
+                alias=alias,
+                mapping_dir=args.mapping_dir,
+                keep_old=args.keep_old,
+                extract=args.extract
+            )
+
+
+if __name__ == '__main__':
+    main()
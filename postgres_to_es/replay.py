@@ -0,0 +1,268 @@
+"""
+Загружает в Elasticsearch файлы NDJSON, записанные файловым получателем (ETL_SINK=file или reindex.py --output).
+
+Файлы читаются через mmap и распаковываются потоково, каждый индекс читается в своём потоке в порядке имён
+файлов. Действия распределяются между --workers потоками загрузки по хэшу идентификатора документа, поэтому
+версии одного документа загружаются в том порядке, в котором записаны. Внутри пачки потока загрузки из нескольких
+версий документа отправляется только последняя. Оборванный хвост файла упавшего писателя пропускается
+с предупреждением. --index SOURCE=TARGET загружает действия индекса SOURCE в индекс TARGET.
+
+Запуск: python replay.py PATH [PATH ...] [--workers 4] [--index movies=movies_v3] [--chunk-bytes BYTES]
+"""
+import argparse
+import gzip
+import io
+import mmap
+import os
+import queue
+import threading
+from collections import defaultdict
+from itertools import groupby
+from logging import Logger
+from time import monotonic
+from typing import Dict, Iterator, List, Optional
+
+import orjson
+import zstandard
+from elasticsearch import Elasticsearch
+
+from file_sink import COMPRESSIONS, finalize_abandoned
+from loader import ACTION_OVERHEAD_BYTES, BulkLoader
+from logger import logger
+from settings import elasticsearch_settings, etl_settings
+
+# Сколько действий поток чтения передаёт потоку загрузки за раз.
+HANDOFF_SIZE = 1000
+READ_BUFFER_BYTES = 1024 * 1024
+
+_STOP = object()
+
+
+def list_files(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for root, _, names in os.walk(path):
+            files.extend(
+                os.path.join(root, name) for name in names if name.endswith(tuple(COMPRESSIONS.values()))
+            )
+    return sorted(files, key=lambda file_path: (os.path.dirname(file_path), os.path.basename(file_path)))
+
+
+def open_stream(mapped: mmap.mmap, path: str):
+    if path.endswith(COMPRESSIONS['zstd']):
+        reader = zstandard.ZstdDecompressor().stream_reader(mapped, read_across_frames=True, closefd=False)
+        return io.BufferedReader(reader, buffer_size=READ_BUFFER_BYTES)
+    if path.endswith(COMPRESSIONS['gzip']):
+        return gzip.GzipFile(fileobj=mapped, mode='rb')
+    return mapped
+
+
+def to_action(header: dict, body: bytes) -> dict:
+    """Обратное преобразование к expand_action: служебная строка и тело в действие elasticsearch.helpers.bulk."""
+    (op_type, meta), = header.items()
+    action = {'_op_type': op_type, **meta}
+    if op_type == 'update':
+        action.update(orjson.loads(body))
+    elif op_type != 'delete':
+        action['_source'] = body
+    return action
+
+
+def read_actions(path: str, logger: Logger) -> Iterator[dict]:
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            stream = open_stream(mapped, path)
+            try:
+                while line := stream.readline():
+                    if not line.endswith(b'\n'):
+                        raise EOFError('incomplete action line')
+                    header = orjson.loads(line)
+                    body = None
+                    if 'delete' not in header:
+                        body = stream.readline()
+                        if not body.endswith(b'\n'):
+                            raise EOFError('incomplete document line')
+                        body = body[:-1]
+                    yield to_action(header, body)
+            except (EOFError, zstandard.ZstdError) as e:
+                logger.warning(f'File {path} is truncated ({str(e)}), the rest of it is skipped')
+            finally:
+                if stream is not mapped:
+                    stream.close()
+
+
+class Replayer:
+    """
+    Читает файлы NDJSON и загружает действия через BulkLoader в workers потоков.
+
+    Потоки связаны ограниченными очередями, поэтому чтение не обгоняет загрузку больше чем на queue_size передач
+    на поток. Каждый поток копит действия по индексам и отправляет их, когда пачка индекса превышает chunk_bytes.
+    """
+
+    def __init__(
+        self,
+        loader: BulkLoader,
+        logger: Logger,
+        workers: int = 4,
+        chunk_bytes: int = 10 * 1024 * 1024,
+        index_map: Optional[Dict[str, str]] = None,
+        queue_size: int = 4
+    ):
+        self.loader = loader
+        self.workers = workers
+        self.chunk_bytes = chunk_bytes
+        self.index_map = index_map or {}
+        self.queue_size = queue_size
+        self._logger = logger
+        self._errors: List[BaseException] = []
+        self._stop = threading.Event()
+        self._loaded = [0] * workers
+
+    def _put(self, target: queue.Queue, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source: queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return _STOP
+
+    def _fail(self, error: BaseException) -> None:
+        self._errors.append(error)
+        self._stop.set()
+
+    def _read(self, files: List[str], outputs: List[queue.Queue]) -> None:
+        try:
+            for path in files:
+                handoff = [[] for _ in outputs]
+                for action in read_actions(path, self._logger):
+                    action['_index'] = self.index_map.get(action['_index'], action['_index'])
+                    worker = hash(action['_id']) % len(outputs)
+                    handoff[worker].append(action)
+                    if len(handoff[worker]) >= HANDOFF_SIZE:
+                        if not self._put(outputs[worker], handoff[worker]):
+                            return
+                        handoff[worker] = []
+                for worker, actions in enumerate(handoff):
+                    if actions and not self._put(outputs[worker], actions):
+                        return
+                self._logger.info(f'Read file {path}')
+        except Exception as e:
+            self._fail(e)
+
+    def _flush(self, worker: int, index: str, pending: Dict[str, dict]) -> None:
+        self.loader.load(list(pending.values()), index=index)
+        self._loaded[worker] += len(pending)
+        pending.clear()
+
+    def _load_worker(self, worker: int, source: queue.Queue) -> None:
+        # По индексам: идентификатор документа -> последнее действие с ним и размер пачки в байтах.
+        pending: Dict[str, Dict[str, dict]] = defaultdict(dict)
+        sizes: Dict[str, int] = defaultdict(int)
+        try:
+            while (actions := self._get(source)) is not _STOP:
+                for action in actions:
+                    index, index_pending = action['_index'], pending[action['_index']]
+                    # Частичное обновление применяется к предыдущей версии документа, её нужно отправить раньше.
+                    if action['_op_type'] == 'update' and action['_id'] in index_pending:
+                        self._flush(worker, index, index_pending)
+                        sizes[index] = 0
+                    index_pending[action['_id']] = action
+                    sizes[index] += ACTION_OVERHEAD_BYTES + len(action.get('_source') or b'')
+                    if sizes[index] >= self.chunk_bytes:
+                        self._flush(worker, index, index_pending)
+                        sizes[index] = 0
+            if self._stop.is_set():
+                return
+            for index, index_pending in pending.items():
+                if index_pending:
+                    self._flush(worker, index, index_pending)
+        except Exception as e:
+            self._fail(e)
+
+    def run(self, files: List[str]) -> int:
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        loaders = [
+            threading.Thread(target=self._load_worker, args=(worker, queues[worker]), daemon=True)
+            for worker in range(self.workers)
+        ]
+        # Файлы разных индексов читаются параллельно, файлы одного индекса - по порядку.
+        readers = [
+            threading.Thread(target=self._read, args=(list(index_files), queues), daemon=True)
+            for _, index_files in groupby(files, key=os.path.dirname)
+        ]
+        for thread in loaders + readers:
+            thread.start()
+        for thread in readers:
+            thread.join()
+        for worker_queue in queues:
+            self._put(worker_queue, _STOP)
+        for thread in loaders:
+            thread.join()
+
+        if self._errors:
+            raise self._errors[0]
+        return sum(self._loaded)
+
+
+def parse_index_map(pairs: List[str]) -> Dict[str, str]:
+    index_map = {}
+    for pair in pairs:
+        source, separator, target = pair.partition('=')
+        if not separator or not source or not target:
+            raise argparse.ArgumentTypeError(f'Expected SOURCE=TARGET, got {pair}')
+        index_map[source] = target
+    return index_map
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='+', help='files or directories written by the file sink')
+    parser.add_argument('--workers', type=int, default=etl_settings.load_workers * 2)
+    parser.add_argument('--chunk-bytes', type=int, default=etl_settings.bulk_max_chunk_bytes)
+    parser.add_argument('--index', action='append', default=[], help='SOURCE=TARGET, may be repeated')
+    args = parser.parse_args()
+
+    for path in args.paths:
+        if os.path.isdir(path):
+            finalize_abandoned(path, logger)
+    files = list_files(args.paths)
+
+    loader = BulkLoader(
+        es_client=Elasticsearch(hosts=elasticsearch_settings.hosts),
+        logger=logger,
+        min_chunk_bytes=etl_settings.bulk_min_chunk_bytes,
+        max_chunk_bytes=etl_settings.bulk_max_chunk_bytes,
+        target_latency=etl_settings.bulk_target_latency
+    )
+    replayer = Replayer(
+        loader=loader,
+        logger=logger,
+        workers=args.workers,
+        chunk_bytes=args.chunk_bytes,
+        index_map=parse_index_map(args.index)
+    )
+    started = monotonic()
+    loaded = replayer.run(files)
+    elapsed = monotonic() - started
+    logger.info(
+        f'Replayed {loaded} actions from {len(files)} files in {elapsed:.1f} s '
+        f'({loaded / max(elapsed, 0.001):.0f} actions/s)'
+    )
+
+
+if __name__ == '__main__':
+    main()
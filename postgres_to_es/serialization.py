@@ -0,0 +1,45 @@
+import random
+from logging import Logger
+from typing import Optional, Type, Union
+
+import orjson
+from pydantic import BaseModel, ValidationError
+
+SERIALIZATION_MODES = ('pydantic', 'orjson', 'raw')
+
+
+class DocumentSerializer:
+    """
+    Превращает строку результата трансформации в тело документа для Elasticsearch.
+
+    Режимы:
+    - pydantic: полная валидация каждой строки моделью документа и дамп через pydantic;
+    - orjson: строка сериализуется orjson как есть;
+    - raw: тело документа уже собрано PostgreSQL в колонке source и передаётся без изменений.
+
+    В режимах orjson и raw моделью проверяется только доля документов validation_sample_rate (в отладке - все).
+    Документ, не прошедший проверку, пишется в лог и не отправляется в индекс.
+    """
+
+    def __init__(self, logger: Logger, mode: str = 'pydantic', validation_sample_rate: float = 0.01):
+        if mode not in SERIALIZATION_MODES:
+            raise ValueError(f'Unknown serialization mode {mode}, expected one of {SERIALIZATION_MODES}')
+        self.mode = mode
+        self.validation_sample_rate = validation_sample_rate
+        self._logger = logger
+
+    def _should_validate(self) -> bool:
+        return self.validation_sample_rate >= 1 or random.random() < self.validation_sample_rate
+
+    def serialize(self, row: dict, model: Type[BaseModel]) -> Optional[Union[str, bytes]]:
+        if self.mode == 'pydantic':
+            return model(**dict(row)).json()
+
+        source = row['source'] if self.mode == 'raw' else orjson.dumps(row)
+        if self._should_validate():
+            try:
+                model.model_validate_json(source)
+            except ValidationError as e:
+                self._logger.error(f'Document {row["id"]} does not match {model.__name__}: {str(e)}')
+                return None
+        return source
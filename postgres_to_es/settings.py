@@ -1,4 +1,6 @@
 import os
+from typing import Optional
+
 from dotenv import load_dotenv
 
 from pydantic_settings import BaseSettings
@@ -18,5 +20,55 @@ class ElasticsearchSettings(BaseSettings):
     hosts: str = f"{os.environ.get('ETL_ELASTICSEARCH_URL')}"
 
 
+class EtlSettings(BaseSettings):
+    batch_size: int = int(os.environ.get('ETL_BATCH_SIZE', 100))
+    transform_batch_size: int = int(os.environ.get('ETL_TRANSFORM_BATCH_SIZE', os.environ.get('ETL_BATCH_SIZE', 100)))
+    cursor_itersize: int = int(os.environ.get('ETL_CURSOR_ITERSIZE', 100))
+    pool_min_size: int = int(os.environ.get('ETL_POOL_MIN_SIZE', 2))
+    pool_max_size: int = int(os.environ.get('ETL_POOL_MAX_SIZE', 10))
+    pool_max_idle: float = float(os.environ.get('ETL_POOL_MAX_IDLE', 600.0))
+    pool_timeout: float = float(os.environ.get('ETL_POOL_TIMEOUT', 30.0))
+    cycle_retries: int = int(os.environ.get('ETL_CYCLE_RETRIES', 5))
+    catch_up_threshold: int = int(os.environ.get('ETL_CATCH_UP_THRESHOLD', 100_000))
+    catch_up_slice_rows: int = int(os.environ.get('ETL_CATCH_UP_SLICE_ROWS', 50_000))
+    catch_up_workers: int = int(os.environ.get('ETL_CATCH_UP_WORKERS', 4))
+    catch_up_min_lag: float = float(os.environ.get('ETL_CATCH_UP_MIN_LAG', 300.0))
+    latency_batch_size: int = int(os.environ.get('ETL_LATENCY_BATCH_SIZE', 10))
+    dedup_max_in_memory: int = int(os.environ.get('ETL_DEDUP_MAX_IN_MEMORY', 1_000_000))
+    dedup_spill_dir: Optional[str] = os.environ.get('ETL_DEDUP_SPILL_DIR')
+    change_source: str = os.environ.get('ETL_CHANGE_SOURCE', 'modified')
+    change_log_batch_size: int = int(os.environ.get('ETL_CHANGE_LOG_BATCH_SIZE', 1000))
+    notify_channel: str = os.environ.get('ETL_NOTIFY_CHANNEL', 'etl_changes')
+    notify_debounce: float = float(os.environ.get('ETL_NOTIFY_DEBOUNCE', 0.2))
+    notify_max_debounce: float = float(os.environ.get('ETL_NOTIFY_MAX_DEBOUNCE', 1.0))
+    poll_interval_min: float = float(os.environ.get('ETL_POLL_INTERVAL_MIN', 1.0))
+    poll_interval_max: float = float(os.environ.get('ETL_POLL_INTERVAL_MAX', 60.0))
+    pipeline_enabled: bool = os.environ.get('ETL_PIPELINE', 'false').lower() == 'true'
+    transform_workers: int = int(os.environ.get('ETL_TRANSFORM_WORKERS', 2))
+    load_workers: int = int(os.environ.get('ETL_LOAD_WORKERS', 2))
+    pipeline_queue_size: int = int(os.environ.get('ETL_PIPELINE_QUEUE_SIZE', 4))
+    async_max_in_flight_bulks: int = int(os.environ.get('ETL_ASYNC_MAX_IN_FLIGHT_BULKS', 4))
+    state_storage: str = os.environ.get('ETL_STATE_STORAGE', 'json')
+    state_dir: str = os.environ.get('ETL_STATE_DIR', 'data')
+    hash_storage: str = os.environ.get('ETL_HASH_STORAGE', 'none')
+    partial_updates: bool = os.environ.get('ETL_PARTIAL_UPDATES', 'false').lower() == 'true'
+    dimension_cache_size: int = int(os.environ.get('ETL_DIMENSION_CACHE_SIZE', 100_000))
+    dimension_cache_ttl: float = float(os.environ.get('ETL_DIMENSION_CACHE_TTL', 600.0))
+    shard_count: int = int(os.environ.get('ETL_SHARD_COUNT', 1))
+    shard_state_dir: str = os.environ.get('ETL_SHARD_STATE_DIR', 'shards')
+    sink: str = os.environ.get('ETL_SINK', 'elasticsearch')
+    sink_dir: str = os.environ.get('ETL_SINK_DIR', 'export')
+    sink_compression: str = os.environ.get('ETL_SINK_COMPRESSION', 'zstd')
+    sink_max_file_bytes: int = int(os.environ.get('ETL_SINK_MAX_FILE_BYTES', 256 * 1024 * 1024))
+    bulk_min_chunk_bytes: int = int(os.environ.get('ETL_BULK_MIN_CHUNK_BYTES', 256 * 1024))
+    bulk_max_chunk_bytes: int = int(os.environ.get('ETL_BULK_MAX_CHUNK_BYTES', 10 * 1024 * 1024))
+    bulk_target_latency: float = float(os.environ.get('ETL_BULK_TARGET_LATENCY', 1.0))
+    serialization: str = os.environ.get('ETL_SERIALIZATION', 'pydantic')
+    validation_sample_rate: float = float(os.environ.get('ETL_VALIDATION_SAMPLE_RATE', 0.01))
+    metrics_port: int = int(os.environ.get('ETL_METRICS_PORT', 8000))
+    debug: bool = os.environ.get('ETL_DEBUG', 'false').lower() == 'true'
+
+
 postgres_settings = PostgresSettings()
 elasticsearch_settings = ElasticsearchSettings()
+etl_settings = EtlSettings()
@@ -0,0 +1,116 @@
+import math
+import uuid
+from logging import Logger
+from typing import Iterable, Optional, Set
+
+import psycopg
+
+# Пространства ключей advisory-блокировок (первый int4-ключ): блокировки шардов и регистрация живых воркеров.
+SHARD_LOCK_NAMESPACE = 0x65746c
+WORKER_LOCK_NAMESPACE = SHARD_LOCK_NAMESPACE + 1
+
+COUNT_WORKERS_SQL = '''
+    SELECT count(DISTINCT pid)
+    FROM pg_locks
+    WHERE locktype = 'advisory' AND classid::bigint = %s AND objsubid = 2 AND granted;
+'''
+
+# Восемь шестнадцатеричных цифр uuid с позиции start как беззнаковое 32-битное число.
+UUID_PART_SQL = "('x' || substr(replace({column}::text, '-', ''), {start}, 8))::bit(32)::bigint"
+
+
+class ShardCoordinator:
+    """
+    Распределяет шарды пространства идентификаторов между воркерами ETL через advisory-блокировки PostgreSQL.
+
+    Документ относится к шарду uuid.int % shard_count, то же условие PostgreSQL проверяет в запросах изменений
+    (shard_condition), поэтому воркер читает только идентификаторы своих шардов. Каждый воркер держит сессионную
+    блокировку на каждый свой шард и блокировку-регистрацию на себя, по числу которых считается справедливая доля
+    шардов. Лишние шарды воркер отпускает, свободные забирает. Если воркер падает, PostgreSQL снимает его
+    блокировки вместе с сессией, и шарды разбирают остальные при следующем вызове rebalance.
+
+    Если оборвалось собственное соединение координатора, его блокировки сняты вместе с сессией: rebalance
+    подключается заново, снова регистрирует воркер и разбирает шарды с пустого набора.
+    """
+
+    def __init__(self, dsn: str, shard_count: int, logger: Logger):
+        self.dsn = dsn
+        self.shard_count = shard_count
+        self.shards: Set[int] = set()
+        self._logger = logger
+        self._conn: Optional[psycopg.Connection] = None
+
+    def __enter__(self):
+        self._connect()
+        return self
+
+    def _connect(self) -> None:
+        self.shards.clear()
+        self._conn = psycopg.connect(self.dsn, autocommit=True)
+        self._conn.execute(
+            'SELECT pg_advisory_lock(%s, pg_backend_pid());',
+            (WORKER_LOCK_NAMESPACE,)
+        )
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._conn.close()
+        self.shards.clear()
+
+    def _try_lock(self, shard: int) -> bool:
+        return self._conn.execute(
+            'SELECT pg_try_advisory_lock(%s, %s);',
+            (SHARD_LOCK_NAMESPACE, shard)
+        ).fetchone()[0]
+
+    def _unlock(self, shard: int) -> None:
+        self._conn.execute('SELECT pg_advisory_unlock(%s, %s);', (SHARD_LOCK_NAMESPACE, shard))
+
+    def rebalance(self) -> Set[int]:
+        if self._conn.closed:
+            self._connect()
+        try:
+            return self._rebalance()
+        except psycopg.OperationalError as e:
+            self._logger.warning(f'Shard coordinator connection lost, reacquiring shards. Error: {str(e)}')
+            self._conn.close()
+            self._connect()
+            return self._rebalance()
+
+    def _rebalance(self) -> Set[int]:
+        workers = self._conn.execute(COUNT_WORKERS_SQL, (WORKER_LOCK_NAMESPACE,)).fetchone()[0]
+        fair_share = math.ceil(self.shard_count / max(workers, 1))
+        previous_shards = set(self.shards)
+
+        for shard in sorted(self.shards, reverse=True)[:max(len(self.shards) - fair_share, 0)]:
+            self._unlock(shard)
+            self.shards.discard(shard)
+
+        for shard in range(self.shard_count):
+            if len(self.shards) >= fair_share:
+                break
+            if shard not in self.shards and self._try_lock(shard):
+                self.shards.add(shard)
+
+        if self.shards != previous_shards:
+            self._logger.info(
+                f'Shards rebalanced across {workers} workers: now owning {sorted(self.shards)} '
+                f'of {self.shard_count}'
+            )
+        return self.shards
+
+    def shard_of(self, item_id: uuid.UUID) -> int:
+        return item_id.int % self.shard_count
+
+    def shard_condition(self, column: str, shards: Iterable[int]) -> str:
+        """
+        SQL-условие "идентификатор в column относится к одному из шардов shards".
+
+        uuid.int % shard_count считается по четырём 32-битным частям uuid: a * 2^96 + b * 2^64 + c * 2^32 + d
+        по модулю shard_count равно сумме частей с весами 2^k % shard_count, и сумма помещается в bigint.
+        """
+        terms = ' + '.join(
+            f'{UUID_PART_SQL.format(column=column, start=part * 8 + 1)} * {pow(2, 96 - part * 32, self.shard_count)}'
+            for part in range(4)
+        )
+        # mod() вместо оператора %: условие подставляется в запросы с параметрами %s.
+        return f'mod({terms}, {self.shard_count}) = ANY(ARRAY[{", ".join(str(shard) for shard in sorted(shards))}])'
@@ -1,11 +1,47 @@
 import abc
+import copy
+import threading
+from typing import Any, Optional
 
 
 class BaseStorage:
+    """
+    Хранилище состояния с кэшем в памяти.
+
+    Состояние читается из хранилища один раз, дальше get_state отдаёт его из кэша. Запись сквозная: кэш
+    обновляется только после того, как состояние сохранено в хранилище.
+    """
+
+    def __init__(self):
+        self._cache: Optional[dict] = None
+        self._lock = threading.RLock()
+
     @abc.abstractmethod
-    def save_state(self, state: dict) -> None:
+    def _read_state(self) -> dict:
         ...
 
     @abc.abstractmethod
+    def _write_state(self, state: dict) -> None:
+        ...
+
+    def save_state(self, state: dict) -> None:
+        with self._lock:
+            self._write_state(state)
+            self._cache = copy.deepcopy(state)
+
+    def cached_state(self) -> dict:
+        """Состояние из кэша без обращения к хранилищу: пустое, пока оно не прочитано. Кэш не менять."""
+        # Кэш не изменяется на месте, а заменяется целиком, поэтому ссылку можно взять без блокировки.
+        return self._cache or {}
+
     def retrieve_state(self) -> dict:
-        ...
\ No newline at end of file
+        with self._lock:
+            if self._cache is None:
+                self._cache = self._read_state()
+            return copy.deepcopy(self._cache)
+
+    def update_state(self, key: str, value: Any) -> None:
+        with self._lock:
+            state = self.retrieve_state()
+            state[key] = value
+            self.save_state(state)
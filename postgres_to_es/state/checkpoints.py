@@ -0,0 +1,76 @@
+import threading
+import uuid
+from datetime import datetime
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .models import State
+
+MIN_UUID = uuid.UUID(int=0)
+
+Position = Tuple[datetime, uuid.UUID]
+
+
+class Checkpoints:
+    """
+    Позиции (modified, id), до которых продюсеры обработали изменения в текущем окне.
+
+    Продюсер - пара (индекс, таблица-источник), например movies:person - фильмы, изменившиеся из-за персон.
+    Идентификаторы документов, затронутых всеми продюсерами индекса, сначала собираются, а затем загружаются
+    пачками по возрастанию. Пока они загружаются, позиция индекса index:pending хранит конец окна, до которого
+    собраны изменения, и последний загруженный идентификатор. Позиции продюсеров фиксируются, когда загружено всё.
+    После падения цикл дозагружает собранное окно с места остановки. Когда окно обработано целиком, позиции
+    сбрасываются, и следующий цикл начинается с last_update.
+    """
+
+    STATE_KEY = 'checkpoints'
+    PENDING = 'pending'
+
+    def __init__(self, states: List[State], last_updated: datetime):
+        self.states = states
+        self.last_updated = last_updated
+        self._positions = dict(states[0].get_state(self.STATE_KEY) or {})
+        self._lock = threading.Lock()
+
+    def start_after(self, index: str, table_name: str) -> Position:
+        position = self._positions.get(f'{index}:{table_name}')
+        if position is None:
+            return self.last_updated, MIN_UUID
+        return datetime.fromisoformat(position['modified']), uuid.UUID(position['id'])
+
+    def pending(self, index: str) -> Optional[Position]:
+        """Возвращает конец недозагруженного окна индекса и последний загруженный идентификатор."""
+        position = self._positions.get(f'{index}:{self.PENDING}')
+        if position is None:
+            return None
+        return datetime.fromisoformat(position['modified']), uuid.UUID(position['id'])
+
+    @staticmethod
+    def _serialize(position: Position) -> dict:
+        modified, item_id = position
+        return {'modified': modified.isoformat(), 'id': str(item_id)}
+
+    def _save(self) -> None:
+        for state in self.states:
+            state.set_state(self.STATE_KEY, self._positions)
+
+    def commit(self, key: str, position: Position) -> None:
+        with self._lock:
+            self._positions[key] = self._serialize(position)
+            self._save()
+
+    def committer(self, index: str, table_name: str, position: Position) -> Callable[[], None]:
+        return partial(self.commit, f'{index}:{table_name}', position)
+
+    def complete(self, index: str, positions: Dict[str, Position]) -> None:
+        """Одной записью фиксирует позиции продюсеров индекса и снимает отметку о недозагруженном окне."""
+        with self._lock:
+            self._positions.pop(f'{index}:{self.PENDING}', None)
+            for table_name, position in positions.items():
+                self._positions[f'{index}:{table_name}'] = self._serialize(position)
+            self._save()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._positions = {}
+            self._save()
@@ -1,29 +1,57 @@
 import json
+import os
+import tempfile
 from json import JSONDecodeError
 from logging import Logger
 from typing import Optional
-from datetime import datetime
 
 from .base_storage import BaseStorage
 
 
 class JsonFileStorage(BaseStorage):
+    """
+    Состояние в JSON-файле.
+
+    Файл записывается атомарно: состояние пишется во временный файл в том же каталоге, сбрасывается на диск
+    и подменяет старый файл через rename, поэтому падение посреди записи оставляет прежнее состояние целым.
+    """
+
     def __init__(
         self, logger: Logger, file_path: Optional[str] = 'storage.json'
     ):
+        super().__init__()
         self.file_path = file_path
         self._logger = logger
 
-    def save_state(self, state: dict) -> None:
-        with open(self.file_path, 'w') as outfile:
-            json.dump(state, outfile)
+    def _write_state(self, state: dict) -> None:
+        directory = os.path.dirname(os.path.abspath(self.file_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.storage-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as outfile:
+                json.dump(state, outfile)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(tmp_path, self.file_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        # rename надёжен только после сброса на диск самого каталога.
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
-    def retrieve_state(self) -> datetime:
+    def _read_state(self) -> dict:
         try:
             with open(self.file_path, 'r') as json_file:
                 return json.load(json_file)
-        except (FileNotFoundError, JSONDecodeError):
+        except FileNotFoundError:
             self._logger.warning(
                 'No state file provided. Continue with default file'
             )
             return {}
+        except JSONDecodeError as e:
+            # Не начинаем молча с пустого состояния: это означало бы полную переиндексацию.
+            self._logger.error(f'State file {self.file_path} is corrupted: {str(e)}')
+            raise
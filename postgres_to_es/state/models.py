@@ -11,16 +11,14 @@ class State:
         self.storage = storage
 
     def set_state(self, key: str, value: Any) -> None:
-        try:
-            state = self.storage.retrieve_state()
-        except FileNotFoundError:
-            state = dict()
-        state[key] = value
-        self.storage.save_state(state)
+        self.storage.update_state(key, value)
 
     def get_state(self, key: str) -> Any:
         return self.storage.retrieve_state().get(key)
 
+    def peek_state(self, key: str) -> Any:
+        return self.storage.cached_state().get(key)
+
 
 class PersonNested(BaseModel):
     id: uuid.UUID
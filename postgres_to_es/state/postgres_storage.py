@@ -0,0 +1,71 @@
+import threading
+from logging import Logger
+from typing import Union
+
+from psycopg import Connection
+from psycopg.rows import tuple_row
+from psycopg.types.json import Jsonb
+from psycopg_pool import ConnectionPool
+
+from connections import connection
+from .base_storage import BaseStorage
+
+CREATE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS content.etl_state (
+        name TEXT PRIMARY KEY,
+        state jsonb NOT NULL,
+        modified timestamp with time zone NOT NULL DEFAULT now()
+    );
+'''
+
+# Таблица создаётся первым хранилищем процесса: состояния шардов и срезов догона создаются каждый цикл.
+_table_ready = False
+_table_lock = threading.Lock()
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Состояние в таблице content.etl_state.
+
+    Запись выполняется в текущей транзакции соединения conn и не фиксируется самим хранилищем. Если передать
+    соединение, на котором ETL подтверждает записи журнала изменений, состояние зафиксируется в одной транзакции
+    с подтверждением. Для немедленной фиксации нужно соединение в режиме autocommit или пул: тогда каждая запись
+    берёт соединение из пула и фиксируется при его возврате, и обрыв одного соединения не ломает хранилище.
+    """
+
+    def __init__(self, logger: Logger, conn: Union[Connection, ConnectionPool], name: str = 'default'):
+        super().__init__()
+        self.conn = conn
+        self.name = name
+        self._logger = logger
+        self._create_table()
+
+    def _create_table(self) -> None:
+        global _table_ready
+        with _table_lock:
+            if _table_ready:
+                return
+            with connection(self.conn) as conn:
+                conn.execute(CREATE_TABLE_SQL)
+                if not conn.autocommit:
+                    conn.commit()
+            _table_ready = True
+
+    def _write_state(self, state: dict) -> None:
+        with connection(self.conn) as conn:
+            conn.execute(
+                '''
+                INSERT INTO content.etl_state (name, state, modified) VALUES (%s, %s, now())
+                ON CONFLICT (name) DO UPDATE SET state = EXCLUDED.state, modified = EXCLUDED.modified;
+                ''',
+                (self.name, Jsonb(state))
+            )
+
+    def _read_state(self) -> dict:
+        with connection(self.conn) as conn, conn.cursor(row_factory=tuple_row) as cur:
+            cur.execute('SELECT state FROM content.etl_state WHERE name = %s;', (self.name,))
+            row = cur.fetchone()
+        if row is None:
+            self._logger.warning(f'No state {self.name} in content.etl_state. Continue with empty state')
+            return {}
+        return row[0]
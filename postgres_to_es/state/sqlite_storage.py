@@ -0,0 +1,63 @@
+import json
+import sqlite3
+import threading
+from logging import Logger
+from typing import Dict, Tuple
+
+from .base_storage import BaseStorage
+
+_connections: Dict[str, Tuple[sqlite3.Connection, threading.Lock]] = {}
+_connections_lock = threading.Lock()
+
+
+def _connect(db_path: str) -> Tuple[sqlite3.Connection, threading.Lock]:
+    """
+    Одно соединение на файл базы на весь процесс вместе с блокировкой доступа к нему.
+
+    Состояния шардов и срезов догона создаются каждый цикл, поэтому соединение и таблица создаются только
+    при первом обращении к базе, а не для каждого хранилища.
+    """
+    with _connections_lock:
+        if db_path not in _connections:
+            # Контрольные точки фиксируются и из потоков загрузки конвейера, доступ сериализуется блокировкой.
+            conn = sqlite3.connect(db_path, check_same_thread=False)
+            with conn:
+                conn.execute('PRAGMA journal_mode=WAL;')
+                conn.execute('CREATE TABLE IF NOT EXISTS etl_state (name TEXT PRIMARY KEY, state TEXT NOT NULL);')
+            _connections[db_path] = (conn, threading.Lock())
+        return _connections[db_path]
+
+
+class SqliteStorage(BaseStorage):
+    """
+    Состояние в базе SQLite.
+
+    Несколько состояний (например, шардов) хранятся в одной базе под разными именами и пишутся через одно общее
+    соединение. Запись выполняется в транзакции SQLite, поэтому падение посреди записи не портит сохранённое
+    состояние.
+    """
+
+    def __init__(self, logger: Logger, db_path: str = 'storage.db', name: str = 'default'):
+        super().__init__()
+        self.db_path = db_path
+        self.name = name
+        self._logger = logger
+        self._conn, self._conn_lock = _connect(db_path)
+
+    def _write_state(self, state: dict) -> None:
+        with self._conn_lock, self._conn:
+            self._conn.execute(
+                '''
+                INSERT INTO etl_state (name, state) VALUES (?, ?)
+                ON CONFLICT (name) DO UPDATE SET state = excluded.state;
+                ''',
+                (self.name, json.dumps(state))
+            )
+
+    def _read_state(self) -> dict:
+        with self._conn_lock:
+            row = self._conn.execute('SELECT state FROM etl_state WHERE name = ?;', (self.name,)).fetchone()
+        if row is None:
+            self._logger.warning(f'No state {self.name} in {self.db_path}. Continue with empty state')
+            return {}
+        return json.loads(row[0])
@@ -0,0 +1,25 @@
+import os
+from typing import Optional, Union
+
+from psycopg import Connection
+from psycopg_pool import ConnectionPool
+
+from logger import logger
+from settings import etl_settings
+from .base_storage import BaseStorage
+from .json_file_storage import JsonFileStorage
+from .postgres_storage import PostgresStorage
+from .sqlite_storage import SqliteStorage
+
+
+def get_storage(
+        name: str,
+        directory: str,
+        conn: Optional[Union[Connection, ConnectionPool]] = None
+) -> BaseStorage:
+    """Хранилище состояния name согласно ETL_STATE_STORAGE: файл в каталоге directory или таблица на conn."""
+    if etl_settings.state_storage == 'sqlite':
+        return SqliteStorage(logger=logger, db_path=os.path.join(directory, 'storage.db'), name=name)
+    if etl_settings.state_storage == 'postgres':
+        return PostgresStorage(logger=logger, conn=conn, name=name)
+    return JsonFileStorage(logger=logger, file_path=os.path.join(directory, f'{name}.json'))
@@ -1,11 +1,12 @@
 #!/bin/bash
 set -e
 
-echo -e "\nCreating file /postgres_to_es/storage.json...\n"
-if [ ! -f ./postgres_to_es/storage.json ]; then
-    echo "{}" > "./postgres_to_es/storage.json"
-else
-    echo "\nFile postgres_to_es/storage.json already exists\n."
+echo -e "\nCreating ETL state directories /postgres_to_es/data and /postgres_to_es/export...\n"
+mkdir -p ./postgres_to_es/data
+mkdir -p ./postgres_to_es/export
+if [ -f ./postgres_to_es/storage.json ] && [ ! -f ./postgres_to_es/data/storage.json ]; then
+    echo -e "\nMoving postgres_to_es/storage.json to postgres_to_es/data\n"
+    mv ./postgres_to_es/storage.json ./postgres_to_es/data/storage.json
 fi
 
 echo -e "\nBuilding and starting containers...\n"
@@ -17,6 +18,11 @@ source .env
 set +a
 docker-compose exec -it postgres psql -U $DB_USER -d $DB_NAME -a -f /schema_design/movies_database.ddl
 
+if [ "$ETL_CHANGE_SOURCE" = "change_log" ]; then
+    echo -e "\nCreating change log table and triggers...\n"
+    docker-compose exec -it postgres psql -U $DB_USER -d $DB_NAME -a -f /schema_design/change_log.ddl
+fi
+
 echo -e "\nApplying migrations...\n"
 docker-compose exec django python manage.py migrate --fake movies 0001_initial
 docker-compose exec django python manage.py migrate